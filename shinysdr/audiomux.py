@@ -94,6 +94,13 @@ class AudioManager(object):
     def validate_destination(self, destination):
         return destination in self.__audio_buses
     
+    def destination_has_outputs(self, destination):
+        """Whether audio sent to the destination will be heard by anyone."""
+        if destination == CLIENT_AUDIO_DEVICE:
+            return len(self.__audio_queue_sinks) > 0
+        else:
+            return destination in self.__audio_devices
+    
     def reconnecting(self):
         return ReconnectSession(self.__audio_buses, self.__audio_devices, self.__audio_queue_sinks)
 
@@ -246,3 +253,38 @@ class AudioQueueSink(gr.hier_block2):
             for ch in xrange(channels):
                 self.connect((self, ch), (interleaver, ch))
             self.connect(interleaver, sink)
+
+
+class AudioBridgeSource(gr.hier_block2):
+    """
+    Emits, as separate channels, the samples an AudioQueueSink in another top block put on the queue.
+    
+    Together with an AudioQueueSink this carries audio between top blocks, so that each can be locked, reconnected, and restarted without disturbing the other. The sink drops samples rather than blocking if the queue is full, so a stalled or stopped receiving graph never stalls the sending one.
+    """
+    def __init__(self, channels, queue):
+        gr.hier_block2.__init__(
+            self, 'ShinySDR AudioBridgeSource',
+            gr.io_signature(0, 0, 0),
+            gr.io_signature(channels, channels, gr.sizeof_float),
+        )
+        source = blocks.message_source(gr.sizeof_float * channels, queue)
+        if channels == 1:
+            self.connect(source, (self, 0))
+        else:
+            deinterleaver = blocks.vector_to_streams(gr.sizeof_float, channels)
+            self.connect(source, deinterleaver)
+            for ch in xrange(channels):
+                self.connect((deinterleaver, ch), (self, ch))
+
+
+def make_audio_bridge(channels, limit=16):
+    """
+    Return (sink, source) blocks, for use in different top blocks, such that audio input to the sink comes out of the source.
+    
+    limit is the number of queued messages (each one sink work call's worth of samples) beyond which samples are dropped.
+    """
+    queue = gr.msg_queue(limit)
+    return AudioQueueSink(channels=channels, queue=queue), AudioBridgeSource(channels=channels, queue=queue)
+
+
+__all__.append('make_audio_bridge')
@@ -37,7 +37,7 @@ from twisted.python import log
 
 # Note that gnuradio-dependent modules are loaded lazily, to avoid the startup time if all we're going to do is give a usage message
 import shinysdr  # put into config namespace
-from shinysdr.db import DatabaseModel, database_from_csv, databases_from_directory
+from shinysdr.db import DatabaseModel, FrequencyIndex, database_from_csv, databases_from_directory
 
 
 __all__ = []  # appended later
@@ -60,6 +60,7 @@ class Config(object):
         
         # private: config state
         self.__server_audio = None
+        self.__recording_directory = None
         
         # private: meta
         self.__waiting = []
@@ -78,7 +79,9 @@ class Config(object):
         return session.AppRoot(
             devices=self.devices._values,
             audio_config=self.__server_audio,
-            features=self.features._get_all())
+            features=self.features._get_all(),
+            frequency_index=self.databases._get_frequency_index(),
+            recording_directory=self.__recording_directory)
     
     def _not_finished(self):
         if self.__finished:
@@ -95,6 +98,11 @@ class Config(object):
             raise ConfigException('config.persist_to_file has already been done once')
         self._state_filename = str(filename)
 
+    def set_recording_directory(self, path):
+        """Enable recording of devices' IQ samples, into the specified directory."""
+        self._not_finished()
+        self.__recording_directory = str(path)
+
     def serve_web(self, http_endpoint, ws_endpoint, root_cap=None, title=u'ShinySDR'):
         self._not_finished()
         # TODO: See if we're reinventing bits of Twisted service stuff here
@@ -105,6 +113,22 @@ class Config(object):
                 raise ConfigException('config.serve_web: root_cap must be None or a nonempty string')
         
         def make_service(app, note_dirty):
+            if self.features._get('process_separation'):
+                import shinysdr.remote as lazy_remote
+                web_config = {
+                    'http_endpoint': http_endpoint,
+                    'ws_endpoint': ws_endpoint,
+                    'root_cap': root_cap,
+                    'title': title,
+                }
+                web_config.update(self.databases._get_paths())
+                return lazy_remote.WebProcessService(
+                    reactor=self.reactor,
+                    root_object=app.get_session(),
+                    flowgraph_for_debug=app.get_receive_flowgraph(),
+                    note_dirty=note_dirty,
+                    web_config=web_config)
+            
             # TODO: This is, of course, not where session objects should be created. Working on it...
             import shinysdr.web as lazy_web
             return lazy_web.WebService(
@@ -186,6 +210,8 @@ class _ConfigDbs(object):
     def __init__(self, config, reactor):
         self._config = config
         self.__reactor = reactor
+        self.__directories = []
+        self.__writable_path = None
         
         self.__read_only_databases, diagnostics = databases_from_directory(self.__reactor,
             os.path.join(os.path.dirname(__file__), 'data/dbs/'))
@@ -195,6 +221,7 @@ class _ConfigDbs(object):
     def add_directory(self, path):
         self._config._not_finished()
         path = str(path)
+        self.__directories.append(path)
         dbs, path_diagnostics = databases_from_directory(self.__reactor, path)
         self.__read_only_databases.update(dbs)
         for d in path_diagnostics:
@@ -205,6 +232,7 @@ class _ConfigDbs(object):
         path = str(path)
         if self.__writable_db is not None:
             raise ConfigException('Multiple writable databases are not yet supported.')
+        self.__writable_path = path
         self.__writable_db, diagnostics = database_from_csv(self.__reactor, path, writable=True)
         for d in diagnostics:
             log.msg('%s: %s' % (path, d))
@@ -219,11 +247,26 @@ class _ConfigDbs(object):
         if self.__read_only_databases is None:
             self.__read_only_databases = {}
         return self.__read_only_databases
+    
+    def _get_paths(self):
+        """Return the database configuration, for repeating it in another process."""
+        return {
+            'db_directories': list(self.__directories),
+            'writable_db': self.__writable_path,
+        }
+    
+    def _get_frequency_index(self):
+        return FrequencyIndex(
+            self._get_read_only_databases().values() + [self._get_writable_database()])
 
 
 class _ConfigFeatures(object):
     def __init__(self, config):
         self._state = {
+            'demodulator_pool': False,
+            'device_graphs': False,
+            'perf_counters': False,
+            'process_separation': False,
             'reboot': False,
             'stereo': True,
             '_test_disabled_feature': False,
@@ -17,6 +17,7 @@
 
 from __future__ import absolute_import, division
 
+import bisect
 import cgi
 import contextlib
 import csv
@@ -39,11 +40,13 @@ class DatabaseModel(object):
         self.records = records
         self.__pathname = pathname
         self.writable = writable
+        self.generation = 0  # incremented on every change, for caches of the records
     
     def dirty(self):
         """
         Notify that a record has been changed and the database should be written to disk.
         """
+        self.generation += 1
         if self.__can_write() and not self.__dirty:
             self.__dirty = True
             self.__reactor.callLater(0.5, self.__write)
@@ -113,6 +116,43 @@ def databases_from_directory(reactor, pathname):
     return dbs, all_diagnostics
 
 
+class FrequencyIndex(object):
+    """
+    Finds the channel records, in any of a set of databases, nearest a frequency.
+    
+    The index is rebuilt when a lookup notices that one of the databases has changed.
+    """
+    def __init__(self, databases):
+        self.__databases = list(databases)
+        self.__key = None
+        self.__freqs = []
+        self.__records = []
+    
+    def lookup(self, freq, tolerance):
+        """Return the channel record nearest freq and within tolerance of it, or None."""
+        self.__refresh()
+        freqs = self.__freqs
+        i = bisect.bisect_left(freqs, freq)
+        best = None
+        for j in (i - 1, i):
+            if 0 <= j < len(freqs) and abs(freqs[j] - freq) <= tolerance:
+                if best is None or abs(freqs[j] - freq) < abs(freqs[best] - freq):
+                    best = j
+        return None if best is None else self.__records[best]
+    
+    def __refresh(self):
+        key = [(db.generation, len(db.records)) for db in self.__databases]
+        if key == self.__key:
+            return
+        self.__key = key
+        channels = sorted(
+            (record[u'lowerFreq'], i, record)
+            for i, record in enumerate(r for db in self.__databases for r in db.records)
+            if record.get(u'type') == u'channel')
+        self.__freqs = [freq for freq, _, _ in channels]
+        self.__records = [record for _, _, record in channels]
+
+
 class DatabasesResource(resource.Resource):
     isLeaf = False
     
@@ -233,6 +233,8 @@ class Device(ExportedState):
     def close(self):
         """
         Instruct the drivers to perform a clean shutdown, and discard them.
+        
+        Components which have a close() method are closed too.
         """
         if self.rx_driver is not nullExportedState:
             self.rx_driver.close()
@@ -240,7 +242,11 @@ class Device(ExportedState):
         if self.tx_driver is not nullExportedState:
             self.tx_driver.close()
             self.tx_driver = nullExportedState
-        # TODO: Components should probably get close() as well, but that's a whole new interface.
+        # TODO: Components should probably have a real interface for this rather than an optional method.
+        for component in self.__components.itervalues():
+            close = getattr(component, 'close', None)
+            if close is not None:
+                close()
     
     def notify_reconnecting_or_restarting(self):
         if self.rx_driver is not nullExportedState:
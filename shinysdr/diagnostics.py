@@ -0,0 +1,295 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Performance counters of the GNU Radio blocks in the flow graph, grouped by the receiver, device, etc. they belong to, and latency histograms from shinysdr.profiling.
+
+GNU Radio only keeps the counters if they are enabled in its preferences (section PerfCounters, option on) before the flow graph is started; Top does this when the 'perf_counters' feature is enabled.
+"""
+
+from __future__ import absolute_import, division
+
+from gnuradio import gr
+
+from shinysdr.math import LazyRateCalculator
+from shinysdr.profiling import get_histograms, latency_metric_families
+from shinysdr.values import CollectionState, ExportedState, exported_block, exported_value
+
+
+__all__ = []  # appended later
+
+
+def enable_perf_counters():
+    """Enable GNU Radio performance counters for flow graphs started after this point."""
+    gr.prefs().set_bool('PerfCounters', 'on', True)
+
+
+__all__.append('enable_perf_counters')
+
+
+def find_leaf_blocks(root):
+    """
+    Return a dict of name -> GNU Radio leaf block for all blocks found in the attributes of root, a hierarchical block, and of hierarchical blocks found there in turn.
+    
+    GNU Radio does not let us enumerate a hierarchical block's contents, so this finds only blocks which something keeps a reference to, which is nearly all of them in practice.
+    """
+    found = {}
+    seen = set()
+    
+    def visit(value, depth):
+        if id(value) in seen:
+            return
+        if isinstance(value, (list, tuple)):
+            if depth < 2:
+                for item in value:
+                    visit(item, depth + 1)
+        elif isinstance(value, dict):
+            if depth < 2:
+                for item in value.itervalues():
+                    visit(item, depth + 1)
+        elif isinstance(value, gr.hier_block2):
+            seen.add(id(value))
+            for item in vars(value).itervalues():
+                visit(item, 0)
+        elif hasattr(value, 'pc_work_time_total'):
+            seen.add(id(value))
+            found['%s%i' % (value.name(), value.unique_id())] = value
+    
+    visit(root, 0)
+    return found
+
+
+__all__.append('find_leaf_blocks')
+
+
+def format_metrics(rows, families=None):
+    """
+    Format metrics in the Prometheus text exposition format.
+    
+    rows is an iterable of (metric name, dict of labels, value). families is a dict of metric family name -> (type, help text), by default metric_families; each family listed there gets HELP and TYPE lines. The rows of a family are written together, in the order the family first appears, since Prometheus requires that; the _bucket, _count and _sum rows of a histogram belong to its family.
+    """
+    if families is None:
+        families = metric_families
+    family_lines = {}
+    order = []
+    for name, labels, value in rows:
+        family = _metric_family(name, families)
+        lines = family_lines.get(family)
+        if lines is None:
+            lines = family_lines[family] = []
+            order.append(family)
+            if family in families:
+                metric_type, help_text = families[family]
+                lines.append('# HELP %s %s\n' % (family, help_text.replace('\\', '\\\\').replace('\n', '\\n')))
+                lines.append('# TYPE %s %s\n' % (family, metric_type))
+        label_text = ','.join(
+            '%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in sorted(labels.iteritems()))
+        lines.append('%s{%s} %r\n' % (name, label_text, float(value)))
+    return ''.join(line for family in order for line in family_lines[family])
+
+
+def _metric_family(name, families):
+    for suffix in ('_bucket', '_count', '_sum'):
+        if name.endswith(suffix):
+            stem = name[:-len(suffix)]
+            if families.get(stem, (None,))[0] == 'histogram':
+                return stem
+    return name
+
+
+__all__.append('format_metrics')
+
+
+class BlockDiagnostics(ExportedState):
+    """Performance counters of one GNU Radio leaf block."""
+    
+    def __init__(self, block, ticks_per_second):
+        self.__block = block
+        self.__ticks_per_second = ticks_per_second
+        self.__work_calculator = LazyRateCalculator(lambda: block.pc_work_time_total() / ticks_per_second)
+    
+    @exported_value(type=float)
+    def get_work_fraction(self):
+        """Fraction of one CPU spent in the block's work function."""
+        return self.__work_calculator.get()
+    
+    @exported_value(type=float)
+    def get_work_time_avg(self):
+        """Average time per call of the block's work function, in seconds."""
+        return self.__block.pc_work_time_avg() / self.__ticks_per_second
+    
+    @exported_value(type=float)
+    def get_items_produced_avg(self):
+        """Average number of items produced per call."""
+        return self.__block.pc_nproduced_avg()
+    
+    @exported_value(type=float)
+    def get_input_buffers_full(self):
+        """Average fullness (0 to 1) of the fullest input buffer; near 1 means this block is a bottleneck."""
+        return max(list(self.__block.pc_input_buffers_full_avg()) or [0.0])
+    
+    @exported_value(type=float)
+    def get_output_buffers_full(self):
+        """Average fullness (0 to 1) of the fullest output buffer; near 1 means a downstream block is a bottleneck."""
+        return max(list(self.__block.pc_output_buffers_full_avg()) or [0.0])
+    
+    def _metrics(self):
+        return [
+            ('work_fraction', self.get_work_fraction()),
+            ('work_time_avg_seconds', self.get_work_time_avg()),
+            ('items_produced_avg', self.get_items_produced_avg()),
+            ('input_buffers_full', self.get_input_buffers_full()),
+            ('output_buffers_full', self.get_output_buffers_full()),
+        ]
+
+
+__all__.append('BlockDiagnostics')
+
+
+class BlockGroupDiagnostics(ExportedState):
+    """Performance counters of the leaf blocks within one hierarchical block."""
+    
+    def __init__(self, root, ticks_per_second):
+        self.__root = root
+        self.__ticks_per_second = ticks_per_second
+        self.__blocks = {}
+        self.__blocks_state = CollectionState(self.__blocks, dynamic=True)
+    
+    def _get_root(self):
+        return self.__root
+    
+    def _rescan(self):
+        found = find_leaf_blocks(self.__root)
+        for name in self.__blocks.keys():
+            if name not in found:
+                del self.__blocks[name]
+        for name, block in found.iteritems():
+            if name not in self.__blocks:
+                self.__blocks[name] = BlockDiagnostics(block, self.__ticks_per_second)
+    
+    @exported_value(type=float)
+    def get_work_fraction(self):
+        """Fraction of one CPU spent in all of the group's blocks."""
+        return round(sum(b.get_work_fraction() for b in self.__blocks.itervalues()), 2)
+    
+    @exported_block()
+    def get_blocks(self):
+        return self.__blocks_state
+    
+    def _metrics(self):
+        for name, block_diagnostics in self.__blocks.iteritems():
+            for metric, value in block_diagnostics._metrics():
+                yield metric, name, value
+
+
+__all__.append('BlockGroupDiagnostics')
+
+
+class LatencyDiagnostics(ExportedState):
+    """Exports a shinysdr.profiling.LatencyHistogram. Except for the count, the values are over the histogram's recent window (the last one to two minutes)."""
+    
+    def __init__(self, histogram):
+        self.__histogram = histogram
+    
+    @exported_value(type=int)
+    def get_count(self):
+        return self.__histogram.count
+    
+    @exported_value(type=float)
+    def get_p50(self):
+        """Median duration in seconds, rounded up to a power of 2 microseconds."""
+        return self.__histogram.percentile(0.5)
+    
+    @exported_value(type=float)
+    def get_p99(self):
+        """99th percentile duration in seconds, rounded up to a power of 2 microseconds."""
+        return self.__histogram.percentile(0.99)
+    
+    @exported_value(type=float)
+    def get_max(self):
+        return self.__histogram.recent_max()
+
+
+__all__.append('LatencyDiagnostics')
+
+
+class Diagnostics(ExportedState):
+    """
+    Performance counters for a flow graph.
+    
+    get_roots is called by rescan() and returns a dict of group name -> hierarchical block; the owner of the flow graph should call rescan() whenever it is reconnected.
+    """
+    
+    def __init__(self, get_roots, counters_enabled):
+        self.__get_roots = get_roots
+        self.__counters_enabled = counters_enabled
+        self.__groups = {}
+        self.__groups_state = CollectionState(self.__groups, dynamic=True)
+        self.__ticks_per_second = float(gr.high_res_timer_tps()) if counters_enabled else 1.0
+        # histograms are all created when the modules using them are loaded
+        self.__latency = CollectionState({
+            name: LatencyDiagnostics(histogram)
+            for name, histogram in get_histograms().iteritems()})
+    
+    def rescan(self):
+        if not self.__counters_enabled:
+            # nothing to show, so don't spend time looking
+            return
+        roots = self.__get_roots()
+        for key in self.__groups.keys():
+            if key not in roots or self.__groups[key]._get_root() is not roots[key]:
+                del self.__groups[key]
+        for key, root in roots.iteritems():
+            if key not in self.__groups:
+                self.__groups[key] = BlockGroupDiagnostics(root, self.__ticks_per_second)
+            self.__groups[key]._rescan()
+    
+    @exported_value(type=bool)
+    def get_counters_enabled(self):
+        return self.__counters_enabled
+    
+    @exported_block()
+    def get_groups(self):
+        return self.__groups_state
+    
+    @exported_block()
+    def get_latency(self):
+        return self.__latency
+    
+    def metric_rows(self):
+        """Return all counters as a list of rows for format_metrics()."""
+        return [
+            ('shinysdr_block_' + metric, {'group': group_key, 'block': block_name}, value)
+            for group_key, group in sorted(self.__groups.iteritems())
+            for metric, block_name, value in group._metrics()]
+
+
+__all__.append('Diagnostics')
+
+
+metric_families = {
+    'shinysdr_block_work_fraction': ('gauge', 'Fraction of one CPU spent in the block\'s work function.'),
+    'shinysdr_block_work_time_avg_seconds': ('gauge', 'Average time per call of the block\'s work function.'),
+    'shinysdr_block_items_produced_avg': ('gauge', 'Average number of items produced per call of the block\'s work function.'),
+    'shinysdr_block_input_buffers_full': ('gauge', 'Average fullness (0 to 1) of the block\'s fullest input buffer.'),
+    'shinysdr_block_output_buffers_full': ('gauge', 'Average fullness (0 to 1) of the block\'s fullest output buffer.'),
+}
+metric_families.update(latency_metric_families)
+
+
+__all__.append('metric_families')
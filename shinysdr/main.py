@@ -42,6 +42,7 @@ from twisted.python import log
 # Note that gnuradio-dependent modules are loaded later, to avoid the startup time if all we're going to do is give a usage message
 from shinysdr.config import Config, make_default_config, execute_config
 from shinysdr.dependencies import DependencyTester
+from shinysdr.profiling import LoopLagProbe
 
 
 def main(argv=None, _abort_for_test=False):
@@ -132,6 +133,8 @@ def _main_async(reactor, argv=None, _abort_for_test=False):
         IService(maker(app, noteDirty)).setServiceParent(services)
     services.startService()
     
+    LoopLagProbe(reactor).start()
+    
     log.msg('ShinySDR is ready.')
     
     for service in services:
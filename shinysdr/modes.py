@@ -60,11 +60,23 @@ class IDemodulator(Interface):
         
         The output must be stereo audio, mono audio, or nothing.
         """
+    
+    # Demodulators which hold resources other than memory, such as threads or subprocesses, may also have a close() method (with no arguments). The receiver calls it, after disconnecting the demodulator, when it discards the demodulator; see close_demodulator.
 
 
 __all__.append('IDemodulator')
 
 
+def close_demodulator(demodulator):
+    """Call the demodulator's close() method, if it has one."""
+    close = getattr(demodulator, 'close', None)
+    if close is not None:
+        close()
+
+
+__all__.append('close_demodulator')
+
+
 class IModulator(Interface):
     def can_set_mode(mode):
         """
@@ -116,6 +128,7 @@ class ModeDef(object):
             label,
             demod_class,
             mod_class=None,
+            telemetry=False,
             available=True):
         """
         mode: String uniquely identifying this mode, typically a standard abbreviation written in uppercase letters (e.g. "USB").
@@ -123,12 +136,14 @@ class ModeDef(object):
         demod_class: Class to instantiate to create a demodulator for this mode.
         mod_class: Class to instantiate to create a modulator for this mode.
         (TODO: cite demodulator and modulator interface docs)
+        telemetry: If true, the demodulator's useful output is telemetry or other messages, which should be collected even when no one is listening to or watching the receiver.
         available: If false, this mode definition will be ignored.
         """
         self.mode = mode
         self.label = label
         self.demod_class = demod_class
         self.mod_class = mod_class
+        self.telemetry = telemetry
         self.available = available
 
 
@@ -49,7 +49,7 @@ from twisted.web import static
 from zope.interface import Interface, implements  # available via Twisted
 
 from shinysdr.devices import Device
-from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject, TelemetryItem, TelemetryStore, Track, empty_track
+from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject, TelemetryItem, TelemetryParsePipeline, TelemetryStore, Track, empty_track
 from shinysdr.types import Notice, Timestamp
 from shinysdr.values import CollectionState, ExportedState, exported_value
 from shinysdr.web import ClientResourceDef
@@ -278,6 +278,27 @@ Velocity = namedtuple('Velocity', [
 ])
 
 
+# Patterns used by the parser, compiled once at load time since APRS-IS feeds can deliver hundreds of lines per second.
+_tnc2_re = re.compile(r'^([^:>,]+?)>([^:>,]+)((?:,[^:>]+)*):(.*?)$')
+_position_with_timestamp_re = re.compile(r'^.(.{7})(.*)$')
+_mic_e_re = re.compile(r'^.(.)(.)(.)(.)(.)(.)(..)(.*)$')
+_mic_e_type_re = re.compile(r"^([] >`'])(?:(...)\})?(.*)$")
+_object_re = re.compile(r'^.(.{9})([*_])(.{7})(.*)$')
+# more lenient than spec because a real packet I saw had decimal points and variable field lengths
+_telemetry_re = re.compile(r'^T#([^,]*|MIC),?([^,]*),([^,]*),([^,]*),([^,]*),([^,]*),([01]{8})(.*)$')
+_capability_re = re.compile(r'^(.*?)=(.*)$')
+_uncompressed_position_re = re.compile(r'^(\d.{7})(.)(.{9})(.)(.*)$')
+_compressed_position_re = re.compile(r'^(.)(.{4})(.{4})(.)(.)(.)(.)(.*)$')
+_ext_course_speed_re = re.compile(r'^(\d\d\d)/(\d\d\d)(.*)$')
+_ext_phg_re = re.compile(r'^PHG(\d)(\d)(\d)(\d)(.*)$')
+_ext_rng_re = re.compile(r'^RNG(\d\d\d\d)(.*)$')
+_ext_dfs_re = re.compile(r'^DFS(\d)(\d)(\d)(\d)(.*)$')
+_ext_area_re = re.compile(r'^(\d)(\d\d)([/1]\d)(\d\d)(.*)$')
+_dhm_hms_timestamp_re = re.compile(r'^(\d\d)(\d\d)(\d\d)([zh/])$')
+_angle_re = re.compile(r'^(\d{1,3})([\d ]{2}\.[\d ]{2})([NESW])$')
+_comment_altitude_re = re.compile(r'/A=(\d{6})')
+
+
 def parse_tnc2(line, receive_time):
     """Parse "TNC2 text format" APRS messages."""
     if not isinstance(line, unicode):
@@ -285,7 +306,7 @@ def parse_tnc2(line, receive_time):
         line = unicode(line, 'ascii', 'replace')
     facts = []
     errors = []
-    match = re.match(r'^([^:>,]+?)>([^:>,]+)((?:,[^:>]+)*):(.*?)$', line)
+    match = _tnc2_re.match(line)
     if not match:
         errors.append('Could not parse TNC2')
         return APRSMessage(receive_time, '', '', '', line, facts, errors, line)
@@ -297,7 +318,7 @@ def parse_tnc2(line, receive_time):
 
 # TODO: This is something we want to support, but is not really appropriate as-is.
 # The data should go into the 'shared object', but right now only receivers can retrieve those. (I currently think shared objects ought to become more explicitly about telemetry-type data.) The current situation means that all of the data records get stuffed into an unfortunate part of the UI.
-# We need more support for non-RF devices, so that e.g. this can have a close callback, and perhaps so the rest of the system is aware of what this is actually doing.
+# We need more support for non-RF devices, so that the rest of the system is aware of what this is actually doing.
 def APRSISRXDevice(reactor, client, name=None, filter=None):
     """
     client: an aprs.APRS object (see <https://pypi.python.org/pypi/aprs>)
@@ -309,26 +330,29 @@ def APRSISRXDevice(reactor, client, name=None, filter=None):
         name = 'APRS-IS ' + filter
     info = TelemetryStore()  # TODO this is wrong, need to be able to output_message.
     
-    def main_callback(line):
-        # TODO: This print-both-formats code is duplicated from multimon.py; it should be a utility in this module instead. Also, we should maybe have a try block.
+    def parse(item):
+        # runs on the pipeline's worker thread
+        line, receive_time = item
+        # TODO: This print-both-formats code is duplicated from multimon.py; it should be a utility in this module instead.
         log.msg(u'APRS: %r' % (line,))
-        message = parse_tnc2(line, time.time())
+        message = parse_tnc2(line, receive_time)
         log.msg(u'   -> %s' % (message,))
-        parsed = parse_tnc2(line, time.time())
-        info.receive(message)
+        return [message]
+    
+    # Full APRS-IS feeds can be hundreds of lines per second, so parsing is kept off the reactor thread.
+    pipeline = TelemetryParsePipeline(parse=parse, deliver=info.receive, reactor=reactor)
     
     # client blocks in a loop, so set up a thread
-    alive = True
     def threaded_callback(line):
-        if not alive:
+        # The device closes the pipeline when it is closed; the client stops on the next line received after that.
+        if pipeline.is_closed():
             raise StopIteration()
-        reactor.callFromThread(main_callback, line)
+        pipeline.submit((line, time.time()))
     
     reactor.callInThread(client.receive, callback=threaded_callback, filter=filter)
     
-    # TODO: Arrange so we can get close() callbacks and set alive=false
     # TODO: Allow the filter to be changed at runtime
-    return Device(name=name, components={'aprs-is': info})
+    return Device(name=name, components={'aprs-is': info, 'aprs-is-parser': pipeline})
 
 
 def _parse_payload(facts, errors, source, destination, payload, receive_time):
@@ -336,134 +360,157 @@ def _parse_payload(facts, errors, source, destination, payload, receive_time):
         errors.append('zero length information')
         return payload
     data_type = payload[0]
+    parser = _data_type_parsers.get(data_type)
+    if parser is None:
+        errors.append('unrecognized data type: %r' % data_type)
+        return payload
+    return parser(facts, errors, destination, payload, receive_time)
+
+
+def _parse_position_without_timestamp(facts, errors, destination, payload, receive_time):
+    facts.append(Messaging(payload[0] == '='))
+    return _parse_position_and_symbol(facts, errors, payload[1:])
+
+
+def _parse_position_with_timestamp(facts, errors, destination, payload, receive_time):
+    facts.append(Messaging(payload[0] == '@'))
+    match = _position_with_timestamp_re.match(payload)
+    if not match:
+        errors.append('Position With Timestamp is too short')
+        return payload
+    else:
+        time_str, position_str = match.groups()
+        _parse_dhm_hms_timestamp(facts, errors, time_str, receive_time)
+        return _parse_position_and_symbol(facts, errors, position_str)
+
+
+def _parse_capabilities(facts, errors, destination, payload, receive_time):
+    facts.append(Capabilities(dict(map(_parse_capability, payload[1:].split(',')))))
+    return ''
+
+
+def _parse_status(facts, errors, destination, payload, receive_time):
+    # TODO: parse timestamp
+    facts.append(Status(payload[1:]))
+    return ''
+
+
+def _parse_mic_e(facts, errors, destination, payload, receive_time):
+    match = _mic_e_re.match(payload)
+    if not match:
+        errors.append('Mic-E Information is too short')
+        return payload
+    elif len(destination) < 6:
+        errors.append('Mic-E Destination Address is too short')
+        return payload
     
-    if data_type == '!' or data_type == '=':  # Position Without Timestamp
-        facts.append(Messaging(data_type == '='))
-        return _parse_position_and_symbol(facts, errors, payload[1:])
+    # TODO: deal with ssid/7th byte
+    # This is a generic application of the decoding table: note that not all of the resulting values are meaningful (e.g. only ns_bits[3] is a north/south value).
+    lat_digits, message_bits, ns_bits, lon_offset_bits, ew_bits = zip(*[_mic_e_addr_decode_table[x] for x in destination[0:6]])
+    latitude_string = ''.join(lat_digits[0:4]) + '.' + ''.join(lat_digits[4:6]) + ns_bits[3]
+    latitude = _parse_angle(latitude_string)
+    longitude_offset = lon_offset_bits[4]
     
-    if data_type == '/' or data_type == '@':  # Position With Timestamp
-        facts.append(Messaging(data_type == '@'))
-        match = re.match(r'^.(.{7})(.*)$', payload)
-        if not match:
-            errors.append('Position With Timestamp is too short')
-            return payload
-        else:
-            time_str, position_str = match.groups()
-            _parse_dhm_hms_timestamp(facts, errors, time_str, receive_time)
-            return _parse_position_and_symbol(facts, errors, position_str)
+    # TODO: parse Mic-E "message"/"position comment" bits
     
-    elif data_type == '<':  # Capabilities
-        facts.append(Capabilities(dict(map(_parse_capability, payload[1:].split(',')))))
-        return ''
+    # TODO: interpret data type ID values (note spec revisions about it)
     
-    elif data_type == '>':  # Status
-        # TODO: parse timestamp
-        facts.append(Status(payload[1:]))
-        return ''
+    d28, m28, h28, sp28, dc28, se28, symbol_rev, type_and_more = match.groups()
     
-    elif data_type == '`' or data_type == "'":  # Mic-E position
-        match = re.match(r'^.(.)(.)(.)(.)(.)(.)(..)(.*)$', payload)
-        if not match:
-            errors.append('Mic-E Information is too short')
-            return payload
-        elif len(destination) < 6:
-            errors.append('Mic-E Destination Address is too short')
-            return payload
-        else:
-            # TODO: deal with ssid/7th byte
-            # This is a generic application of the decoding table: note that not all of the resulting values are meaningful (e.g. only ns_bits[3] is a north/south value).
-            lat_digits, message_bits, ns_bits, lon_offset_bits, ew_bits = zip(*[_mic_e_addr_decode_table[x] for x in destination[0:6]])
-            latitude_string = ''.join(lat_digits[0:4]) + '.' + ''.join(lat_digits[4:6]) + ns_bits[3]
-            latitude = _parse_angle(latitude_string)
-            longitude_offset = lon_offset_bits[4]
-            
-            # TODO: parse Mic-E "message"/"position comment" bits
-            
-            # TODO: interpret data type ID values (note spec revisions about it)
-            
-            d28, m28, h28, sp28, dc28, se28, symbol_rev, type_and_more = match.groups()
-            
-            # decode longitude, as specified in http://www.aprs.org/doc/APRS101.PDF page 48
-            lon_d = ord(d28) - 28 + longitude_offset
-            if 180 <= lon_d <= 189:
-                lon_d -= 80
-            elif 190 <= lon_d <= 199:
-                lon_d -= 190
-            lon_m = ord(m28) - 28
-            if lon_m >= 60:
-                lon_m -= 60
-            lon_s = ord(h28) - 28
-            longitude = ew_bits[5] * (lon_d + (lon_m + lon_s / 100) / 60)
-            # TODO: interpret position ambiguity from latitude
-            
-            if latitude is not None:
-                facts.append(Position(latitude, longitude))
-            else:
-                errors.append('Mic-E latitude does not parse: %r' % latitude_string)
-            
-            # decode course and speed, as specified in http://www.aprs.org/doc/APRS101.PDF page 52
-            dc = ord(dc28) - 28
-            speed = (ord(sp28) - 28) * 10 + dc // 10
-            course = dc % 10 + (ord(se28) - 28)
-            if speed >= 800:
-                speed -= 800
-            if course >= 400:
-                course -= 400
-            facts.append(Velocity(speed_knots=speed, course_degrees=course))
-            
-            _parse_symbol(facts, errors, symbol_rev[1] + symbol_rev[0])
-            
-            # Type code per http://www.aprs.org/aprs12/mic-e-types.txt
-            # TODO: parse and process manufacturer codes
-            type_match = re.match(r"^([] >`'])(?:(...)\})?(.*)$", type_and_more)
-            if type_match is None:
-                errors.append('Mic-E contained non-type-code text: %r' % type_and_more)
-                return type_and_more
-            else:
-                type_code, opt_altitude, more_text = type_match.groups()
-                # TODO: process type code
-                if opt_altitude is not None:
-                    facts.append(Altitude(value=_parse_base91(opt_altitude) - 10000, feet_not_meters=False))
-                return more_text  # or should this be a status fact?
-
-    elif data_type == ';':  # Object
-        match = re.match(r'^.(.{9})([*_])(.{7})(.*)$', payload)
-        if not match:
-            errors.append('Object Information did not parse')
-            return payload
-        else:
-            name, live_str, time_str, position_ext_and_comment = match.groups()
-            obj_facts = []
-            
-            _parse_dhm_hms_timestamp(obj_facts, errors, time_str, receive_time)
-            comment = _parse_position_and_symbol(obj_facts, errors, position_ext_and_comment)
-            
-            facts.append(ObjectItemReport(
-                object=True,
-                name=name,
-                live=live_str == '*',
-                facts=obj_facts))
-            return comment
-
-    elif data_type == 'T':  # Telemetry (1.0.1 format)
-        # more lenient than spec because a real packet I saw had decimal points and variable field lengths
-        match = re.match(r'^T#([^,]*|MIC),?([^,]*),([^,]*),([^,]*),([^,]*),([^,]*),([01]{8})(.*)$', payload)
-        if not match:
-            errors.append('Telemetry did not parse: %r' % payload)
-            return ''
-        else:
-            seq, a1, a2, a3, a4, a5, digital, comment = match.groups()
-            _parse_telemetry_value(facts, errors, a1, 1)
-            _parse_telemetry_value(facts, errors, a2, 2)
-            _parse_telemetry_value(facts, errors, a3, 3)
-            _parse_telemetry_value(facts, errors, a4, 4)
-            _parse_telemetry_value(facts, errors, a5, 5)
-            # TODO: handle seq # (how is it used in practice?) and digital
-            return comment
-        
+    # decode longitude, as specified in http://www.aprs.org/doc/APRS101.PDF page 48
+    lon_d = ord(d28) - 28 + longitude_offset
+    if 180 <= lon_d <= 189:
+        lon_d -= 80
+    elif 190 <= lon_d <= 199:
+        lon_d -= 190
+    lon_m = ord(m28) - 28
+    if lon_m >= 60:
+        lon_m -= 60
+    lon_s = ord(h28) - 28
+    longitude = ew_bits[5] * (lon_d + (lon_m + lon_s / 100) / 60)
+    # TODO: interpret position ambiguity from latitude
+    
+    if latitude is not None:
+        facts.append(Position(latitude, longitude))
     else:
-        errors.append('unrecognized data type: %r' % data_type)
+        errors.append('Mic-E latitude does not parse: %r' % latitude_string)
+    
+    # decode course and speed, as specified in http://www.aprs.org/doc/APRS101.PDF page 52
+    dc = ord(dc28) - 28
+    speed = (ord(sp28) - 28) * 10 + dc // 10
+    course = dc % 10 + (ord(se28) - 28)
+    if speed >= 800:
+        speed -= 800
+    if course >= 400:
+        course -= 400
+    facts.append(Velocity(speed_knots=speed, course_degrees=course))
+    
+    _parse_symbol(facts, errors, symbol_rev[1] + symbol_rev[0])
+    
+    # Type code per http://www.aprs.org/aprs12/mic-e-types.txt
+    # TODO: parse and process manufacturer codes
+    type_match = _mic_e_type_re.match(type_and_more)
+    if type_match is None:
+        errors.append('Mic-E contained non-type-code text: %r' % type_and_more)
+        return type_and_more
+    else:
+        type_code, opt_altitude, more_text = type_match.groups()
+        # TODO: process type code
+        if opt_altitude is not None:
+            facts.append(Altitude(value=_parse_base91(opt_altitude) - 10000, feet_not_meters=False))
+        return more_text  # or should this be a status fact?
+
+
+def _parse_object(facts, errors, destination, payload, receive_time):
+    match = _object_re.match(payload)
+    if not match:
+        errors.append('Object Information did not parse')
         return payload
+    else:
+        name, live_str, time_str, position_ext_and_comment = match.groups()
+        obj_facts = []
+        
+        _parse_dhm_hms_timestamp(obj_facts, errors, time_str, receive_time)
+        comment = _parse_position_and_symbol(obj_facts, errors, position_ext_and_comment)
+        
+        facts.append(ObjectItemReport(
+            object=True,
+            name=name,
+            live=live_str == '*',
+            facts=obj_facts))
+        return comment
+
+
+def _parse_telemetry(facts, errors, destination, payload, receive_time):
+    # Telemetry (1.0.1 format)
+    match = _telemetry_re.match(payload)
+    if not match:
+        errors.append('Telemetry did not parse: %r' % payload)
+        return ''
+    else:
+        seq, a1, a2, a3, a4, a5, digital, comment = match.groups()
+        _parse_telemetry_value(facts, errors, a1, 1)
+        _parse_telemetry_value(facts, errors, a2, 2)
+        _parse_telemetry_value(facts, errors, a3, 3)
+        _parse_telemetry_value(facts, errors, a4, 4)
+        _parse_telemetry_value(facts, errors, a5, 5)
+        # TODO: handle seq # (how is it used in practice?) and digital
+        return comment
+
+
+# Parsers for the information field, keyed by APRS data type identifier (the first character).
+_data_type_parsers = {
+    '!': _parse_position_without_timestamp,
+    '=': _parse_position_without_timestamp,
+    '/': _parse_position_with_timestamp,
+    '@': _parse_position_with_timestamp,
+    '<': _parse_capabilities,
+    '>': _parse_status,
+    '`': _parse_mic_e,
+    "'": _parse_mic_e,
+    ';': _parse_object,
+    'T': _parse_telemetry,
+}
 
 
 _mic_e_addr_decode_table = {
@@ -511,7 +558,7 @@ def _parse_symbol(facts, errors, symbol):
 
 
 def _parse_capability(capability):
-    match = re.match(r'^(.*?)=(.*)$', capability)
+    match = _capability_re.match(capability)
     if match:
         return match.groups()
     else:
@@ -520,7 +567,7 @@ def _parse_capability(capability):
 
 def _parse_position_and_symbol(facts, errors, data):
     # Uncompressed position
-    match = re.match(r'^(\d.{7})(.)(.{9})(.)(.*)$', data)
+    match = _uncompressed_position_re.match(data)
     if match:
         lat, symbol1, lon, symbol2, ext_and_comment = match.groups()
         plat = _parse_angle(lat)
@@ -535,7 +582,7 @@ def _parse_position_and_symbol(facts, errors, data):
              _parse_data_extension(facts, errors, ext_and_comment, symbol))
     
     # Compressed position
-    match = re.match(r'^(.)(.{4})(.{4})(.)(.)(.)(.)(.*)$', data)
+    match = _compressed_position_re.match(data)
     if match:
         symbol1, lat, lon, symbol2, c, s, comptype, comment = match.groups()
         plat = 90 - _parse_base91(lat) / 380926
@@ -572,34 +619,34 @@ def _parse_data_extension(facts, errors, data, symbol):
     if len(data) < 7:
         return data
     
-    match = re.match(r'^(\d\d\d)/(\d\d\d)(.*)$', data)
+    match = _ext_course_speed_re.match(data)
     if match and symbol is not '\\l':  # not an area object, which is ambiguous
         # TODO: Deal with wind direction case
         course, speed, comment = match.groups()
         facts.append(Velocity(speed_knots=int(speed), course_degrees=int(course)))
         return comment
     
-    match = re.match(r'^PHG(\d)(\d)(\d)(\d)(.*)$', data)
+    match = _ext_phg_re.match(data)
     if match:
         # TODO: Store this data
         p, h, g, d, comment = match.groups()
         errors.append('PHG parsing not implemented')
         return comment
     
-    match = re.match(r'^RNG(\d\d\d\d)(.*)$', data)
+    match = _ext_rng_re.match(data)
     if match:
         range_str, comment = match.groups()
         facts.append(RadioRange(int(range_str)))
         return comment
     
-    match = re.match(r'^DFS(\d)(\d)(\d)(\d)(.*)$', data)
+    match = _ext_dfs_re.match(data)
     if match:
         # TODO: Store this data
         s, h, g, d, comment = match.groups()
         errors.append('DFS parsing not implemented')
         return comment
     
-    match = re.match(r'^(\d)(\d\d)([/1]\d)(\d\d)(.*)$', data)
+    match = _ext_area_re.match(data)
     if match:
         # TODO: Store this data
         type_code, yy, color_code, xx, comment = match.groups()
@@ -611,7 +658,7 @@ def _parse_data_extension(facts, errors, data, symbol):
 
 
 def _parse_dhm_hms_timestamp(facts, errors, data, receive_time):
-    match = re.match(r'^(\d\d)(\d\d)(\d\d)([zh/])$', data)
+    match = _dhm_hms_timestamp_re.match(data)
     if not match:
         errors.append('DHM/HMS timestamp does not parse')
         return
@@ -640,7 +687,7 @@ def _parse_dhm_hms_timestamp(facts, errors, data, receive_time):
 def _parse_angle(angle_str):
     # TODO return imprecision information
     # TODO old notes say "." is allowed as imprecision, check
-    match = re.match(r'^(\d{1,3})([\d ]{2}\.[\d ]{2})([NESW])$', angle_str)
+    match = _angle_re.match(angle_str)
     if not match:
         return None
     else:
@@ -654,7 +701,7 @@ def _parse_angle(angle_str):
 
 
 def _parse_comment_altitude(facts, errors, comment):
-    match = re.search(r'/A=(\d{6})', comment)
+    match = _comment_altitude_re.search(comment)
     if match:
         facts.append(Altitude(value=int(match.group(1)), feet_not_meters=True))
         comment = comment[:match.start()] + comment[match.end():]
@@ -23,10 +23,12 @@ Android to connect to ShinySDR as a "dspserver"; references:
 <https://github.com/alexlee188/ghpsdr3-alex/tree/master/trunk/src/dspserver/client.c>
 <https://github.com/alexlee188/ghpsdr3-alex/tree/master/trunk/src/dspserver/audiostream.c>
 
-DOES NOT YET WORK: some messages we send have the wrong length as judged
-by the glSDR client, resulting in the following messages being
-misparsed. No success yet in figuring out where the discrepancy is.
-Patches welcome.
+NOT YET CONFIRMED TO WORK: messages previously had the wrong length as
+judged by the glSDR client, resulting in the following messages being
+misparsed. The headers were being packed with native alignment and byte
+order; they are now packed as big-endian without padding, as dspserver
+does, but this has not yet been tested against a real client. Patches
+welcome.
 """
 
 
@@ -38,7 +40,6 @@ Patches welcome.
 
 from __future__ import absolute_import, division
 
-import array
 import struct
 
 from twisted.application import strports
@@ -48,6 +49,7 @@ from twisted.internet import task
 from twisted.python import log
 
 from gnuradio import gr
+import numpy
 
 
 __all__ = ['DspserverService']
@@ -55,6 +57,41 @@ __all__ = ['DspserverService']
 
 _CLIENT_MSG_LENGTH = 64
 
+# message type, header version, header subversion, and then type-specific fields
+_spectrum_header = struct.Struct('>BBBHHHIh')  # ..., width, meter, subrx meter, sample rate, LO offset
+_audio_header = struct.Struct('>BBBH')  # ..., number of samples
+_SPECTRUM_BUFFER = 0
+_AUDIO_BUFFER = 1
+_HEADER_VERSION = 2
+_HEADER_SUBVERSION = 1
+
+_AUDIO_RATE = 8000
+_AUDIO_SAMPLES_PER_MESSAGE = 2000
+
+
+def _make_alaw_table():
+    """
+    Build a table for G.711 A-law encoding (as dspserver uses for audio) indexed by 13-bit linear sample + 4096.
+    """
+    # per the reference implementation, g711.c
+    segment_ends = numpy.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+    linear = numpy.arange(-4096, 4096)
+    mask = numpy.where(linear >= 0, 0xD5, 0x55)
+    magnitude = numpy.where(linear >= 0, linear, -linear - 1)
+    segment = numpy.searchsorted(segment_ends, magnitude)
+    mantissa = numpy.where(segment < 2, magnitude >> 1, magnitude >> numpy.maximum(segment, 1)) & 0xF
+    encoded = numpy.where(segment >= 8, 0x7F, (numpy.minimum(segment, 7) << 4) | mantissa)
+    return (encoded ^ mask).astype(numpy.uint8)
+
+
+_alaw_table = _make_alaw_table()
+
+
+def _encode_alaw(samples):
+    """Encode float samples in [-1, 1] as A-law bytes."""
+    linear = numpy.clip(samples * 4096, -4096, 4095).astype(numpy.int16)
+    return _alaw_table.take(linear + 4096).tostring()
+
 
 def _cmd_noop(self, argstr):
     """stub command implementation"""
@@ -66,6 +103,8 @@ def _cmd_setFPS(self, argstr):
     self._req_width = width
     self._top.monitor.set_freq_resolution(width)
     self._top.monitor.set_frame_rate(rate)
+    if self._poller.running:
+        self._poller.stop()
     self._poller.start(1.0 / (rate * 2.0))
     self._top.monitor.set_paused(False)
 
@@ -91,19 +130,22 @@ class _DspserverProtocol(protocol.Protocol):
         self._req_width = None
         self.__msgbuf = ''
         self._poller = task.LoopingCall(self.__poll)
-        self.__splitter = top.monitor.state()['fft'].subscribe()
+        fft_cell = top.monitor.state()['fft']
+        self.__splitter = fft_cell.subscribe()
+        self.__fft_info_struct = struct.Struct(fft_cell.type().get_info_format())
+        self.__fft_work = numpy.zeros(0, dtype=numpy.float32)  # reused between frames
         self.__audio_queue = gr.msg_queue(limit=100)
-        self.__audio_buffer = ''
-        self._top.add_audio_queue(self.__audio_queue, 8000)
+        self.__audio_chunks = []
+        self.__audio_buffered = 0  # bytes in __audio_chunks
+        self._top.add_audio_queue(self.__audio_queue, _AUDIO_RATE)
 
     def dataReceived(self, data):
         """twisted Protocol implementation"""
-        self.__msgbuf += data
-        while len(self.__msgbuf) >= _CLIENT_MSG_LENGTH:
-            # TODO: efficient buffering
-            msg = self.__msgbuf[:_CLIENT_MSG_LENGTH]
-            self.__msgbuf = self.__msgbuf[_CLIENT_MSG_LENGTH:]
-            self.__messageReceived(msg)
+        msgbuf = self.__msgbuf + data
+        count = len(msgbuf) // _CLIENT_MSG_LENGTH
+        self.__msgbuf = msgbuf[count * _CLIENT_MSG_LENGTH:]
+        for i in xrange(count):
+            self.__messageReceived(msgbuf[i * _CLIENT_MSG_LENGTH:(i + 1) * _CLIENT_MSG_LENGTH])
     
     def _get_receiver(self):
         receiver_cells = self._top.receivers.state().values()
@@ -137,48 +179,68 @@ class _DspserverProtocol(protocol.Protocol):
     def __poll(self):
         receiver = self._get_receiver()
         while True:
-            frame = self.__splitter.get()
+            frame = self.__splitter.get(binary=True)
             if frame is None:
                 break
-            ((freq, sample_rate), fft) = frame
             if self._req_width is None:
                 break
-            print 'Sending frame', self._req_width, sample_rate  # TODO: Remove debugging
-            msg = struct.pack('BBBHHHIh' + str(self._req_width) + 's',
-                0,
-                2,
-                1,
-                self._req_width,  # short
-                0,  # meter
-                0,  # subrx meter
-                sample_rate,
-                receiver.get_rec_freq() - freq,  # lo_offset
-                ''.join([chr(int(max(1, min(255, -(x - 20))))) for x in fft]))
-            self.transport.write(msg)
-
+            self.__send_spectrum(receiver, frame)
+        
         # audio
         aqueue = self.__audio_queue
         while not aqueue.empty_p():
             grmessage = aqueue.delete_head()
             if grmessage.length() > 0:  # avoid crash bug
-                self.__audio_buffer += grmessage.to_string()
-        size_in_bytes = 2000 * 4
-        if len(self.__audio_buffer) > size_in_bytes:
-            abuf = self.__audio_buffer[:size_in_bytes]
-            self.__audio_buffer = self.__audio_buffer[size_in_bytes:]
-            print 'Sending audio', len(abuf)  # TODO: Remove debugging
-            unpacker = array.array('f')
-            unpacker.fromstring(abuf)
-            nsamples = len(unpacker)
-            msg = struct.pack('BBBH' + str(nsamples) + 'B',
-                1,
-                2,
-                1,
-                nsamples,
-                # TODO tweak
-                *[int(max(0, min(255, x * 127 + 127))) for x in unpacker.tolist()])
-            # TODO: Disabled until we fix fft messages
-            # self.transport.write(msg)
+                chunk = grmessage.to_string()
+                self.__audio_chunks.append(chunk)
+                self.__audio_buffered += len(chunk)
+        channels = self._top.get_audio_queue_channels()
+        message_bytes = _AUDIO_SAMPLES_PER_MESSAGE * channels * gr.sizeof_float
+        if self.__audio_buffered >= message_bytes:
+            self.__send_audio(channels, message_bytes)
+    
+    def __send_spectrum(self, receiver, frame):
+        (freq, sample_rate, offset) = self.__fft_info_struct.unpack_from(frame)
+        fft = numpy.frombuffer(frame, dtype=numpy.int8, offset=self.__fft_info_struct.size)
+        width = self._req_width
+        if len(fft) != width:
+            # monitor has not yet switched to the requested resolution
+            return
+        work = self.__fft_work
+        if len(work) != width:
+            work = self.__fft_work = numpy.zeros(width, dtype=numpy.float32)
+        # dspserver sends negated dB values, clamped to 1..255
+        numpy.subtract(20 + offset, fft, out=work)
+        numpy.clip(work, 1, 255, out=work)
+        self.transport.write(_spectrum_header.pack(
+            _SPECTRUM_BUFFER,
+            _HEADER_VERSION,
+            _HEADER_SUBVERSION,
+            width,
+            0,  # meter
+            0,  # subrx meter
+            int(sample_rate),
+            max(-32768, min(32767, int(receiver.get_rec_freq() - freq))),  # LO offset
+        ) + work.astype(numpy.uint8).tostring())
+    
+    def __send_audio(self, channels, message_bytes):
+        data = ''.join(self.__audio_chunks)
+        message_count = len(data) // message_bytes
+        remainder = data[message_count * message_bytes:]
+        self.__audio_chunks = [remainder]
+        self.__audio_buffered = len(remainder)
+        
+        samples = numpy.frombuffer(data, dtype=numpy.float32, count=message_count * message_bytes // gr.sizeof_float)
+        if channels > 1:
+            samples = samples.reshape(-1, channels).mean(axis=1)
+        encoded = _encode_alaw(samples)
+        for i in xrange(message_count):
+            self.transport.write(_audio_header.pack(
+                _AUDIO_BUFFER,
+                _HEADER_VERSION,
+                _HEADER_SUBVERSION,
+                _AUDIO_SAMPLES_PER_MESSAGE,
+            ) + encoded[i * _AUDIO_SAMPLES_PER_MESSAGE:(i + 1) * _AUDIO_SAMPLES_PER_MESSAGE])
 
 
 class _DspserverFactory(protocol.Factory):
@@ -37,6 +37,7 @@ TODO explain how to link up with soundcard devices
 
 from __future__ import absolute_import, division
 
+from collections import deque
 import os.path
 import re
 import subprocess
@@ -311,13 +312,21 @@ class _HamlibProxy(ExportedState):
         self.__communication_error = False
         self.__last_error = (-1e9, '', 0)
         
+        # set commands awaiting a reply, and the arguments for the next set command once they are answered; keys are command names
+        self.__sets_in_flight = set()
+        self.__pending_set_args = {}
+        
         self.__protocol = protocol
         self.__disconnect_deferred = defer.Deferred()
         protocol._set_proxy(self)
 
-        # TODO: If hamlib backend supports "transceive mode", use it in lieu of polling
-        self.__poller_slow = LoopingCall(self.__poll_slow)
-        self.__poller_fast = LoopingCall(self.__poll_fast)
+        # Polls whose replies have not all arrived yet; a poll is skipped rather than queued behind itself, so slow rigs are polled only as fast as they answer.
+        self.__polls_in_flight = set()
+        self.__skipped_poll_count = 0
+        
+        # rigctld does not relay "transceive mode" events to network clients, so we must poll.
+        self.__poller_slow = LoopingCall(self.__poll, 'slow', self.poll_slow)
+        self.__poller_fast = LoopingCall(self.__poll, 'fast', self.__poll_fast)
         self.__poller_slow.start(2.0)
         self.__poller_fast.start(0.2)
         
@@ -397,9 +406,21 @@ class _HamlibProxy(ExportedState):
         name_in_cmd = self._how_to_command[name_full]  # raises if cannot set
         if value != self.__cache[name_full]:
             self.__cache[name_full] = value
-            self.__protocol.rc_send(
-                'set_' + name_in_cmd,
-                ' '.join(self.__cache[arg_name] for arg_name in self._commands[name_in_cmd]))
+            # Captured now, since polling may overwrite the cache before the command is sent.
+            self.__pending_set_args[name_in_cmd] = ' '.join(self.__cache[arg_name] for arg_name in self._commands[name_in_cmd])
+            if name_in_cmd not in self.__sets_in_flight:
+                self.__send_set(name_in_cmd)
+            # else last write wins: only the latest value is sent once the rig has answered the previous set
+    
+    def __send_set(self, name_in_cmd):
+        self.__sets_in_flight.add(name_in_cmd)
+        d = self.__protocol.rc_send('set_' + name_in_cmd, self.__pending_set_args.pop(name_in_cmd))
+        d.addCallback(self.__set_answered, name_in_cmd)
+    
+    def __set_answered(self, _return_code, name_in_cmd):
+        self.__sets_in_flight.discard(name_in_cmd)
+        if name_in_cmd in self.__pending_set_args:
+            self.__send_set(name_in_cmd)
     
     def state_def(self, callback):
         super(_HamlibProxy, self).state_def(callback)
@@ -416,17 +437,40 @@ class _HamlibProxy(ExportedState):
             # TODO support writable levels
             _install_cell(self, level_name + ' level', True, False, callback, self.__caps)
 
-    def __poll_fast(self):
-        # TODO: Stop if we're getting behind
-        p = self.__protocol
-        self.poll_fast(p.rc_send)
+    def __poll(self, name, poll_function):
+        if name in self.__polls_in_flight:
+            # getting behind; back off until the rig catches up
+            self.__skipped_poll_count += 1
+            return
+        protocol = self.__protocol
+        deferreds = []
+        
+        def send(cmd, argstr=''):
+            deferreds.append(protocol.rc_send(cmd, argstr, poll=True))
+        
+        poll_function(send)
+        if deferreds:
+            self.__polls_in_flight.add(name)
+            defer.DeferredList(deferreds).addCallback(lambda _: self.__polls_in_flight.discard(name))
+    
+    def __poll_fast(self, send):
+        self.poll_fast(send)
         for level_name in self.__levels:
-            p.rc_send('get_level', level_name)
+            send('get_level', level_name)
     
-    def __poll_slow(self):
-        # TODO: Stop if we're getting behind
-        p = self.__protocol
-        self.poll_slow(p.rc_send)
+    @exported_value(type=float)
+    def get_command_latency(self):
+        """Average seconds from sending a command to the daemon to receiving its reply."""
+        return self.__protocol.get_latency()
+    
+    @exported_value(type=int)
+    def get_command_queue_depth(self):
+        """Number of commands queued or awaiting a reply."""
+        return self.__protocol.get_queue_depth()
+    
+    @exported_value(type=int)
+    def get_skipped_poll_count(self):
+        return self.__skipped_poll_count
     
     @exported_value(type=Notice(always_visible=False))
     def get_errors(self):
@@ -604,6 +648,12 @@ class _HamlibClientFactory(ClientFactory):
 
 
 class _HamlibClientProtocol(Protocol):
+    # Maximum number of commands sent but not yet answered. The daemon executes commands one at a time, so more than enough to cover the round trip only moves the queue out of our control, where it can no longer be prioritized.
+    _window = 2
+    
+    # Weight of the newest sample in the average latency.
+    _latency_smoothing = 0.2
+    
     def __init__(self, server_name, connected_deferred):
         self.__proxy_obj = None
         self.__server_name = server_name
@@ -611,7 +661,10 @@ class _HamlibClientProtocol(Protocol):
         self.__line_receiver = LineReceiver()
         self.__line_receiver.delimiter = '\n'
         self.__line_receiver.lineReceived = self.__lineReceived
-        self.__waiting_for_responses = []
+        self.__waiting_for_responses = []  # (cmd, deferred, send time) in order sent
+        self.__queue = deque()  # (cmd, argstr, deferred) not yet sent
+        self.__poll_queue = deque()  # same, sent only when __queue is empty
+        self.__latency = 0.0
         self.__receive_cmd = None
         self.__receive_arg = None
     
@@ -640,21 +693,24 @@ class _HamlibClientProtocol(Protocol):
                 # command response ending line
                 return_code = int(match.group(1))
                 
+                receive_cmd = self.__receive_cmd
+                self.__receive_cmd = None
+                self.__receive_arg = None
+                
                 waiting = self.__waiting_for_responses
-                i = 0
-                for i, (wait_cmd, wait_deferred) in enumerate(waiting):
-                    if self.__receive_cmd != wait_cmd:
-                        log.err("%s client: Didn't get a response for command %r before receiving one for command %r" % (self.__server_name, wait_cmd, self.__receive_cmd))
+                while waiting:
+                    wait_cmd, wait_deferred, send_time = waiting.pop(0)
+                    if receive_cmd != wait_cmd:
+                        log.err("%s client: Didn't get a response for command %r before receiving one for command %r" % (self.__server_name, wait_cmd, receive_cmd))
+                        wait_deferred.callback(RIG_EPROTO)
                     else:
+                        self.__latency += (time.time() - send_time - self.__latency) * self._latency_smoothing
                         # TODO: Consider 'parsing' return code more here.
                         if return_code != 0:
-                            self.__proxy_obj._clientError(self.__receive_cmd, return_code)
+                            self.__proxy_obj._clientError(receive_cmd, return_code)
                         wait_deferred.callback(return_code)
                         break
-                self.__waiting_for_responses = waiting[i + 1:]
-                
-                self.__receive_cmd = None
-                self.__receive_arg = None
+                self.__send_queued()
                 return
             if self.__receive_cmd == 'get_level':
                 # Should be a level value
@@ -684,15 +740,37 @@ class _HamlibClientProtocol(Protocol):
     def _set_proxy(self, proxy):
         self.__proxy_obj = proxy
     
-    def rc_send(self, cmd, argstr=''):
+    def rc_send(self, cmd, argstr='', poll=False):
+        """
+        Send a command, returning a Deferred which fires with the return code.
+        
+        Commands are sent in order, except that those with poll=True wait until no other commands are queued.
+        """
         if not re.match(r'^\w+$', cmd):  # no spaces (stuffing args in), no newlines (breaking the command)
             raise ValueError('Syntactically invalid command name %r' % (cmd,))
         if not re.match(r'^[^\r\n]*$', argstr):  # no newlines
             raise ValueError('Syntactically invalid arguments string %r' % (cmd,))
-        self.transport.write('+\\' + cmd + ' ' + argstr + '\n')
         d = defer.Deferred()
-        self.__waiting_for_responses.append((cmd, d))
+        (self.__poll_queue if poll else self.__queue).append((cmd, argstr, d))
+        self.__send_queued()
         return d
+    
+    def __send_queued(self):
+        while len(self.__waiting_for_responses) < self._window:
+            if self.__queue:
+                cmd, argstr, d = self.__queue.popleft()
+            elif self.__poll_queue:
+                cmd, argstr, d = self.__poll_queue.popleft()
+            else:
+                break
+            self.transport.write('+\\' + cmd + ' ' + argstr + '\n')
+            self.__waiting_for_responses.append((cmd, d, time.time()))
+    
+    def get_latency(self):
+        return self.__latency
+    
+    def get_queue_depth(self):
+        return len(self.__queue) + len(self.__poll_queue) + len(self.__waiting_for_responses)
 
 _plugin_client = ClientResourceDef(
     key=__name__,
@@ -42,9 +42,9 @@ from shinysdr.filters import MultistageChannelFilter
 from shinysdr.math import LazyRateCalculator
 from shinysdr.modes import ModeDef, IDemodulator
 from shinysdr.signals import no_signal
-from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject, TelemetryItem, TelemetryStore, Track, empty_track
+from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject, TelemetryItem, TelemetryParsePipeline, TelemetryStore, Track, empty_track
 from shinysdr.types import Notice, Timestamp
-from shinysdr.values import CollectionState, ExportedState, exported_value
+from shinysdr.values import CollectionState, ExportedState, exported_block, exported_value
 from shinysdr.web import ClientResourceDef
 
 
@@ -97,35 +97,53 @@ class ModeSDemodulator(gr.hier_block2, ExportedState):
         
         # Parsing
         # TODO: These bits are mimicking gr-air-modes toplevel code. Figure out if we can have less glue.
-        # Note: gr pubsub is synchronous -- subscribers are called on the publisher's thread
+        # Note: gr pubsub is synchronous -- subscribers are called on the publisher's thread, which here is the parse pipeline's worker thread.
         parser_output = gr.pubsub.pubsub()
         parser = air_modes.make_parser(parser_output)
         cpr_decoder = air_modes.cpr_decoder(my_location=None)  # TODO: get position info from device
-        air_modes.output_print(cpr_decoder, parser_output)
+        # output_print gets its own decoder because it runs on the worker thread while cpr_decoder is used by Aircraft on the reactor thread.
+        air_modes.output_print(air_modes.cpr_decoder(my_location=None), parser_output)
+        parsed_messages = []  # only touched on the worker thread
+        
+        def parsed_callback(msg):
+            parsed_messages.append(ModeSMessageWrapper(msg, cpr_decoder, time.time()))
+        
+        for i in xrange(0, 2 ** 5):
+            parser_output.subscribe('type%i_dl' % i, parsed_callback)
+        
+        def parse(msg_string):
+            del parsed_messages[:]
+            parser(msg_string)
+            return list(parsed_messages)
+        
+        def deliver(message):
+            self.__messages_seen += 1
+            context.output_message(message)
+        
+        self.__pipeline = TelemetryParsePipeline(parse=parse, deliver=deliver, reactor=reactor)
+        
         def callback(msg):  # called on msgq_runner's thrad
             # pylint: disable=broad-except
             try:
-                reactor.callFromThread(parser, msg.to_string())
+                self.__pipeline.submit(msg.to_string())
             except Exception:
                 print traceback.format_exc()
         
         self.__msgq_runner = gru.msgq_runner(hex_msg_queue, callback)
-        
-        def parsed_callback(msg):
-            timestamp = time.time()
-            self.__messages_seen += 1
-            context.output_message(ModeSMessageWrapper(msg, cpr_decoder, timestamp))
-        
-        for i in xrange(0, 2 ** 5):
-            parser_output.subscribe('type%i_dl' % i, parsed_callback)
 
-    def __del__(self):
+    def close(self):
+        """implements IDemodulator"""
         self.__msgq_runner.stop()
+        self.__pipeline.close()
     
     @exported_value(float)
     def get_message_rate(self):
         return round(self.__message_rate_calc.get(), 1)
     
+    @exported_block()
+    def get_parser(self):
+        return self.__pipeline
+    
     def can_set_mode(self, mode):
         return False
 
@@ -285,6 +303,7 @@ plugin_mode = ModeDef(
     mode='MODE-S',
     label='Mode S',
     demod_class=ModeSDemodulator,
+    telemetry=True,
     available=_available)
 plugin_client = ClientResourceDef(
     key=__name__,
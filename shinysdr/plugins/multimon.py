@@ -15,15 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
 
-# pylint: disable=no-member
-# (no-member: Twisted reactor)
-
 from __future__ import absolute_import, division
 
 import time
 import warnings
 
-from twisted.internet import reactor
 from twisted.internet.protocol import ProcessProtocol
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
@@ -32,12 +28,14 @@ from zope.interface import implements
 from gnuradio import analog
 from gnuradio import gr
 from gnuradio import blocks
+import numpy
 
-from shinysdr.blocks import make_sink_to_process_stdin, test_subprocess
+from shinysdr.blocks import test_subprocess
 from shinysdr.filters import make_resampler
 from shinysdr.modes import ModeDef, IDemodulator
 from shinysdr.plugins.basic_demod import NFMDemodulator
 from shinysdr.plugins.aprs import parse_tnc2
+from shinysdr.process import the_decoder_process_pool
 from shinysdr.signals import SignalType
 from shinysdr.types import Enum
 from shinysdr.values import ExportedState, exported_block, exported_value, setter
@@ -59,36 +57,38 @@ class MultimonNGDemodulator(gr.hier_block2, ExportedState):
         )
         
         # Subprocess
-        # using /usr/bin/env because twisted spawnProcess doesn't support path search
-        process = reactor.spawnProcess(
-            protocol,
-            '/usr/bin/env',
-            env=None,  # inherit environment
-            args=['env', 'multimon-ng', '-t', 'raw'] + multimon_demod_args + ['-v', '10', '-'],
-            childFDs={
-                0: 'w',
-                1: 'r',
-                2: 2
-            })
-        sink = make_sink_to_process_stdin(process, itemsize=gr.sizeof_short)
+        # The input rate is fixed at pipe_rate, so the arguments fully identify the process and it may be reused by any later demodulator with the same arguments.
+        lease = the_decoder_process_pool.acquire(
+            args=['multimon-ng', '-t', 'raw'] + multimon_demod_args + ['-v', '10', '-'],
+            protocol=protocol)
+        lease.release_when_collected(self)
+        self.__lease = lease
+        sink = lease.make_sink(dtype=numpy.int16)
+        self.__pipe_writer = sink.get_writer()
         
         # Output
-        to_short = blocks.float_to_short(vlen=1, scale=int_scale)
         self.connect(
             self,
             # blocks.complex_to_float(),
-            to_short,
+            blocks.float_to_short(vlen=1, scale=int_scale),
             sink)
-        # Audio copy output
-        unconverter = blocks.short_to_float(vlen=1, scale=int_scale)
-        self.connect(to_short, unconverter)
-        self.connect(unconverter, self)
-        
+        # Audio copy output; no need to round-trip it through the integer conversion. (A hier block cannot connect its input directly to its output, hence the copy block.)
+        self.connect(self, blocks.copy(gr.sizeof_float), self)
+    
     def get_input_type(self):
         return SignalType(kind='MONO', sample_rate=pipe_rate)
     
+    def close(self):
+        """Stop writing to the decoder process and return it to the pool. Must not be called while this block is connected."""
+        self.__pipe_writer.close()
+        self.__lease.release()
+    
     def get_output_type(self):
         return SignalType(kind='MONO', sample_rate=pipe_rate)
+    
+    @exported_block()
+    def get_decoder_pipe(self):
+        return self.__pipe_writer
 
 
 _aprs_squelch_type = Enum({
@@ -143,6 +143,10 @@ class APRSDemodulator(gr.hier_block2, ExportedState):
     def get_input_type(self):
         return self.__mm_demod.get_input_type()
     
+    def close(self):
+        """implements IDemodulator"""
+        self.__mm_demod.close()
+    
     def get_output_type(self):
         return self.__mm_demod.get_output_type()
     
@@ -206,6 +210,10 @@ class FMAPRSDemodulator(gr.hier_block2, ExportedState):
     def can_set_mode(self, mode):
         return False
     
+    def close(self):
+        """implements IDemodulator"""
+        self.mm_demod.close()
+    
     @exported_value()
     def get_band_filter_shape(self):
         return self.fm_demod.get_band_filter_shape()
@@ -260,4 +268,5 @@ pluginDef_APRS = ModeDef(
     mode='APRS',  # TODO: Rename mode to be more accurate
     label='APRS',
     demod_class=FMAPRSDemodulator,
+    telemetry=True,
     available=_multimon_available)
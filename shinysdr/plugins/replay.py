@@ -0,0 +1,287 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replay of recorded IQ files as a receiving device.
+"""
+
+from __future__ import absolute_import, division
+
+import json
+import os.path
+
+import numpy
+
+from zope.interface import implements  # available via Twisted
+
+from gnuradio import blocks
+from gnuradio import gr
+
+from shinysdr.devices import Device, IRXDriver
+from shinysdr.signals import SignalType
+from shinysdr.types import Range
+from shinysdr.values import ExportedState, LooseCell, exported_value, setter
+
+
+__all__ = []  # appended later
+
+
+# SigMF datatype name -> (numpy dtype of one component, scale, offset)
+_datatypes = {
+    'cf32_le': (numpy.dtype('<f4'), 1.0, 0.0),
+    'cf32_be': (numpy.dtype('>f4'), 1.0, 0.0),
+    'ci16_le': (numpy.dtype('<i2'), 1 / 32768, 0.0),
+    'ci16_be': (numpy.dtype('>i2'), 1 / 32768, 0.0),
+    'ci8': (numpy.dtype('i1'), 1 / 128, 0.0),
+    'cu8': (numpy.dtype('u1'), 1 / 127.5, -127.5),  # as written by rtl_sdr
+}
+
+
+def read_sigmf_metadata(data_path):
+    """
+    Return a dict of the sample_rate, frequency, and datatype recorded in the SigMF metadata file accompanying the given data file, omitting any which are not known.
+    
+    A missing metadata file is not an error, since raw files have none.
+    """
+    base, ext = os.path.splitext(data_path)
+    meta_path = base + '.sigmf-meta' if ext == '.sigmf-data' else data_path + '.sigmf-meta'
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, 'r') as f:
+        metadata = json.load(f)
+    global_info = metadata.get('global', {})
+    captures = metadata.get('captures', [])
+    result = {}
+    if 'core:sample_rate' in global_info:
+        result['sample_rate'] = float(global_info['core:sample_rate'])
+    if 'core:datatype' in global_info:
+        result['datatype'] = str(global_info['core:datatype'])
+    if captures and 'core:frequency' in captures[0]:
+        result['frequency'] = float(captures[0]['core:frequency'])
+    return result
+
+
+__all__.append('read_sigmf_metadata')
+
+
+class MappedSampleReader(object):
+    """
+    Reads complex samples from a memory-mapped file, converting them to complex64.
+    
+    The position may be changed by seek() from another thread than the one calling read_into(); the change takes effect at the next read.
+    """
+    
+    def __init__(self, path, datatype='cf32_le', loop=True):
+        if datatype not in _datatypes:
+            raise ValueError('Unsupported datatype %r; known types are %s' % (datatype, ', '.join(sorted(_datatypes))))
+        component_dtype, self.__scale, self.__offset = _datatypes[datatype]
+        self.__native = datatype == 'cf32_le' and component_dtype.isnative
+        if os.path.getsize(path) < 2 * component_dtype.itemsize:
+            raise ValueError('%s does not contain any samples' % (path,))
+        # numpy.memmap uses mmap; pages are read from the file as they are touched.
+        self.__components = numpy.memmap(path, dtype=component_dtype, mode='r')
+        self.__length = len(self.__components) // 2
+        self.__position = 0
+        self.__seek_to = None
+        self.loop = loop
+    
+    def get_length(self):
+        """Number of samples in the file."""
+        return self.__length
+    
+    def tell(self):
+        seek_to = self.__seek_to
+        return seek_to if seek_to is not None else self.__position
+    
+    def seek(self, position):
+        self.__seek_to = max(0, min(self.__length, int(position)))
+    
+    def read_into(self, out):
+        """
+        Copy samples into the complex64 array out, returning the number copied.
+        
+        Returns fewer than len(out) only at the end of the file when not looping, and then 0 on every later call.
+        """
+        seek_to = self.__seek_to
+        if seek_to is not None:
+            self.__seek_to = None
+            self.__position = seek_to
+        position = self.__position
+        wanted = len(out)
+        done = 0
+        while done < wanted:
+            if position >= self.__length:
+                if not self.loop:
+                    break
+                position = 0
+            count = min(wanted - done, self.__length - position)
+            self.__convert(position, count, out[done:done + count])
+            position += count
+            done += count
+        self.__position = position
+        return done
+    
+    def __convert(self, position, count, out):
+        components = self.__components[2 * position:2 * (position + count)]
+        if self.__native:
+            out[:] = components.view(numpy.complex64)
+        else:
+            converted = components.astype(numpy.float32)
+            if self.__offset:
+                converted += self.__offset
+            if self.__scale != 1.0:
+                converted *= self.__scale
+            out[:] = converted.view(numpy.complex64)
+    
+    def close(self):
+        # numpy.memmap has no explicit close; dropping the reference unmaps the file.
+        self.__components = None
+
+
+__all__.append('MappedSampleReader')
+
+
+def FileDevice(path, name=None, sample_rate=None, freq=None, datatype=None, throttle=True, loop=True):
+    """
+    A device which plays back an IQ file: a SigMF recording (such as those written by config.set_recording_directory) or a raw file.
+    
+    sample_rate, freq, and datatype override the values in the SigMF metadata file, and must be given if there is none (datatype defaults to cf32_le).
+    
+    If throttle is false, samples are produced as fast as the flow graph consumes them.
+    """
+    metadata = read_sigmf_metadata(path)
+    if sample_rate is None:
+        sample_rate = metadata.get('sample_rate')
+    if sample_rate is None:
+        raise ValueError('No sample rate known for %s; specify sample_rate' % (path,))
+    if freq is None:
+        freq = metadata.get('frequency', 0.0)
+    if datatype is None:
+        datatype = metadata.get('datatype', 'cf32_le')
+    if name is None:
+        name = os.path.basename(path)
+    rx_driver = _FileRXDriver(
+        name=name,
+        reader=MappedSampleReader(path, datatype=datatype, loop=loop),
+        sample_rate=float(sample_rate),
+        throttle=throttle)
+    return Device(
+        name=name,
+        vfo_cell=LooseCell(
+            key='freq',
+            value=float(freq),
+            type=Range([(freq, freq)]),
+            writable=True,
+            persists=False),
+        rx_driver=rx_driver)
+
+
+__all__.append('FileDevice')
+
+
+class _FileRXDriver(ExportedState, gr.hier_block2):
+    implements(IRXDriver)
+    
+    def __init__(self, name, reader, sample_rate, throttle):
+        gr.hier_block2.__init__(
+            self, type(self).__name__,
+            gr.io_signature(0, 0, 0),
+            gr.io_signature(1, 1, gr.sizeof_gr_complex * 1),
+        )
+        self.__reader = reader
+        self.__sample_rate = sample_rate
+        
+        self.__source = _MappedFileSource(reader, name)
+        if throttle:
+            self.__throttle = blocks.throttle(gr.sizeof_gr_complex, sample_rate)
+            self.connect(self.__source, self.__throttle, self)
+        else:
+            self.__throttle = None
+            self.connect(self.__source, self)
+        
+        self.__signal_type = SignalType(
+            kind='IQ',
+            sample_rate=sample_rate)
+        self.__usable_bandwidth = Range([(-sample_rate / 2, sample_rate / 2)])
+    
+    # implement IRXDriver
+    @exported_value(type=SignalType)
+    def get_output_type(self):
+        return self.__signal_type
+    
+    # implement IRXDriver
+    def get_tune_delay(self):
+        return 0.0
+    
+    # implement IRXDriver
+    def get_usable_bandwidth(self):
+        return self.__usable_bandwidth
+    
+    # implement IRXDriver
+    def close(self):
+        self.__reader.close()
+    
+    # implement IRXDriver
+    def notify_reconnecting_or_restarting(self):
+        if self.__throttle is not None:
+            # See the same kludge in plugins.simulate.
+            self.__throttle.set_sample_rate(self.__throttle.sample_rate())
+    
+    @exported_value(type=float)
+    def get_duration(self):
+        """Length of the file in seconds."""
+        return self.__reader.get_length() / self.__sample_rate
+    
+    @exported_value(type=Range([(0, 1e9)], strict=False), persists=False)
+    def get_position(self):
+        """Current playback position in seconds."""
+        return self.__reader.tell() / self.__sample_rate
+    
+    @setter
+    def set_position(self, value):
+        self.__reader.seek(float(value) * self.__sample_rate)
+    
+    @exported_value(type=bool)
+    def get_loop(self):
+        return self.__reader.loop
+    
+    @setter
+    def set_loop(self, value):
+        self.__reader.loop = bool(value)
+    
+    @exported_value(type=bool)
+    def get_throttle(self):
+        """Whether playback is limited to the recorded sample rate."""
+        return self.__throttle is not None
+
+
+class _MappedFileSource(gr.sync_block):
+    """GNU Radio source block which outputs the samples from a MappedSampleReader."""
+    
+    def __init__(self, reader, name):
+        gr.sync_block.__init__(
+            self,
+            name='%s(%s)' % (type(self).__name__, name),
+            in_sig=None,
+            out_sig=[numpy.complex64])
+        self.__reader = reader
+    
+    def work(self, input_items, output_items):
+        count = self.__reader.read_into(output_items[0])
+        if count == 0:
+            return -1  # WORK_DONE: end of file and not looping
+        return count
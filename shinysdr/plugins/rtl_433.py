@@ -20,7 +20,6 @@ from __future__ import absolute_import, division
 import json
 import time
 
-from twisted.internet import reactor as the_reactor  # TODO eliminate
 from twisted.internet.protocol import ProcessProtocol
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
@@ -28,15 +27,17 @@ from zope.interface import implements
 
 from gnuradio import analog
 from gnuradio import gr
+import numpy
 
-from shinysdr.blocks import make_sink_to_process_stdin, test_subprocess
+from shinysdr.blocks import test_subprocess
 from shinysdr.filters import MultistageChannelFilter
 from shinysdr.math import dB
 from shinysdr.modes import ModeDef, IDemodulator
+from shinysdr.process import the_decoder_process_pool
 from shinysdr.signals import no_signal
 from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject
 from shinysdr.types import Timestamp
-from shinysdr.values import ExportedState, LooseCell, exported_value
+from shinysdr.values import ExportedState, LooseCell, exported_block, exported_value
 
 
 drop_unheard_timeout_seconds = 120
@@ -82,24 +83,18 @@ class RTL433Demodulator(gr.hier_block2, ExportedState):
                 transition_width=demod_rate * 0.2)
         
         # Subprocess
-        # using /usr/bin/env because twisted spawnProcess doesn't support path search
-        # pylint: disable=no-member
-        process = the_reactor.spawnProcess(
-            RTL433ProcessProtocol(context.output_message),
-            '/usr/bin/env',
-            env=None,  # inherit environment
-            args=['env', 'rtl_433',
+        lease = the_decoder_process_pool.acquire(
+            args=['rtl_433',
                 '-F', 'json',
                 '-r', '-',  # read from stdin
                 '-m', '3',  # complex float input
                 '-s', str(demod_rate),
             ],
-            childFDs={
-                0: 'w',
-                1: 'r',
-                2: 2
-            })
-        sink = make_sink_to_process_stdin(process, itemsize=gr.sizeof_gr_complex)
+            protocol=RTL433ProcessProtocol(context.output_message))
+        lease.release_when_collected(self)
+        self.__lease = lease
+        sink = lease.make_sink(dtype=numpy.complex64)
+        self.__pipe_writer = sink.get_writer()
         
         agc = analog.agc2_cc(reference=dB(-4))
         agc.set_attack_rate(200 / demod_rate)
@@ -120,6 +115,11 @@ class RTL433Demodulator(gr.hier_block2, ExportedState):
         """implements IDemodulator"""
         return False
     
+    def close(self):
+        """implements IDemodulator"""
+        self.__pipe_writer.close()
+        self.__lease.release()
+    
     @exported_value()
     def get_band_filter_shape(self):
         """implements IDemodulator"""
@@ -136,6 +136,10 @@ class RTL433Demodulator(gr.hier_block2, ExportedState):
     def get_output_type(self):
         """implements IDemodulator"""
         return no_signal
+    
+    @exported_block()
+    def get_decoder_pipe(self):
+        return self.__pipe_writer
 
 
 class RTL433ProcessProtocol(ProcessProtocol):
@@ -330,4 +334,5 @@ plugin_mode = ModeDef(
     mode='433',
     label='rtl_433',
     demod_class=RTL433Demodulator,
+    telemetry=True,
     available=_rtl_433_available)
@@ -42,7 +42,7 @@ from shinysdr.filters import MultistageChannelFilter
 from shinysdr.modes import ModeDef, IDemodulator, IModulator
 from shinysdr.signals import SignalType, no_signal
 from shinysdr.types import Range
-from shinysdr.values import ExportedState, exported_block, exported_value
+from shinysdr.values import ExportedState, TextStreamCell, exported_block, exported_value
 
 
 # note: this string is ordered so that the first bit (on the air) is the least significant bit of the index in the string
@@ -73,7 +73,7 @@ class RTTYDemodulator(gr.hier_block2, ExportedState):
             gr.io_signature(1, 1, gr.sizeof_gr_complex * 1),
             gr.io_signature(1, 1, gr.sizeof_float * 1),
         )
-        self.__text = u''
+        self.__text_cell = TextStreamCell(key='text', source=self.__drain_text)
         
         baud = _DEFAULT_BAUD  # TODO param
         self.baud = baud
@@ -132,20 +132,20 @@ class RTTYDemodulator(gr.hier_block2, ExportedState):
     def get_fsk_demod(self):
         return self.fsk_demod
 
-    @exported_value(type=unicode)
-    def get_text(self):
+    def state_def(self, callback):
+        super(RTTYDemodulator, self).state_def(callback)
+        callback(self.__text_cell)
+    
+    def __drain_text(self):
         queue = self.__char_queue
+        chunks = []
         # we would use .delete_head_nowait() but it returns a crashy wrapper instead of a sensible value like None. So implement a test (which is safe as long as we're the only reader)
-        if not queue.empty_p():
+        while not queue.empty_p():
             message = queue.delete_head()
             if message.length() > 0:
-                bitstring = message.to_string()
-            else:
-                bitstring = ''  # avoid crash bug
-            textstring = self.__text
-            textstring += bitstring
-            self.__text = textstring[-20:]
-        return self.__text
+                chunks.append(message.to_string())
+            # else avoid crash bug
+        return ''.join(chunks).decode('us-ascii', 'replace')
 
 
 # Because we don't currently have an encoder which can operate as a block, the rtty modulator is limited to looping a fixed message. This is good enough for simulation testing.
@@ -40,8 +40,11 @@ from shinysdr.values import CollectionState, ExportedState, LooseCell, exported_
 __all__ = []  # appended later
 
 
-def SimulatedDevice(name='Simulated RF', freq=0.0, allow_tuning=False):
-    rx_driver = _SimulatedRXDriver(name)
+def SimulatedDevice(name='Simulated RF', freq=0.0, allow_tuning=False, throttle=True):
+    """
+    If throttle is false, the signal is generated as fast as the flow graph consumes it rather than in real time, which is useful for benchmarking.
+    """
+    rx_driver = _SimulatedRXDriver(name, throttle=throttle)
     return Device(
         name=name,
         vfo_cell=LooseCell(
@@ -68,7 +71,7 @@ class _SimulatedRXDriver(ExportedState, gr.hier_block2):
     audio_rate = 1e4
     rf_rate = 200e3
 
-    def __init__(self, name):
+    def __init__(self, name, throttle=True):
         gr.hier_block2.__init__(
             self, name,
             gr.io_signature(0, 0, 0),
@@ -91,13 +94,21 @@ class _SimulatedRXDriver(ExportedState, gr.hier_block2):
             # taps=...,  # TODO: apply something here?
         )
         self.__rotator = blocks.rotator_cc()
-        self.__throttle = blocks.throttle(gr.sizeof_gr_complex, rf_rate)
-        self.connect(
-            self.__bus,
-            self.__throttle,
-            self.__channel_model,
-            self.__rotator,
-            self)
+        if throttle:
+            self.__throttle = blocks.throttle(gr.sizeof_gr_complex, rf_rate)
+            self.connect(
+                self.__bus,
+                self.__throttle,
+                self.__channel_model,
+                self.__rotator,
+                self)
+        else:
+            self.__throttle = None
+            self.connect(
+                self.__bus,
+                self.__channel_model,
+                self.__rotator,
+                self)
         signals = []
         
         def add_modulator(freq, key, mode_or_modulator_ctor, **kwargs):
@@ -179,7 +190,8 @@ class _SimulatedRXDriver(ExportedState, gr.hier_block2):
     def notify_reconnecting_or_restarting(self):
         # The throttle block runs on a clock which does not stop when the flowgraph stops; resetting the sample rate restarts the clock.
         # The necessity of this kludge has been filed as a gnuradio bug at <http://gnuradio.org/redmine/issues/649>
-        self.__throttle.set_sample_rate(self.__throttle.sample_rate())
+        if self.__throttle is not None:
+            self.__throttle.set_sample_rate(self.__throttle.sample_rate())
 
 
 class _SimulatedTransmitter(gr.hier_block2, ExportedState):
@@ -0,0 +1,539 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+#
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Management of long-lived external decoder processes (multimon-ng, rtl_433, etc.) which are fed samples on their stdin.
+
+This module is not an external API and not guaranteed to have a stable
+interface.
+"""
+
+# pylint: disable=no-member
+# (no-member: Twisted reactor)
+
+from __future__ import absolute_import, division
+
+import errno
+import fcntl
+import os
+import sys
+import time
+import weakref
+
+from twisted.internet import reactor as the_reactor
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+from gnuradio import gr
+import numpy
+
+from shinysdr.math import LazyRateCalculator
+from shinysdr.values import ExportedState, exported_value
+
+
+__all__ = []  # appended later
+
+
+class DecoderProcessPool(ExportedState):
+    """
+    Spawns decoder processes and keeps them alive for reuse.
+    
+    A process is identified by its argument list (which must include anything, such as the sample rate, that affects how it interprets its input). The tools we run read a single sample stream, so a process serves one lease at a time; when the lease is released the process is kept idle for a while so that the next user with the same arguments (e.g. after a mode switch or demodulator rebuild) does not have to fork a new one.
+    
+    Each process reads from a pipe owned by the pool rather than by the process, so that if the process dies it is respawned on the same pipe and the flow graph writing into it is not disturbed.
+    """
+    
+    def __init__(self, reactor=the_reactor, idle_timeout=60, max_idle_per_key=1, max_restart_delay=10, max_consecutive_failures=10, pipe_size=1 << 20):
+        self.__reactor = reactor
+        self.__pipe_size = pipe_size
+        self.__idle_timeout = idle_timeout
+        self.__max_idle_per_key = max_idle_per_key
+        self.__max_restart_delay = max_restart_delay
+        self.__max_consecutive_failures = max_consecutive_failures
+        
+        self.__idle = {}  # key -> list of _DecoderProcess, most recently released last
+        self.__processes = set()
+        # weakref to owner -> DecoderProcessLease. The pool, not the lease, holds the weakrefs, since a weakref which is itself garbage never has its callback called.
+        self.__owned_leases = {}
+        
+        # metrics
+        self.__spawn_count = 0
+        self.__reuse_count = 0
+        self.__restart_count = 0
+        self.__last_spawn_latency = 0.0
+        self.__last_respawn_latency = 0.0
+    
+    def acquire(self, args, protocol):
+        """
+        Obtain exclusive use of a decoder process.
+        
+        args: command and arguments, e.g. ['multimon-ng', '-t', 'raw', ...]. Looked up on the PATH.
+        protocol: a ProcessProtocol whose outReceived will be called with the process's stdout for as long as the lease is held.
+        
+        Returns a DecoderProcessLease.
+        """
+        key = tuple(args)
+        idle = self.__idle.get(key)
+        if idle:
+            process = idle.pop()
+            if not idle:
+                del self.__idle[key]
+            self.__reuse_count += 1
+        else:
+            process = _DecoderProcess(self, key, self.__pipe_size)
+            self.__processes.add(process)
+            process.spawn()
+        return DecoderProcessLease(self, process, protocol)
+    
+    def close_all(self):
+        """Stop all processes, including those in use."""
+        self.__idle.clear()
+        self.__owned_leases.clear()
+        for process in list(self.__processes):
+            process.stop()
+    
+    def _release_when_collected(self, lease, owner):
+        """for use by DecoderProcessLease only"""
+        reactor = self.__reactor
+        owned_leases = self.__owned_leases
+        
+        def collected(ref):
+            lease = owned_leases.pop(ref, None)
+            if lease is not None:
+                # The weakref callback may run at an arbitrary point, so defer the actual work.
+                reactor.callFromThread(lease.release)
+        
+        ref = weakref.ref(owner, collected)
+        owned_leases[ref] = lease
+        return ref
+    
+    def _release(self, process, owner_ref):
+        """for use by DecoderProcessLease only"""
+        if owner_ref is not None:
+            self.__owned_leases.pop(owner_ref, None)
+        if not process.is_running():
+            return
+        idle = self.__idle.setdefault(process.key, [])
+        idle.append(process)
+        while len(idle) > self.__max_idle_per_key:
+            idle.pop(0).stop()
+        process.schedule_expiry(self.__reactor.callLater(self.__idle_timeout, self.__expire, process))
+    
+    def __expire(self, process):
+        if self.__remove_idle(process):
+            process.stop()
+    
+    def __remove_idle(self, process):
+        idle = self.__idle.get(process.key, [])
+        if process not in idle:
+            return False
+        idle.remove(process)
+        if not idle:
+            del self.__idle[process.key]
+        return True
+    
+    def _spawn(self, process_protocol, key, read_fd):
+        """for use by _DecoderProcess only"""
+        t0 = time.time()
+        # using /usr/bin/env because twisted spawnProcess doesn't support path search
+        transport = self.__reactor.spawnProcess(
+            process_protocol,
+            '/usr/bin/env',
+            env=None,  # inherit environment
+            args=['env'] + list(key),
+            childFDs={
+                0: read_fd,
+                1: 'r',
+                2: 2
+            })
+        self.__spawn_count += 1
+        self.__last_spawn_latency = time.time() - t0
+        return transport
+    
+    def _process_died(self, process, expected):
+        """for use by _DecoderProcess only"""
+        description = ' '.join(process.key)
+        if not expected:
+            if self.__remove_idle(process):
+                # No one is using it, so no need to restart it.
+                log.msg('Idle decoder process %s exited unexpectedly' % (description,))
+                expected = True
+            elif process.consecutive_failures > self.__max_consecutive_failures:
+                log.err('Decoder process %s keeps exiting; giving up' % (description,))
+                expected = True
+            else:
+                self.__restart_count += 1
+                delay = min(self.__max_restart_delay, 0.1 * 2 ** process.consecutive_failures)
+                log.msg('Decoder process %s exited unexpectedly; restarting in %.1f s' % (description, delay))
+                process.schedule_respawn(self.__reactor.callLater(delay, process.respawn))
+        if expected:
+            process.stop()
+            self._forget(process)
+    
+    def _forget(self, process):
+        """for use by _DecoderProcess only"""
+        self.__processes.discard(process)
+    
+    def _note_respawned(self, latency):
+        """for use by _DecoderProcess only"""
+        self.__last_respawn_latency = latency
+    
+    @exported_value(type=int)
+    def get_process_count(self):
+        return len(self.__processes)
+    
+    @exported_value(type=int)
+    def get_idle_count(self):
+        return sum(len(idle) for idle in self.__idle.itervalues())
+    
+    @exported_value(type=int)
+    def get_spawn_count(self):
+        return self.__spawn_count
+    
+    @exported_value(type=int)
+    def get_reuse_count(self):
+        return self.__reuse_count
+    
+    @exported_value(type=int)
+    def get_restart_count(self):
+        return self.__restart_count
+    
+    @exported_value(type=float)
+    def get_last_spawn_latency(self):
+        """Seconds taken by the most recent spawnProcess call."""
+        return self.__last_spawn_latency
+    
+    @exported_value(type=float)
+    def get_last_respawn_latency(self):
+        """Seconds from noticing the most recent unexpected exit to having a replacement running, including the restart delay."""
+        return self.__last_respawn_latency
+
+
+__all__.append('DecoderProcessPool')
+
+
+class PipeWriter(ExportedState):
+    """
+    Writes a stream of samples to a pipe without ever blocking.
+    
+    Small writes are coalesced into writes of at least coalesce_size bytes to reduce system call overhead; larger writes go directly from the caller's buffer when nothing is already queued. When the pipe is full, the data is queued, up to max_buffer_size bytes; past that, the oldest whole items are dropped (an overrun), since a decoder which cannot keep up is better served by recent samples than by stalling the flow graph.
+    
+    write() is called from the GNU Radio scheduler thread; the metrics may be read from any thread.
+    """
+    
+    default_coalesce_size = 4096
+    
+    def __init__(self, fd, item_size=1, coalesce_size=default_coalesce_size, max_buffer_size=1 << 20, clock=time.time):
+        """fd is owned by the PipeWriter and will be made non-blocking."""
+        self.__fd = fd
+        self.__item_size = item_size
+        self.__coalesce_size = coalesce_size
+        self.__max_buffer_size = max_buffer_size
+        self.__clock = clock
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        
+        self.__pending = bytearray()
+        self.__closed = False
+        
+        # metrics
+        self.__written_bytes = 0
+        self.__blocked_time = 0.0
+        self.__blocked_since = None
+        self.__overrun_count = 0
+        self.__dropped_bytes = 0
+        self.__throughput_calculator = LazyRateCalculator(lambda: self.__written_bytes)
+    
+    def __del__(self):
+        self.close()
+    
+    def close(self):
+        if not self.__closed:
+            self.__closed = True
+            os.close(self.__fd)
+    
+    def write(self, data):
+        """Write data (a str or other buffer, such as a numpy array) to the pipe, or queue it."""
+        if self.__closed:
+            return
+        data = buffer(data)
+        pending = self.__pending
+        if not pending and len(data) >= self.__coalesce_size:
+            # fast path: no copy unless the pipe does not take all of it
+            data = data[self.__write_some(data):]
+            if data:
+                self.__note_blocked()
+        pending += data
+        if len(pending) >= self.__coalesce_size:
+            self.flush()
+        excess = len(pending) - self.__max_buffer_size
+        if excess > 0:
+            self.__drop(excess)
+    
+    def flush(self):
+        """Write as much queued data as the pipe will accept."""
+        pending = self.__pending
+        if self.__closed or not pending:
+            return
+        del pending[:self.__write_some(buffer(pending))]
+        if pending:
+            self.__note_blocked()
+        elif self.__blocked_since is not None:
+            self.__blocked_time += self.__clock() - self.__blocked_since
+            self.__blocked_since = None
+    
+    def __write_some(self, data):
+        try:
+            count = os.write(self.__fd, data)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return 0
+            elif e.errno == errno.EPIPE:
+                # Nothing will ever read it; the pool has shut the process down.
+                self.__dropped_bytes += len(data)
+                return len(data)
+            else:
+                raise
+        self.__written_bytes += count
+        return count
+    
+    def __note_blocked(self):
+        if self.__blocked_since is None:
+            self.__blocked_since = self.__clock()
+    
+    def __drop(self, excess):
+        # Keep the remainder of any item which has been partly written, and drop whole items after it, so the reader stays aligned.
+        partial = -self.__written_bytes % self.__item_size
+        count = -(-excess // self.__item_size) * self.__item_size
+        del self.__pending[partial:partial + count]
+        self.__overrun_count += 1
+        self.__dropped_bytes += count
+    
+    @exported_value(type=float)
+    def get_throughput(self):
+        """Bytes per second written to the pipe."""
+        return self.__throughput_calculator.get()
+    
+    @exported_value(type=float)
+    def get_blocked_time(self):
+        """Total seconds during which the pipe was full and data had to be queued."""
+        blocked_time = self.__blocked_time
+        blocked_since = self.__blocked_since
+        if blocked_since is not None:
+            blocked_time += self.__clock() - blocked_since
+        return blocked_time
+    
+    @exported_value(type=int)
+    def get_overrun_count(self):
+        return self.__overrun_count
+    
+    @exported_value(type=int)
+    def get_dropped_bytes(self):
+        return self.__dropped_bytes
+    
+    @exported_value(type=float)
+    def get_buffer_fill(self):
+        """Fraction of the queue (not the pipe itself) in use."""
+        return len(self.__pending) / self.__max_buffer_size
+    
+    @exported_value(type=int)
+    def get_pipe_size(self):
+        if self.__closed:
+            return 0
+        return _get_pipe_size(self.__fd)
+
+
+__all__.append('PipeWriter')
+
+
+class PipeSink(gr.sync_block):
+    """GNU Radio sink block which writes its input to a PipeWriter."""
+    
+    def __init__(self, writer, dtype):
+        gr.sync_block.__init__(
+            self,
+            name=type(self).__name__,
+            in_sig=[dtype],
+            out_sig=None)
+        self.__writer = writer
+    
+    def get_writer(self):
+        return self.__writer
+    
+    def work(self, input_items, output_items):
+        items = input_items[0]
+        self.__writer.write(items)
+        return len(items)
+
+
+__all__.append('PipeSink')
+
+
+class DecoderProcessLease(object):
+    """
+    Exclusive use of a process from a DecoderProcessPool.
+    
+    The lease should be released by calling release() when the process is no longer needed (e.g. from the close() of the demodulator using it). As a safety net, it is also released when the object passed to release_when_collected is garbage collected.
+    """
+    
+    def __init__(self, pool, process, protocol):
+        self.__pool = pool
+        self.__process = process
+        self.__released = False
+        self.__owner_ref = None
+        process.attach(protocol)
+    
+    def get_write_fd(self):
+        """Return a new file descriptor for the process's input pipe. The caller is responsible for closing it."""
+        return os.dup(self.__process.write_fd)
+    
+    def make_sink(self, dtype, coalesce_size=PipeWriter.default_coalesce_size):
+        """Return a PipeSink block which writes items of the given numpy dtype to the process's input pipe."""
+        return PipeSink(PipeWriter(self.get_write_fd(), item_size=numpy.dtype(dtype).itemsize, coalesce_size=coalesce_size), dtype)
+    
+    def release(self):
+        if self.__released:
+            return
+        self.__released = True
+        self.__process.detach()
+        self.__pool._release(self.__process, self.__owner_ref)
+    
+    def release_when_collected(self, owner):
+        """Release this lease, if it has not been already, when owner (typically the block which made the sink) is garbage collected."""
+        self.__owner_ref = self.__pool._release_when_collected(self, owner)
+
+
+__all__.append('DecoderProcessLease')
+
+
+class _DecoderProcess(ProcessProtocol):
+    # A process which has run for this long is considered to have started successfully.
+    _healthy_run_time = 10
+    
+    def __init__(self, pool, key, pipe_size):
+        self.__pool = pool
+        self.key = key
+        self.read_fd, self.write_fd = os.pipe()
+        _set_pipe_size(self.write_fd, pipe_size)
+        self.consecutive_failures = 0
+        self.__transport = None
+        self.__target = None
+        self.__stopping = False
+        self.__expiry = None
+        self.__respawn = None
+        self.__spawn_time = None
+        self.__died_time = None
+    
+    def spawn(self):
+        self.__spawn_time = time.time()
+        self.__transport = self.__pool._spawn(self, self.key, self.read_fd)
+    
+    def respawn(self):
+        self.__respawn = None
+        self.spawn()
+        self.__pool._note_respawned(time.time() - self.__died_time)
+    
+    def is_running(self):
+        return not self.__stopping
+    
+    def attach(self, protocol):
+        if self.__expiry is not None and self.__expiry.active():
+            self.__expiry.cancel()
+        self.__expiry = None
+        self.__target = protocol
+    
+    def detach(self):
+        self.__target = None
+    
+    def schedule_expiry(self, delayed_call):
+        self.__expiry = delayed_call
+    
+    def schedule_respawn(self, delayed_call):
+        self.__respawn = delayed_call
+    
+    def stop(self):
+        if self.__stopping:
+            return
+        self.__stopping = True
+        self.__target = None
+        if self.__expiry is not None and self.__expiry.active():
+            self.__expiry.cancel()
+        if self.__respawn is not None:
+            self.__respawn.cancel()
+            self.__respawn = None
+        # Closing our ends of the pipe lets the process see EOF once any sinks still writing to it are gone, and makes such sinks fail rather than block.
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        if self.__transport is not None:
+            try:
+                self.__transport.signalProcess('TERM')
+            except ProcessExitedAlready:
+                pass
+        else:
+            # between an exit and a respawn; processEnded will not be called again
+            self.__pool._forget(self)
+    
+    def outReceived(self, data):
+        """Implements ProcessProtocol."""
+        if self.__target is not None:
+            self.__target.outReceived(data)
+    
+    def errReceived(self, data):
+        """Implements ProcessProtocol."""
+        # we should inherit stderr, not pipe it
+        raise Exception('shouldn\'t happen')
+    
+    def processEnded(self, reason):
+        """Implements ProcessProtocol."""
+        self.__transport = None
+        now = time.time()
+        if now - self.__spawn_time >= self._healthy_run_time:
+            self.consecutive_failures = 0
+        self.consecutive_failures += 1
+        self.__died_time = now
+        self.__pool._process_died(self, expected=self.__stopping)
+
+
+# Linux-specific fcntl commands, not provided by the fcntl module.
+_F_SETPIPE_SZ = 1031
+_F_GETPIPE_SZ = 1032
+
+
+def _set_pipe_size(fd, size):
+    """Enlarge the pipe's kernel buffer, if possible, so that bursts of samples are absorbed without the writer having to queue them."""
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        fcntl.fcntl(fd, _F_SETPIPE_SZ, size)
+    except IOError as e:
+        # EPERM if above /proc/sys/fs/pipe-max-size for an unprivileged process
+        log.msg('Could not set decoder pipe size to %i bytes: %s' % (size, e))
+
+
+def _get_pipe_size(fd):
+    if not sys.platform.startswith('linux'):
+        return 0
+    try:
+        return fcntl.fcntl(fd, _F_GETPIPE_SZ)
+    except IOError:
+        return 0
+
+
+the_decoder_process_pool = DecoderProcessPool()
+
+
+__all__.append('the_decoder_process_pool')
@@ -0,0 +1,290 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lightweight latency measurement and sampling profiling of the Python side of ShinySDR.
+
+Latency histograms are cheap enough (two clock reads and a few arithmetic operations per call) to be always enabled; functions on hot paths are wrapped with the timed() decorator, and the histograms are reported by shinysdr.diagnostics and the web server's metrics resource.
+"""
+
+from __future__ import absolute_import, division
+
+from collections import Counter
+import functools
+import sys
+import thread
+import threading
+import time
+
+
+__all__ = []  # appended later
+
+
+_clock = time.time
+_bucket_count = 32  # bucket i counts durations of less than 2**i microseconds, so the last is over half an hour
+
+
+class LatencyHistogram(object):
+    """
+    Counts durations in logarithmic buckets, a factor of 2 apart, from which percentiles can be estimated to within that factor.
+    
+    count, total, max, and cumulative_buckets() cover everything ever recorded, as Prometheus expects of a histogram. percentile() and recent_max() cover only the recent window: the current interval and the one before it, i.e. the last interval to 2 * interval seconds, so that they show a stutter that is happening now rather than being diluted by the whole uptime.
+    """
+    
+    def __init__(self, interval=60.0, clock=None):
+        self.__interval = interval
+        self.__clock = clock or _clock
+        self.__buckets = [0] * _bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # recent window
+        self.__current = [0] * _bucket_count
+        self.__current_max = 0.0
+        self.__previous = [0] * _bucket_count
+        self.__previous_max = 0.0
+        self.__interval_end = self.__clock() + interval
+    
+    def record(self, seconds, now=None):
+        """Record a duration. now, if given, is the current time, to save reading the clock again."""
+        if now is None:
+            now = self.__clock()
+        if now >= self.__interval_end:
+            self.__rotate(now)
+        microseconds = int(seconds * 1e6)
+        index = min(microseconds.bit_length() if microseconds > 0 else 0, _bucket_count - 1)
+        self.__buckets[index] += 1
+        self.__current[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds > self.__current_max:
+            self.__current_max = seconds
+    
+    def __rotate(self, now):
+        if now >= self.__interval_end + self.__interval:
+            # nothing was recorded in the whole of the last interval
+            self.__previous = [0] * _bucket_count
+            self.__previous_max = 0.0
+        else:
+            self.__previous = self.__current
+            self.__previous_max = self.__current_max
+        self.__current = [0] * _bucket_count
+        self.__current_max = 0.0
+        self.__interval_end = now + self.__interval
+    
+    def __recent(self):
+        now = self.__clock()
+        if now >= self.__interval_end:
+            self.__rotate(now)
+        return [a + b for a, b in zip(self.__previous, self.__current)], max(self.__previous_max, self.__current_max)
+    
+    def recent_max(self):
+        """Return the longest duration, in seconds, in the recent window."""
+        return self.__recent()[1]
+    
+    def percentile(self, fraction):
+        """Return an upper bound, in seconds, on the given fraction (0 to 1) of the durations recorded in the recent window."""
+        buckets, recent_max = self.__recent()
+        count = sum(buckets)
+        if count == 0:
+            return 0.0
+        threshold = fraction * count
+        running = 0
+        for index, bucket_count in enumerate(buckets):
+            running += bucket_count
+            if running >= threshold:
+                if index == _bucket_count - 1:
+                    # overflow bucket has no upper bound
+                    return recent_max
+                return min((1 << index) / 1e6, recent_max)
+        return recent_max
+    
+    def cumulative_buckets(self):
+        """Return a list of (upper bound in seconds, number of durations recorded at most that long), in increasing order, ending with an upper bound of infinity; the form of a Prometheus histogram."""
+        result = []
+        running = 0
+        for index, bucket_count in enumerate(self.__buckets):
+            running += bucket_count
+            result.append((float('inf') if index == _bucket_count - 1 else (1 << index) / 1e6, running))
+        return result
+
+
+__all__.append('LatencyHistogram')
+
+
+_histograms = {}
+
+
+def get_histogram(name):
+    """Return the histogram with the given name, creating it if necessary."""
+    if name not in _histograms:
+        _histograms[name] = LatencyHistogram()
+    return _histograms[name]
+
+
+__all__.append('get_histogram')
+
+
+def get_histograms():
+    """Return a dict of all histograms by name."""
+    return dict(_histograms)
+
+
+__all__.append('get_histograms')
+
+
+def timed(name):
+    """Decorator which records the duration of each call of the function in the named histogram."""
+    histogram = get_histogram(name)
+    
+    def decorator(f):
+        @functools.wraps(f)
+        def timed_wrapper(*args, **kwargs):
+            start = _clock()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                end = _clock()
+                histogram.record(end - start, end)
+        return timed_wrapper
+    return decorator
+
+
+__all__.append('timed')
+
+
+def latency_metric_rows(labels=None):
+    """
+    Return the histograms in the row format of shinysdr.diagnostics.format_metrics.
+    
+    shinysdr_latency_seconds is a Prometheus histogram (cumulative, so rates and quantiles over any range can be computed from it); shinysdr_latency_recent_seconds and shinysdr_latency_recent_max_seconds are precomputed over the histograms' recent windows, for those reading the metrics directly.
+    """
+    labels = labels or {}
+    rows = []
+    for name, histogram in sorted(_histograms.iteritems()):
+        name_labels = dict(labels, name=name)
+        for upper_bound, cumulative_count in histogram.cumulative_buckets():
+            le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+            rows.append(('shinysdr_latency_seconds_bucket', dict(name_labels, le=le), cumulative_count))
+        rows.append(('shinysdr_latency_seconds_count', name_labels, histogram.count))
+        rows.append(('shinysdr_latency_seconds_sum', name_labels, histogram.total))
+        for quantile in (0.5, 0.99):
+            rows.append(('shinysdr_latency_recent_seconds', dict(name_labels, quantile=quantile), histogram.percentile(quantile)))
+        rows.append(('shinysdr_latency_recent_max_seconds', name_labels, histogram.recent_max()))
+    return rows
+
+
+__all__.append('latency_metric_rows')
+
+
+latency_metric_families = {
+    'shinysdr_latency_seconds': ('histogram', 'Durations of timed operations since startup.'),
+    'shinysdr_latency_recent_seconds': ('gauge', 'Quantiles of durations of timed operations over the recent window.'),
+    'shinysdr_latency_recent_max_seconds': ('gauge', 'Longest duration of timed operations over the recent window.'),
+}
+
+
+__all__.append('latency_metric_families')
+
+
+class LoopLagProbe(object):
+    """
+    Measures how late the reactor runs a timed call, which is how long anything else running in the reactor thread can delay the UI; recorded in the histogram 'reactor_lag'.
+    """
+    
+    def __init__(self, reactor, interval=0.05):
+        self.__reactor = reactor
+        self.__interval = interval
+        self.__histogram = get_histogram('reactor_lag')
+        self.__expected = None
+        self.__call = None
+    
+    def start(self):
+        self.__schedule()
+    
+    def stop(self):
+        if self.__call is not None and self.__call.active():
+            self.__call.cancel()
+        self.__call = None
+    
+    def __schedule(self):
+        self.__expected = self.__reactor.seconds() + self.__interval
+        self.__call = self.__reactor.callLater(self.__interval, self.__tick)
+    
+    def __tick(self):
+        self.__histogram.record(max(0.0, self.__reactor.seconds() - self.__expected))
+        self.__schedule()
+
+
+__all__.append('LoopLagProbe')
+
+
+# created now so that it is listed before the probe is started
+get_histogram('reactor_lag')
+
+
+def sample_stacks(duration, interval=0.005, max_depth=40):
+    """
+    Record the Python stacks of all other threads every interval seconds for duration seconds, and return a Counter of (thread name, stack) where stack is a tuple of (filename, line number, function name), outermost first.
+    
+    This blocks for the duration, so it should be run in a thread other than the reactor's.
+    """
+    own_ident = thread.get_ident()
+    thread_names = {t.ident: t.name for t in threading.enumerate()}
+    counts = Counter()
+    end_time = _clock() + duration
+    while _clock() < end_time:
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < max_depth:
+                code = frame.f_code
+                stack.append((code.co_filename, frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            counts[(thread_names.get(ident, str(ident)), tuple(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+__all__.append('sample_stacks')
+
+
+def format_stacks(counts, limit=20):
+    """Format the result of sample_stacks as text: the functions most often executing, then the most common stacks."""
+    total = sum(counts.itervalues())
+    if total == 0:
+        return 'No samples.\n'
+    lines = ['%i samples\n' % (total,), '\nMost frequent innermost functions:\n']
+    innermost = Counter()
+    for (thread_name, stack), count in counts.iteritems():
+        if stack:
+            innermost[(thread_name,) + stack[-1]] += count
+    for (thread_name, filename, lineno, function), count in innermost.most_common(limit):
+        lines.append('%6.1f%%  %s  %s (%s:%i)\n' % (100 * count / total, thread_name, function, filename, lineno))
+    lines.append('\nMost frequent stacks:\n')
+    for (thread_name, stack), count in counts.most_common(limit):
+        lines.append('\n%6.1f%%  thread %s\n' % (100 * count / total, thread_name))
+        for filename, lineno, function in stack:
+            lines.append('    %s (%s:%i)\n' % (function, filename, lineno))
+    return ''.join(lines)
+
+
+__all__.append('format_stacks')
@@ -22,6 +22,7 @@
 
 from __future__ import absolute_import, division
 
+from collections import OrderedDict
 import time
 
 from twisted.python import log
@@ -33,10 +34,10 @@ from gnuradio import blocks
 
 from shinysdr.blocks import rotator_inc
 from shinysdr.math import dB, todB
-from shinysdr.modes import ITunableDemodulator, get_modes, lookup_mode
+from shinysdr.modes import ITunableDemodulator, close_demodulator, get_modes, lookup_mode
 from shinysdr.signals import SignalType
 from shinysdr.types import Enum, Range
-from shinysdr.values import ExportedState, exported_block, exported_value, setter, unserialize_exported_state
+from shinysdr.values import ExportedState, LooseCell, exported_block, exported_value, setter, unserialize_exported_state
 
 
 # arbitrary non-infinite limit
@@ -47,6 +48,10 @@ _audio_power_minimum_amplitude = dB(_audio_power_minimum_dB)
 _dummy_audio_rate = 2000
 
 
+# Each pooled demodulator keeps its filter taps and buffers allocated, so this is kept small.
+_demodulator_pool_size = 3
+
+
 class IReceiver(Interface):
     """
     Marker interface for receivers.
@@ -67,6 +72,8 @@ class Receiver(gr.hier_block2, ExportedState):
             audio_gain=-6,
             audio_pan=0,
             audio_channels=0,
+            always_on=False,
+            demodulator_pool=False,
             context=None):
         assert audio_channels == 1 or audio_channels == 2
         assert audio_destination is not None
@@ -95,6 +102,12 @@ class Receiver(gr.hier_block2, ExportedState):
         self.audio_gain = audio_gain
         self.audio_pan = min(1, max(-1, audio_pan))
         self.__audio_destination = audio_destination
+        self.__always_on = bool(always_on)
+        
+        # Demand: whether anything other than audio output wants this receiver to be running. Audio demand is determined by the top block.
+        self.__state_subscription_count = 0
+        self.__demod_unattended = False  # set by __update_demodulator_info
+        self.__interested_cell = LooseCell(key='interested', type=bool, value=self.__always_on, writable=False, persists=False)
         
         # Receive frequency.
         self.__freq_linked_to_device = bool(freq_linked_to_device)
@@ -107,8 +120,11 @@ class Receiver(gr.hier_block2, ExportedState):
         
         # Blocks
         self.__rotator = blocks.rotator_cc()
+        self.__demodulator_pool = DemodulatorPool(_demodulator_pool_size if demodulator_pool else 0)
+        self.__demodulator_facet = None
         self.__demodulator = self.__make_demodulator(mode, {})
         self.__update_demodulator_info()
+        self.__update_interested()
         self.__audio_gain_blocks = [blocks.multiply_const_ff(0.0) for _ in xrange(self.__audio_channels)]
         self.probe_audio = analog.probe_avg_mag_sqrd_f(0, alpha=10.0 / 44100)  # TODO adapt to output audio rate
         
@@ -127,6 +143,9 @@ class Receiver(gr.hier_block2, ExportedState):
         assert output_type.get_kind() == 'STEREO' or output_type.get_kind() == 'MONO' or output_type.get_kind() == 'NONE'
         self.__demod_output = output_type.get_kind() != 'NONE'
         self.__demod_stereo = output_type.get_kind() == 'STEREO'
+        # A demodulator with no audio output (e.g. rtl_433), or whose mode is for telemetry (e.g. APRS), is only useful if it runs whether or not anyone is listening or watching.
+        mode_def = lookup_mode(self.mode)
+        self.__demod_unattended = not self.__demod_output or (mode_def is not None and mode_def.telemetry)
         self.__output_type = SignalType(
             kind='STEREO',
             sample_rate=output_type.get_sample_rate() if self.__demod_output else 0)
@@ -277,6 +296,30 @@ class Receiver(gr.hier_block2, ExportedState):
             self.__audio_destination = value
             self.context.changed_needed_connections(u'changed destination')
     
+    @exported_value(type=bool, parameter='always_on')
+    def get_always_on(self):
+        """Whether the receiver runs even if no one is listening to or watching it. Receivers in telemetry modes, or with no audio output, always do."""
+        return self.__always_on
+    
+    @setter
+    def set_always_on(self, value):
+        self.__always_on = bool(value)
+        self.__update_interested()
+    
+    # non-exported
+    def get_interested_cell(self):
+        return self.__interested_cell
+    
+    def state_subscription_count_changed(self, count):
+        """Overrides ExportedState."""
+        self.__state_subscription_count = count
+        self.__update_interested()
+    
+    def __update_interested(self):
+        interested = self.__always_on or self.__demod_unattended or self.__state_subscription_count > 0
+        if interested != self.__interested_cell.get():
+            self.__interested_cell.set_internal(interested)
+    
     @exported_value(type=bool)
     def get_is_valid(self):
         if self.__demodulator is None:
@@ -309,24 +352,64 @@ class Receiver(gr.hier_block2, ExportedState):
     def __get_device(self):
         return self.context.get_device(self.__device_name)
     
+    def __get_input_rate(self):
+        return self.__get_device().get_rx_driver().get_output_type().get_sample_rate()
+    
+    def close(self):
+        """Close the demodulator and any kept for reuse. For use by the owner after this receiver has been disconnected."""
+        self.__demodulator_pool.clear()
+        if self.__demodulator is not None:
+            close_demodulator(self.__demodulator)
+            self.__demodulator = None
+    
     # called from facet
-    def _rebuild_demodulator(self, mode=None, reason='<unspecified>'):
-        self.__rebuild_demodulator_nodirty(mode)
+    def _rebuild_demodulator(self, mode=None, reason='<unspecified>', reuse=True):
+        old_demodulator = self.__demodulator
+        self.__rebuild_demodulator_nodirty(mode, reuse=reuse)
         self.__do_connect(reason=u'demodulator rebuilt: %s' % (reason,))
+        if (old_demodulator is not None and
+                old_demodulator is not self.__demodulator and
+                not self.__demodulator_pool.holds(old_demodulator)):
+            # now disconnected and not kept for reuse
+            close_demodulator(old_demodulator)
         # TODO write a test for this!
         #self.context.revalidaate(tuning=False)  # in case our bandwidth changed
+    
+    # called from facet
+    def _demodulator_wants_rebuild(self, facet):
+        if facet is self.__demodulator_facet:
+            # The current demodulator's configuration is stale, so it must not be kept for reuse.
+            self._rebuild_demodulator(reason=u'rebuild_me', reuse=False)
+        else:
+            # A pooled demodulator asked; it will simply not be reused.
+            self.__demodulator_pool.discard(facet)
 
-    def __rebuild_demodulator_nodirty(self, mode=None):
+    def __rebuild_demodulator_nodirty(self, mode=None, reuse=True):
         if self.__demodulator is None:
             defaults = {}
         else:
             defaults = self.__demodulator.state_to_json()
         if mode is None:
             mode = self.mode
-        self.__demodulator = self.__make_demodulator(mode, defaults)
+        if reuse and self.__demodulator is not None:
+            # Keep the old demodulator (which the caller will disconnect) so that switching back to it is cheap.
+            self.__demodulator_pool.put(
+                (self.mode, self.__demodulator_input_rate),
+                self.__demodulator,
+                self.__demodulator_facet)
+        input_rate = self.__get_input_rate()
+        pooled = self.__demodulator_pool.take((mode, input_rate)) if reuse else None
+        if pooled is not None:
+            # The reused demodulator keeps the settings it had when last used in this mode rather than taking on the current one's.
+            self.__demodulator, self.__demodulator_facet = pooled
+            self.__demodulator_input_rate = input_rate
+            log.msg('Reused %s demodulator.' % (mode,))
+        else:
+            self.__demodulator = self.__make_demodulator(mode, defaults)
+        self.mode = mode
         self.__update_demodulator_info()
         self.__update_rotator()
-        self.mode = mode
+        self.__update_interested()
         
         # Replace blocks downstream of the demodulator so as to flush samples that are potentially at a different sample rate and would therefore be audibly wrong. Caller will handle reconnection.
         self.__audio_gain_blocks = [blocks.multiply_const_ff(0.0) for _ in xrange(self.__audio_channels)]
@@ -347,10 +430,11 @@ class Receiver(gr.hier_block2, ExportedState):
         if 'mode' in state: del state['mode']  # don't switch back to the mode we just switched from
         
         facet = ContextForDemodulator(self)
+        input_rate = self.__get_input_rate()
         
         init_kwargs = dict(
             mode=mode,
-            input_rate=self.__get_device().get_rx_driver().get_output_type().get_sample_rate(),
+            input_rate=input_rate,
             context=facet)
         demodulator = unserialize_exported_state(
             ctor=clas,
@@ -359,6 +443,8 @@ class Receiver(gr.hier_block2, ExportedState):
         
         # until _enabled, ignore any callbacks resulting from unserialization calling setters
         facet._enabled = True
+        self.__demodulator_facet = facet
+        self.__demodulator_input_rate = input_rate
         log.msg('Constructed %s demodulator: %i ms.' % (mode, (time.time() - t0) * 1000))
         return demodulator
 
@@ -373,6 +459,45 @@ class Receiver(gr.hier_block2, ExportedState):
             self.__audio_gain_blocks[0].set_k(gain_lin)
 
 
+class DemodulatorPool(object):
+    """
+    Keeps recently used demodulators, which are not connected to anything, so that switching back to a mode is a reconnect rather than a construction.
+    
+    Entries are keyed by (mode, input rate) and the least recently used are dropped beyond max_size. GNU Radio gives us no way to ask how much memory a block holds, so the number of entries is what bounds memory use.
+    
+    Demodulators which have a close() method (see close_demodulator) hold more than memory, such as decoder processes or threads, which should not be kept while unused; the pool declines them, leaving them to the caller, as it does everything when max_size is 0.
+    """
+    def __init__(self, max_size):
+        self.__max_size = max(0, int(max_size))
+        self.__entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self.__entries)
+    
+    def put(self, key, demodulator, facet):
+        self.__entries.pop(key, None)
+        if self.__max_size <= 0 or hasattr(demodulator, 'close'):
+            return
+        self.__entries[key] = (demodulator, facet)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+    
+    def holds(self, demodulator):
+        return any(entry_demodulator is demodulator for entry_demodulator, _ in self.__entries.itervalues())
+    
+    def take(self, key):
+        """Remove and return the (demodulator, facet) pair for key, or None."""
+        return self.__entries.pop(key, None)
+    
+    def discard(self, facet):
+        for key, (_, entry_facet) in self.__entries.items():
+            if entry_facet is facet:
+                del self.__entries[key]
+    
+    def clear(self):
+        self.__entries.clear()
+
+
 class ContextForDemodulator(object):
     def __init__(self, receiver):
         self._receiver = receiver
@@ -380,7 +505,7 @@ class ContextForDemodulator(object):
     
     def rebuild_me(self):
         assert self._enabled
-        self._receiver._rebuild_demodulator(reason=u'rebuild_me')
+        self._receiver._demodulator_wants_rebuild(self)
 
     def lock(self):
         self._receiver.context.lock()
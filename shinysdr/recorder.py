@@ -0,0 +1,374 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Recording of a device's IQ samples to disk, as SigMF-style data and metadata files.
+"""
+
+from __future__ import absolute_import, division
+
+from collections import deque
+import datetime
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+
+from twisted.internet import reactor as the_reactor
+from twisted.python import log
+
+from gnuradio import blocks
+from gnuradio import gr
+
+from shinysdr.types import Range
+from shinysdr.values import ExportedState, exported_value, setter
+
+
+__all__ = []  # appended later
+
+
+_queue_limit = 1000  # messages; each is one work call's worth of samples
+_datatype = 'cf32_le' if sys.byteorder == 'little' else 'cf32_be'
+
+
+class BufferedFileWriter(object):
+    """
+    Writes a file with os.write, collecting data until buffer_size bytes are pending so that each system call writes a large block.
+    
+    A full disk is reported as an OSError (ENOSPC) from write() or close(); the data which was pending is then discarded. (Writing through a memory mapping instead would be cheaper per byte, but a full disk then kills the process with SIGBUS.)
+    """
+    
+    def __init__(self, path, buffer_size=1 << 22):
+        self.__fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.__buffer_size = buffer_size
+        self.__pending = []
+        self.__pending_size = 0
+        self.__length = 0
+    
+    def tell(self):
+        """Return the number of bytes written, including those still pending."""
+        return self.__length
+    
+    def write(self, data):
+        if not isinstance(data, str):
+            data = buffer(data)[:]
+        self.__pending.append(data)
+        self.__pending_size += len(data)
+        self.__length += len(data)
+        if self.__pending_size >= self.__buffer_size:
+            self.flush()
+    
+    def flush(self):
+        data = ''.join(self.__pending)
+        self.__pending = []
+        self.__pending_size = 0
+        offset = 0
+        while offset < len(data):
+            offset += os.write(self.__fd, buffer(data, offset))
+    
+    def close(self):
+        if self.__fd is None:
+            return
+        try:
+            self.flush()
+        finally:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+__all__.append('BufferedFileWriter')
+
+
+class RecordingFiles(object):
+    """
+    Writes samples into a series of data files, each with a SigMF metadata file, starting a new pair when the current one reaches max_bytes or max_seconds (0 for no limit).
+    
+    Not thread-safe; IQRecorder uses it from its writer thread only.
+    """
+    
+    def __init__(self, directory, name, sample_rate, frequency, metadata, max_bytes=0, max_seconds=0, clock=time.time):
+        self.__directory = directory
+        self.__name = name
+        self.__sample_rate = sample_rate
+        self.__frequency = frequency
+        self.__metadata = metadata
+        self.__max_bytes = max_bytes
+        self.__max_seconds = max_seconds
+        self.__clock = clock
+        
+        self.__writer = None
+        self.__base_path = None
+        self.__start_time = None
+        self.__captures = None
+        self.paths = []  # of data files, including the current one
+        self.total_bytes = 0
+    
+    def write(self, data):
+        if self.__writer is None:
+            self.__open()
+        elif self.__should_rotate():
+            self.__close_file()
+            self.__open()
+        self.__writer.write(data)
+        self.total_bytes += len(data)
+    
+    def retune(self, frequency, timestamp=None):
+        """Note that samples written after this point were received at a different center frequency, since timestamp (default now)."""
+        self.__frequency = frequency
+        if self.__writer is not None:
+            self.__captures.append(self.__capture(timestamp))
+    
+    def close(self):
+        if self.__writer is not None:
+            self.__close_file()
+    
+    def __should_rotate(self):
+        if self.__max_bytes and self.__writer.tell() >= self.__max_bytes:
+            return True
+        if self.__max_seconds and self.__clock() - self.__start_time >= self.__max_seconds:
+            return True
+        return False
+    
+    def __open(self):
+        self.__start_time = self.__clock()
+        stamp = datetime.datetime.utcfromtimestamp(self.__start_time).strftime('%Y%m%dT%H%M%S.%fZ')
+        self.__base_path = os.path.join(self.__directory, '%s-%s' % (self.__name, stamp))
+        self.__writer = BufferedFileWriter(self.__base_path + '.sigmf-data')
+        self.__captures = [self.__capture()]
+        self.paths.append(self.__base_path + '.sigmf-data')
+        # Written now as well as at the end, so that an interrupted recording still has its metadata.
+        self.__write_metadata()
+    
+    def __close_file(self):
+        writer = self.__writer
+        self.__writer = None
+        try:
+            writer.close()
+        finally:
+            self.__write_metadata()
+    
+    def __capture(self, timestamp=None):
+        if timestamp is None:
+            timestamp = self.__clock()
+        return {
+            'core:sample_start': self.__writer.tell() // 8 if self.__writer is not None else 0,
+            'core:frequency': self.__frequency,
+            'core:datetime': datetime.datetime.utcfromtimestamp(timestamp).isoformat() + 'Z',
+        }
+    
+    def __write_metadata(self):
+        global_info = {
+            'core:datatype': _datatype,
+            'core:sample_rate': self.__sample_rate,
+            'core:version': '0.0.1',
+            'core:recorder': 'ShinySDR',
+        }
+        global_info.update(self.__metadata)
+        with open(self.__base_path + '.sigmf-meta', 'w') as f:
+            json.dump({
+                'global': global_info,
+                'captures': self.__captures,
+                'annotations': [],
+            }, f, indent=2, sort_keys=True)
+
+
+__all__.append('RecordingFiles')
+
+
+class IQRecorder(gr.hier_block2, ExportedState):
+    """
+    Records the output of a device's RX driver to files in a directory.
+    
+    Samples pass from the flow graph through a message queue which drops them if it is full, and are written to disk by a separate thread, so a slow disk loses samples rather than stalling the flow graph. If writing fails (e.g. the disk is full), the recording stops.
+    
+    changed is called when recording starts or stops, and the caller must then connect or disconnect this block.
+    """
+    
+    def __init__(self, device, device_key, directory, changed, reactor=the_reactor):
+        gr.hier_block2.__init__(
+            self, type(self).__name__,
+            gr.io_signature(1, 1, gr.sizeof_gr_complex),
+            gr.io_signature(0, 0, 0))
+        self.__device = device
+        self.__device_key = device_key
+        self.__directory = directory
+        self.__changed = changed
+        self.__reactor = reactor
+        
+        self.__queue = None
+        self.__make_queue()
+        
+        self.__recording = False
+        self.__max_megabytes = 0.0
+        self.__max_minutes = 0.0
+        self.__files = None
+        self.__writer = None
+        
+        self.__vfo_subscription = device.get_vfo_cell().subscribe(self.__vfo_changed)
+    
+    @exported_value(type=bool, persists=False)
+    def get_recording(self):
+        return self.__recording
+    
+    @setter
+    def set_recording(self, value):
+        value = bool(value)
+        if value == self.__recording:
+            return
+        if value:
+            self.__start()
+        else:
+            self.__writer.stop()
+        self.__recording = value
+        self.__changed()
+    
+    @exported_value(type=Range([(0, 1e6)], strict=False))
+    def get_max_megabytes(self):
+        """Size at which to start a new file; 0 for no limit."""
+        return self.__max_megabytes
+    
+    @setter
+    def set_max_megabytes(self, value):
+        self.__max_megabytes = float(value)
+    
+    @exported_value(type=Range([(0, 1440)], strict=False))
+    def get_max_minutes(self):
+        """Duration after which to start a new file; 0 for no limit."""
+        return self.__max_minutes
+    
+    @setter
+    def set_max_minutes(self, value):
+        self.__max_minutes = float(value)
+    
+    @exported_value(type=unicode)
+    def get_current_file(self):
+        files = self.__files
+        if files is None or not files.paths:
+            return u''
+        return unicode(files.paths[-1])
+    
+    @exported_value(type=float)
+    def get_megabytes_written(self):
+        files = self.__files
+        return files.total_bytes / 1e6 if files is not None else 0.0
+    
+    def __make_queue(self):
+        """Replace the queue and the sink feeding it. Must only be called while this block is disconnected."""
+        self.__queue = gr.msg_queue(limit=_queue_limit)
+        self.disconnect_all()
+        self.connect(self, blocks.message_sink(gr.sizeof_gr_complex, self.__queue, True))
+    
+    def __start(self):
+        rx_driver = self.__device.get_rx_driver()
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+        
+        metadata = {'core:hw': self.__device.get_name() or self.__device_key}
+        driver_state = rx_driver.state()
+        if 'gain' in driver_state:
+            metadata['shinysdr:gain'] = driver_state['gain'].get()
+        
+        # The previous recording's thread may still be finishing (it may not even have woken up to see that it was stopped yet), so it keeps its own objects, including its queue. This block is disconnected while not recording, so the sink can be replaced here.
+        self.__make_queue()
+        files = self.__files = RecordingFiles(
+            directory=self.__directory,
+            name=self.__device_key,
+            sample_rate=rx_driver.get_output_type().get_sample_rate(),
+            frequency=self.__device.get_freq(),
+            metadata=metadata,
+            max_bytes=int(self.__max_megabytes * 1e6),
+            max_seconds=self.__max_minutes * 60)
+        
+        def failed():
+            self.__reactor.callFromThread(self.__write_failed, files)
+        
+        self.__writer = _WriterThread(self.__queue, files, failed)
+    
+    def __write_failed(self, files):
+        if files is self.__files and self.__recording:
+            self.set_recording(False)
+    
+    def __vfo_changed(self, frequency):
+        if self.__recording:
+            self.__writer.retune(frequency, time.time())
+    
+    def close(self):
+        self.set_recording(False)
+        self.__vfo_subscription.unsubscribe()
+
+
+__all__.append('IQRecorder')
+
+
+class _WriterThread(object):
+    """
+    Takes sample messages from the queue and writes them to the RecordingFiles, in a thread of its own, until stopped or writing fails.
+    
+    The methods other than __run are called from the reactor thread.
+    """
+    
+    def __init__(self, queue, files, failed):
+        self.__queue = queue
+        self.__files = files
+        self.__failed = failed
+        
+        self.__stopped = False
+        self.__retunes = deque()  # of (message count, frequency, timestamp)
+        self.__taken = 0  # messages taken from the queue; written by the writer thread only
+        
+        self.__thread = threading.Thread(target=self.__run, name='IQRecorder')
+        self.__thread.daemon = True
+        self.__thread.start()
+    
+    def retune(self, frequency, timestamp):
+        # The messages already in the queue were received at the old frequency, so the retune takes effect after them, rather than when the thread gets to it. (The count may be off by the one message the thread is taking at this moment.)
+        self.__retunes.append((self.__taken + self.__queue.count(), frequency, timestamp))
+    
+    def stop(self):
+        """Stop without writing the samples still queued."""
+        self.__stopped = True
+        # wake the thread (and if the queue is full, it isn't waiting anyway)
+        if not self.__queue.full_p():
+            self.__queue.insert_tail(gr.message())
+    
+    def __run(self):
+        # RUNS IN A SEPARATE THREAD.
+        # pylint: disable=broad-except
+        queue = self.__queue
+        files = self.__files
+        retunes = self.__retunes
+        try:
+            while True:
+                message = queue.delete_head()  # blocking call
+                if self.__stopped:
+                    return
+                self.__taken += 1
+                while retunes and retunes[0][0] < self.__taken:
+                    _, frequency, timestamp = retunes.popleft()
+                    files.retune(frequency, timestamp)
+                if message.length() > 0:  # avoid crash bug
+                    files.write(message.to_string())
+        except Exception:
+            log.err(None, 'IQ recording failed')
+            self.__failed()
+        finally:
+            try:
+                files.close()
+            except Exception:
+                log.err(None, 'IQ recording failed while finishing')
@@ -0,0 +1,1029 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Running the web server in a separate process from the signal processing.
+
+The DSP process (the one which executed the configuration and owns the devices) runs a StateServer for each web process. The web process has a StateClient, which presents proxies for the exported objects and cells that the web server uses exactly as it would use the real ones. Cell state and commands travel as length-prefixed JSON messages over a pipe; stream cell frames (e.g. FFT) and client audio travel through shared-memory rings (shinysdr.shm) so that the bulk data is not copied through the pipe or parsed.
+
+The DSP side polls only what the web side is subscribed to, so a cell or object is polled in one process or the other but not both, and clients' interest in receivers is seen by the DSP side as if they were connected directly.
+
+This module is not an external API and not guaranteed to have a stable
+interface.
+"""
+
+# pylint: disable=no-member
+# (no-member: Twisted reactor)
+
+from __future__ import absolute_import, division
+
+import array
+import json
+import logging
+import struct
+import sys
+import weakref
+
+from twisted.application.service import Service
+from twisted.internet import defer
+from twisted.internet import reactor as the_reactor
+from twisted.internet.protocol import Protocol, ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.python.reflect import namedAny, qual
+from zope.interface import directlyProvides, providedBy  # available via Twisted
+
+from gnuradio import gr
+
+from shinysdr.profiling import LoopLagProbe, latency_metric_rows
+from shinysdr.shm import RingReader, RingWriter
+from shinysdr.types import BulkDataType
+from shinysdr.values import BaseBlockCell, Command, ExportedState, StreamCell, TextStreamCell, ValueCell, the_poller
+from shinysdr.web import _serialize
+
+
+__all__ = []  # appended later
+
+
+_length_struct = struct.Struct('!I')
+
+# Ring sizes. A stream slot must hold the largest frame (info plus one byte per FFT bin).
+_stream_slot_count = 8
+_stream_slot_size = 1 << 18
+_audio_slot_count = 64
+_audio_slot_size = 1 << 15  # a multiple of the audio frame size, so that frames are never split
+
+_audio_queue_limit = 100  # same as web.AudioStreamInner
+_audio_pump_interval = 0.01  # seconds
+_respawn_delay = 1.0  # seconds
+
+
+class RemoteError(Exception):
+    """An operation performed in the other process failed."""
+
+
+__all__.append('RemoteError')
+
+
+class _Channel(object):
+    """Frames messages (JSON-compatible structures) as length-prefixed JSON over a byte stream."""
+    
+    def __init__(self, write, message_received):
+        self.__write = write
+        self.__message_received = message_received
+        # Received data is kept as a list of chunks and joined only once a whole message (or length prefix) has arrived, so that a large message arriving in many pieces is not copied once per piece.
+        self.__chunks = []
+        self.__buffered = 0
+        self.__needed = _length_struct.size
+    
+    def send(self, message):
+        data = _serialize(message).encode('utf-8')
+        self.__write(_length_struct.pack(len(data)) + data)
+    
+    def data_received(self, data):
+        self.__chunks.append(data)
+        self.__buffered += len(data)
+        if self.__buffered < self.__needed:
+            return
+        buf = ''.join(self.__chunks)
+        offset = 0
+        header_size = _length_struct.size
+        self.__needed = header_size
+        while len(buf) - offset >= header_size:
+            length, = _length_struct.unpack_from(buf, offset)
+            end = offset + header_size + length
+            if end > len(buf):
+                self.__needed = end - offset
+                break
+            message = json.loads(buf[offset + header_size:end])
+            offset = end
+            # pylint: disable=broad-except
+            try:
+                self.__message_received(message)
+            except Exception:
+                log.err(None, 'Error handling message %r' % (message[0],))
+        rest = buf[offset:]
+        self.__chunks = [rest] if rest else []
+        self.__buffered = len(rest)
+
+
+class _ServedObject(object):
+    def __init__(self, ref):
+        self.ref = ref
+        self.cells = {}  # key -> cell serial
+
+
+class StateServer(object):
+    """
+    Serves the exported state of root_object to a StateClient.
+    
+    write is called with data to be delivered to the client's data_received; data from the client should be passed to data_received.
+    
+    Objects are held only weakly, so that serving them does not prolong their lives; when one is garbage collected the client is told to forget it.
+    """
+    
+    def __init__(self, write, root_object, note_dirty, flowgraph_for_debug=None, ready=None, reactor=the_reactor, poller=the_poller):
+        self.__channel = _Channel(write, self.__message_received)
+        self.data_received = self.__channel.data_received
+        self.__root_object = root_object
+        self.__note_dirty = note_dirty
+        self.__flowgraph = flowgraph_for_debug
+        self.__ready = ready
+        self.__reactor = reactor
+        self.__poller = poller
+        
+        self.__last_serial = 0
+        self.__object_serials = weakref.WeakKeyDictionary()  # object -> serial
+        self.__objects = {}  # serial -> _ServedObject
+        self.__cells = {}  # cell serial -> (object serial, key)
+        self.__cell_subscriptions = {}  # cell serial -> poller subscription
+        self.__state_subscriptions = {}  # object serial -> poller subscription
+        self.__streams = {}  # stream id -> (RingWriter, poller subscription)
+        self.__audio = {}  # stream id -> (gr.msg_queue, RingWriter)
+        self.__audio_loop = LoopingCall(self.__pump_audio)
+        self.__audio_loop.clock = reactor
+        self.__closed = False
+        
+        self.__ops = {
+            u'set': self.__op_set,
+            u'subscribe': self.__op_subscribe,
+            u'unsubscribe': self.__op_unsubscribe,
+            u'subscribe_state': self.__op_subscribe_state,
+            u'unsubscribe_state': self.__op_unsubscribe_state,
+            u'open_stream': self.__op_open_stream,
+            u'close_stream': self.__op_close_stream,
+            u'add_audio_queue': self.__op_add_audio_queue,
+            u'remove_audio_queue': self.__op_remove_audio_queue,
+            u'delete_child': self.__op_delete_child,
+            u'call': self.__op_call,
+            u'note_dirty': self.__op_note_dirty,
+            u'ready': self.__op_ready,
+        }
+    
+    def start(self):
+        """Send the description of the root object, which the client waits for."""
+        root = self.__root_object
+        if hasattr(root, 'get_audio_queue_channels'):
+            channels = root.get_audio_queue_channels()
+        else:
+            channels = None
+        self.__send([u'root', self.__describe(root), channels])
+    
+    def close(self):
+        """Release everything held for the client (which has gone away)."""
+        self.__closed = True
+        for subscription in self.__cell_subscriptions.values() + self.__state_subscriptions.values():
+            subscription.unsubscribe()
+        self.__cell_subscriptions.clear()
+        self.__state_subscriptions.clear()
+        for stream_id in self.__streams.keys():
+            self.__op_close_stream(stream_id)
+        for stream_id in self.__audio.keys():
+            self.__op_remove_audio_queue(stream_id)
+    
+    def __send(self, message):
+        if not self.__closed:
+            self.__channel.send(message)
+    
+    def __message_received(self, message):
+        op = message[0]
+        if op in self.__ops:
+            self.__ops[op](*message[1:])
+        else:
+            log.msg('StateServer: Unrecognized op %r' % (op,))
+    
+    def __next_serial(self):
+        self.__last_serial += 1
+        return self.__last_serial
+    
+    def __describe(self, obj):
+        serial = self.__object_serials.get(obj)
+        if serial is not None:
+            return {u'ref': serial}
+        serial = self.__next_serial()
+        self.__object_serials[obj] = serial
+        # The weakref callback runs in the middle of garbage collection, which is no place to send messages from.
+        self.__objects[serial] = _ServedObject(weakref.ref(obj, lambda _: self.__reactor.callLater(0, self.__forget, serial)))
+        return {
+            u'serial': serial,
+            u'interfaces': [qual(interface) for interface in providedBy(obj)],
+            u'dynamic': obj.state_is_dynamic(),
+            u'cells': self.__describe_cells(serial, obj),
+        }
+    
+    def __describe_cells(self, serial, obj):
+        entry = self.__objects[serial]
+        old_cells = entry.cells
+        entry.cells = cells = {}
+        descriptions = {}
+        for key, cell in obj.state().iteritems():
+            cell_serial = old_cells.get(key)
+            if cell_serial is None:
+                cell_serial = self.__next_serial()
+                self.__cells[cell_serial] = (serial, key)
+            cells[key] = cell_serial
+            descriptions[key] = self.__describe_cell(cell_serial, cell)
+        for key, cell_serial in old_cells.iteritems():
+            if key not in cells:
+                self.__drop_cell(cell_serial)
+        return descriptions
+    
+    def __describe_cell(self, cell_serial, cell):
+        if cell.isBlock():
+            return {u'serial': cell_serial, u'proxy': u'block', u'value': self.__describe(cell.get())}
+        elif isinstance(cell, StreamCell):
+            # The current value of a stream is not meaningful and may be binary, so it is not sent.
+            return {u'serial': cell_serial, u'proxy': u'stream', u'description': {
+                u'kind': u'value',
+                u'type': cell.type().type_to_json(),
+                u'writable': False,
+                u'current': None,
+            }}
+        elif isinstance(cell, TextStreamCell):
+            return {u'serial': cell_serial, u'proxy': u'text', u'description': cell.description()}
+        elif isinstance(cell, Command):
+            return {u'serial': cell_serial, u'proxy': u'command', u'description': cell.description()}
+        else:
+            return {u'serial': cell_serial, u'proxy': u'value', u'description': cell.description()}
+    
+    def __forget(self, serial):
+        entry = self.__objects.pop(serial, None)
+        if entry is None:
+            return
+        for cell_serial in entry.cells.itervalues():
+            self.__drop_cell(cell_serial)
+        subscription = self.__state_subscriptions.pop(serial, None)
+        if subscription is not None:
+            subscription.unsubscribe()
+        self.__send([u'delete', serial])
+    
+    def __drop_cell(self, cell_serial):
+        del self.__cells[cell_serial]
+        subscription = self.__cell_subscriptions.pop(cell_serial, None)
+        if subscription is not None:
+            subscription.unsubscribe()
+    
+    def __lookup_object(self, serial):
+        entry = self.__objects.get(serial)
+        if entry is None:
+            return None
+        return entry.ref()
+    
+    def __lookup_cell(self, cell_serial):
+        if cell_serial not in self.__cells:
+            # The object has gone away since the client sent its message.
+            return None
+        serial, key = self.__cells[cell_serial]
+        obj = self.__lookup_object(serial)
+        if obj is None:
+            return None
+        return obj.state().get(key)
+    
+    def __send_value(self, cell_serial, cell):
+        if isinstance(cell, (StreamCell, TextStreamCell, Command)):
+            return
+        self.__send_given_value(cell_serial, cell, cell.get())
+    
+    def __send_given_value(self, cell_serial, cell, value):
+        if cell.isBlock():
+            value = self.__describe(value)
+        self.__send([u'value', cell_serial, value])
+    
+    def __op_set(self, cell_serial, value):
+        cell = self.__lookup_cell(cell_serial)
+        if cell is None:
+            return
+        # pylint: disable=broad-except
+        try:
+            cell.set(value)
+        except Exception:
+            log.err(None, 'StateServer: Error setting %r' % (cell,))
+        # The client assumed the set succeeded exactly; correct it if not.
+        self.__send_value(cell_serial, cell)
+    
+    def __op_subscribe(self, cell_serial):
+        cell = self.__lookup_cell(cell_serial)
+        if cell is None or cell_serial in self.__cell_subscriptions:
+            return
+        if isinstance(cell, TextStreamCell):
+            def callback(chunk):
+                self.__send([u'value', cell_serial, chunk])
+        else:
+            def callback(value):
+                self.__send_given_value(cell_serial, cell, value)
+            
+            # The client's copy may be stale, since it was not subscribed.
+            self.__send_value(cell_serial, cell)
+        self.__cell_subscriptions[cell_serial] = self.__poller.subscribe(cell, callback)
+    
+    def __op_unsubscribe(self, cell_serial):
+        subscription = self.__cell_subscriptions.pop(cell_serial, None)
+        if subscription is not None:
+            subscription.unsubscribe()
+    
+    def __op_subscribe_state(self, serial):
+        obj = self.__lookup_object(serial)
+        if obj is None or serial in self.__state_subscriptions:
+            return
+        
+        def callback(_state):
+            self.__send([u'state', serial, self.__describe_cells(serial, obj)])
+        
+        self.__state_subscriptions[serial] = self.__poller.subscribe_state(obj, callback)
+    
+    def __op_unsubscribe_state(self, serial):
+        subscription = self.__state_subscriptions.pop(serial, None)
+        if subscription is not None:
+            subscription.unsubscribe()
+    
+    def __op_open_stream(self, stream_id, cell_serial):
+        cell = self.__lookup_cell(cell_serial)
+        if cell is None:
+            return
+        ring = RingWriter(_stream_slot_count, _stream_slot_size)
+        
+        def callback(frame):
+            try:
+                ring.write(frame)
+            except ValueError as e:
+                log.msg('StateServer: Dropping stream frame: %s' % (e,))
+        
+        self.__streams[stream_id] = (ring, self.__poller.subscribe(cell, callback))
+        self.__send([u'ring', stream_id, ring.path])
+    
+    def __op_close_stream(self, stream_id):
+        if stream_id not in self.__streams:
+            return
+        ring, subscription = self.__streams.pop(stream_id)
+        subscription.unsubscribe()
+        ring.close()
+    
+    def __op_add_audio_queue(self, stream_id, rate):
+        queue = gr.msg_queue(limit=_audio_queue_limit)
+        ring = RingWriter(_audio_slot_count, _audio_slot_size)
+        self.__root_object.add_audio_queue(queue, rate)
+        self.__audio[stream_id] = (queue, ring)
+        if not self.__audio_loop.running:
+            self.__audio_loop.start(_audio_pump_interval)
+        self.__send([u'ring', stream_id, ring.path])
+    
+    def __op_remove_audio_queue(self, stream_id):
+        if stream_id not in self.__audio:
+            return
+        queue, ring = self.__audio.pop(stream_id)
+        self.__root_object.remove_audio_queue(queue)
+        ring.close()
+        if not self.__audio and self.__audio_loop.running:
+            self.__audio_loop.stop()
+    
+    def __pump_audio(self):
+        for queue, ring in self.__audio.itervalues():
+            step = ring.get_slot_size()
+            while not queue.empty_p():
+                message = queue.delete_head()
+                if message.length() > 0:  # avoid crash bug
+                    data = message.to_string()
+                    for i in xrange(0, len(data), step):
+                        ring.write(data[i:i + step])
+    
+    def __op_delete_child(self, serial, key):
+        obj = self.__lookup_object(serial)
+        if obj is not None:
+            obj.delete_child(key)
+    
+    def __op_call(self, call_id, name, *args):
+        d = defer.maybeDeferred(self.__call, name, *args)
+        d.addCallbacks(
+            lambda value: self.__send([u'result', call_id, value]),
+            lambda failure: self.__send([u'error', call_id, failure.getErrorMessage()]))
+    
+    def __call(self, name, *args):
+        if name == u'create_child':
+            serial, desc = args
+            obj = self.__lookup_object(serial)
+            if obj is None:
+                raise RemoteError('Object no longer exists')
+            return obj.create_child(desc)
+        elif name == u'dot_graph':
+            if self.__flowgraph is None:
+                raise RemoteError('No flow graph available')
+            return self.__flowgraph.dot_graph()
+        elif name == u'metrics':
+            if self.__flowgraph is None:
+                raise RemoteError('No flow graph available')
+            # The web process adds its own latency histograms and formats them all together, since each metric family must be written in one piece.
+            return self.__flowgraph.metrics() + latency_metric_rows({'process': 'dsp'})
+        else:
+            raise RemoteError('Unknown call %r' % (name,))
+    
+    def __op_note_dirty(self):
+        self.__note_dirty()
+    
+    def __op_ready(self, url):
+        if self.__ready is not None:
+            self.__ready(url)
+
+
+__all__.append('StateServer')
+
+
+class StateClient(object):
+    """
+    Presents the state served by a StateServer as proxy objects.
+    
+    write is called with data to be delivered to the server's data_received; data from the server should be passed to data_received.
+    
+    The proxies' values are cached, and are kept up to date only while they are subscribed to using a Poller; setting a value updates the cache immediately and the server corrects it if the set did not take effect as given.
+    """
+    
+    def __init__(self, write, reactor=the_reactor):
+        self.__channel = _Channel(write, self.__message_received)
+        self.data_received = self.__channel.data_received
+        self.__root = None
+        self.__root_waiting = []
+        self.__audio_channels = None
+        
+        self.__objects = {}  # serial -> _RemoteExportedState
+        self.__cells = {}  # cell serial -> proxy cell
+        self.__object_cell_serials = {}  # serial -> {key: cell serial}
+        self.__subscribed_cells = set()
+        self.__subscribed_states = set()
+        self.__interfaces = {}  # name -> interface
+        
+        self.__last_id = 0
+        self.__calls = {}  # call id -> Deferred
+        self.__streams = set()  # ids of open streams
+        self.__audio_queues = {}  # stream id -> gr.msg_queue
+        self.__readers = {}  # stream id -> RingReader
+        self.__audio_loop = LoopingCall(self.__pump_audio)
+        self.__audio_loop.clock = reactor
+        
+        self.__ops = {
+            u'root': self.__op_root,
+            u'value': self.__op_value,
+            u'state': self.__op_state,
+            u'delete': self.__op_delete,
+            u'ring': self.__op_ring,
+            u'result': self.__op_result,
+            u'error': self.__op_error,
+        }
+    
+    def when_ready(self):
+        """Return a Deferred which fires with the proxy for the root object once it has been received."""
+        if self.__root is not None:
+            return defer.succeed(self.__root)
+        d = defer.Deferred()
+        self.__root_waiting.append(d)
+        return d
+    
+    def note_dirty(self):
+        """Tell the server that its state should be saved."""
+        self._send([u'note_dirty'])
+    
+    def dot_graph(self):
+        """Return a Deferred for the server's flow graph in Graphviz format (the web server's debug graph view)."""
+        return self._call(u'dot_graph')
+    
+    def metrics(self):
+        """Return a Deferred for the server's performance counters as rows for shinysdr.diagnostics.format_metrics (the web server's metrics resource)."""
+        return self._call(u'metrics')
+    
+    def announce(self, url):
+        """Tell the server the URL at which its state is being served."""
+        self._send([u'ready', url])
+    
+    def _send(self, message):
+        self.__channel.send(message)
+    
+    def _call(self, name, *args):
+        self.__last_id += 1
+        call_id = self.__last_id
+        d = defer.Deferred()
+        self.__calls[call_id] = d
+        self._send([u'call', call_id, name] + list(args))
+        return d
+    
+    def __message_received(self, message):
+        op = message[0]
+        if op in self.__ops:
+            self.__ops[op](*message[1:])
+        else:
+            log.msg('StateClient: Unrecognized op %r' % (op,))
+    
+    def __resolve(self, desc, proxy_class=None):
+        if u'ref' in desc:
+            return self.__objects[desc[u'ref']]
+        serial = desc[u'serial']
+        obj = (proxy_class or _RemoteExportedState)(
+            client=self,
+            serial=serial,
+            interfaces=[i for i in map(self.__interface, desc[u'interfaces']) if i is not None],
+            dynamic=desc[u'dynamic'])
+        # registered before the cells are made, since they may refer back to it
+        self.__objects[serial] = obj
+        obj._set_cells(self.__make_cells(obj, serial, desc[u'cells']))
+        return obj
+    
+    def __interface(self, name):
+        if name not in self.__interfaces:
+            try:
+                self.__interfaces[name] = namedAny(name)
+            except (ImportError, AttributeError):
+                log.msg('StateClient: Could not load interface %s' % (name,))
+                self.__interfaces[name] = None
+        return self.__interfaces[name]
+    
+    def __make_cells(self, obj, serial, descriptions):
+        cells = {}
+        old_serials = self.__object_cell_serials.get(serial, {})
+        serials = {}
+        for key, desc in descriptions.iteritems():
+            cell_serial = desc[u'serial']
+            cell = self.__cells.get(cell_serial)
+            kind = desc[u'proxy']
+            if kind == u'block':
+                value = self.__resolve(desc[u'value'])
+                if cell is None:
+                    cell = _RemoteBlockCell(self, obj, key, cell_serial, value)
+                else:
+                    cell._update(value)
+            elif cell is not None:
+                # Other kinds' values arrive only by subscription.
+                pass
+            elif kind == u'stream':
+                cell = _RemoteStreamCell(self, obj, key, cell_serial, desc[u'description'])
+            elif kind == u'text':
+                cell = _RemoteTextStreamCell(self, key, cell_serial, desc[u'description'])
+            elif kind == u'command':
+                cell = Command(obj, key, lambda cell_serial=cell_serial: self._send([u'set', cell_serial, None]))
+            else:
+                cell = _RemoteValueCell(self, obj, key, cell_serial, desc[u'description'])
+            self.__cells[cell_serial] = cell
+            cells[key] = cell
+            serials[key] = cell_serial
+        for key, cell_serial in old_serials.iteritems():
+            if serials.get(key) != cell_serial:
+                self.__cells.pop(cell_serial, None)
+        self.__object_cell_serials[serial] = serials
+        return cells
+    
+    def _cell_subscription_count_changed(self, cell_serial, count):
+        if (count > 0) != (cell_serial in self.__subscribed_cells):
+            if count > 0:
+                self.__subscribed_cells.add(cell_serial)
+                self._send([u'subscribe', cell_serial])
+            else:
+                self.__subscribed_cells.remove(cell_serial)
+                self._send([u'unsubscribe', cell_serial])
+    
+    def _state_subscription_count_changed(self, serial, count):
+        if (count > 0) != (serial in self.__subscribed_states):
+            if count > 0:
+                self.__subscribed_states.add(serial)
+                self._send([u'subscribe_state', serial])
+            else:
+                self.__subscribed_states.remove(serial)
+                self._send([u'unsubscribe_state', serial])
+    
+    def __next_id(self):
+        self.__last_id += 1
+        return self.__last_id
+    
+    def _open_stream(self, cell_serial, bulk_type):
+        stream_id = self.__next_id()
+        self.__streams.add(stream_id)
+        self._send([u'open_stream', stream_id, cell_serial])
+        return _RemoteSplitter(self, stream_id, bulk_type)
+    
+    def _get_reader(self, stream_id):
+        return self.__readers.get(stream_id)
+    
+    def _close_stream(self, stream_id):
+        self.__streams.discard(stream_id)
+        self.__close_reader(stream_id)
+        self._send([u'close_stream', stream_id])
+    
+    def _add_audio_queue(self, queue, rate):
+        stream_id = self.__next_id()
+        self.__audio_queues[stream_id] = queue
+        self._send([u'add_audio_queue', stream_id, rate])
+        if not self.__audio_loop.running:
+            self.__audio_loop.start(_audio_pump_interval)
+    
+    def _remove_audio_queue(self, queue):
+        for stream_id, known in self.__audio_queues.items():
+            if known is queue:
+                del self.__audio_queues[stream_id]
+                self.__close_reader(stream_id)
+                self._send([u'remove_audio_queue', stream_id])
+        if not self.__audio_queues and self.__audio_loop.running:
+            self.__audio_loop.stop()
+    
+    def _get_audio_queue_channels(self):
+        return self.__audio_channels
+    
+    def __close_reader(self, stream_id):
+        reader = self.__readers.pop(stream_id, None)
+        if reader is not None:
+            reader.close()
+    
+    def __pump_audio(self):
+        for stream_id, queue in self.__audio_queues.iteritems():
+            reader = self.__readers.get(stream_id)
+            if reader is not None:
+                for data in reader.read_all():
+                    queue.insert_tail(gr.message_from_string(data))
+    
+    def __op_root(self, desc, audio_channels):
+        self.__audio_channels = audio_channels
+        self.__root = self.__resolve(desc, proxy_class=_RemoteRoot)
+        waiting = self.__root_waiting
+        self.__root_waiting = []
+        for d in waiting:
+            d.callback(self.__root)
+    
+    def __op_value(self, cell_serial, value):
+        cell = self.__cells.get(cell_serial)
+        if cell is None:
+            return
+        if cell.isBlock():
+            value = self.__resolve(value)
+        cell._update(value)
+    
+    def __op_state(self, serial, descriptions):
+        obj = self.__objects.get(serial)
+        if obj is None:
+            return
+        obj._set_cells(self.__make_cells(obj, serial, descriptions))
+    
+    def __op_delete(self, serial):
+        obj = self.__objects.pop(serial, None)
+        if obj is None:
+            return
+        for cell_serial in self.__object_cell_serials.pop(serial, {}).itervalues():
+            self.__cells.pop(cell_serial, None)
+        self.__subscribed_states.discard(serial)
+    
+    def __op_ring(self, stream_id, path):
+        if stream_id in self.__streams or stream_id in self.__audio_queues:
+            self.__readers[stream_id] = RingReader(path)
+    
+    def __op_result(self, call_id, value):
+        self.__calls.pop(call_id).callback(value)
+    
+    def __op_error(self, call_id, message):
+        self.__calls.pop(call_id).errback(RemoteError(message))
+
+
+__all__.append('StateClient')
+
+
+class _RemoteExportedState(ExportedState):
+    def __init__(self, client, serial, interfaces, dynamic):
+        self.__client = client
+        self.__serial = serial
+        self.__dynamic = dynamic
+        self.__cells = {}
+        directlyProvides(self, *interfaces)
+    
+    def _set_cells(self, cells):
+        self.__cells = cells
+    
+    def state_def(self, callback):
+        super(_RemoteExportedState, self).state_def(callback)
+        for cell in self.__cells.itervalues():
+            callback(cell)
+    
+    def state_is_dynamic(self):
+        return self.__dynamic
+    
+    def state_subscription_count_changed(self, count):
+        self.__client._state_subscription_count_changed(self.__serial, count)
+    
+    def create_child(self, desc):
+        """Returns a Deferred for the key of the new child."""
+        return self.__client._call(u'create_child', self.__serial, desc)
+    
+    def delete_child(self, key):
+        self.__client._send([u'delete_child', self.__serial, key])
+
+
+class _RemoteRoot(_RemoteExportedState):
+    """The root object, which also provides the audio operations of shinysdr.session.Session."""
+    
+    def __init__(self, client, **kwargs):
+        _RemoteExportedState.__init__(self, client=client, **kwargs)
+        self.__client = client
+    
+    def add_audio_queue(self, queue, queue_rate):
+        self.__client._add_audio_queue(queue, queue_rate)
+    
+    def remove_audio_queue(self, queue):
+        self.__client._remove_audio_queue(queue)
+    
+    def get_audio_queue_channels(self):
+        return self.__client._get_audio_queue_channels()
+
+
+class _RemoteValueCell(ValueCell):
+    def __init__(self, client, target, key, serial, description):
+        ValueCell.__init__(self, target, key, type=object, writable=description[u'writable'], persists=False)
+        self.__client = client
+        self.__serial = serial
+        self.__description = description
+        self.__value = description[u'current']
+    
+    def get(self):
+        return self.__value
+    
+    def set(self, value):
+        if not self.isWritable():
+            raise Exception('Not writable.')
+        self.__value = value
+        self.__client._send([u'set', self.__serial, value])
+    
+    def description(self):
+        description = dict(self.__description)
+        description[u'current'] = self.__value
+        return description
+    
+    def subscription_count_changed(self, count):
+        self.__client._cell_subscription_count_changed(self.__serial, count)
+    
+    def _update(self, value):
+        self.__value = value
+
+
+class _RemoteBlockCell(BaseBlockCell):
+    def __init__(self, client, target, key, serial, value):
+        BaseBlockCell.__init__(self, target, key, persists=False)
+        self.__client = client
+        self.__serial = serial
+        self.__value = value
+    
+    def get(self):
+        return self.__value
+    
+    def subscription_count_changed(self, count):
+        self.__client._cell_subscription_count_changed(self.__serial, count)
+    
+    def _update(self, value):
+        self.__value = value
+
+
+class _RemoteStreamCell(StreamCell):
+    def __init__(self, client, target, key, serial, description):
+        # StreamCell's constructor is not used because we have no distributor.
+        # pylint: disable=non-parent-init-called, super-init-not-called
+        type_json = description[u'type']
+        ValueCell.__init__(self, target, key,
+            type=BulkDataType(info_format=str(type_json[u'info_format']), array_format=str(type_json[u'array_format'])),
+            writable=False,
+            persists=False)
+        self.__client = client
+        self.__serial = serial
+        self.__description = description
+    
+    def subscribe(self):
+        return self.__client._open_stream(self.__serial, self.type())
+    
+    def get(self):
+        return None
+    
+    def description(self):
+        return self.__description
+
+
+class _RemoteSplitter(object):
+    """Stands in for values._MessageSplitter, reading frames from the ring the server writes them to."""
+    
+    def __init__(self, client, stream_id, bulk_type):
+        self.__client = client
+        self.__stream_id = stream_id
+        self.__info_struct = struct.Struct(bulk_type.get_info_format())
+        self.__array_format = bulk_type.get_array_format()
+    
+    def get(self, binary=False):
+        reader = self.__client._get_reader(self.__stream_id)
+        if reader is None:
+            # not yet opened by the server
+            return None
+        frame = reader.read()
+        if frame is None or binary:
+            return frame
+        # The frame is in the binary form (info packed in front of the data); unpack it as _MessageSplitter would.
+        info_size = self.__info_struct.size
+        unpacker = array.array(self.__array_format)
+        unpacker.fromstring(frame[info_size:])
+        return (self.__info_struct.unpack(frame[:info_size]), unpacker.tolist())
+    
+    def close(self):
+        self.__client._close_stream(self.__stream_id)
+
+
+class _RemoteTextStreamCell(TextStreamCell):
+    def __init__(self, client, key, serial, description):
+        TextStreamCell.__init__(self, key, source=self.__take, size=description[u'size'])
+        self.__client = client
+        self.__serial = serial
+        # The text so far is delivered as if it were new, which it is to this cell.
+        self.__pending = [description[u'current']]
+    
+    def __take(self):
+        chunk = u''.join(self.__pending)
+        self.__pending = []
+        return chunk
+    
+    def subscription_count_changed(self, count):
+        self.__client._cell_subscription_count_changed(self.__serial, count)
+    
+    def _update(self, chunk):
+        self.__pending.append(chunk)
+
+
+class WebProcessService(Service):
+    """
+    Runs a web server (shinysdr.web.WebService) in a child process, serving root_object through a StateServer.
+    
+    web_config is passed to the child; see _serve_web_process for its contents. If the child exits, it is restarted.
+    """
+    
+    def __init__(self, reactor, root_object, flowgraph_for_debug, note_dirty, web_config):
+        self.__reactor = reactor
+        self.__root_object = root_object
+        self.__flowgraph = flowgraph_for_debug
+        self.__note_dirty = note_dirty
+        self.__web_config = web_config
+        self.__process = None
+        self.__stopped = None
+        self.__open_client = None
+        self.__url = None
+    
+    def startService(self):
+        Service.startService(self)
+        self.__spawn()
+    
+    def stopService(self):
+        Service.stopService(self)
+        if self.__process is None:
+            return None
+        self.__stopped = defer.Deferred()
+        self.__process.signalProcess('TERM')
+        return self.__stopped
+    
+    def announce(self, open_client):
+        """interface used by shinysdr.main"""
+        # The child may not have started listening yet.
+        self.__open_client = open_client
+        if self.__url is not None:
+            self.__announce()
+    
+    def __spawn(self):
+        self.__process = self.__reactor.spawnProcess(
+            _WebProcessProtocol(self.__make_server, self.__process_ended),
+            sys.executable,
+            args=[sys.executable, '-m', 'shinysdr.remote', json.dumps(self.__web_config)],
+            env=None,  # inherit environment
+            childFDs={
+                0: 'w',
+                1: 1,
+                2: 2,
+                3: 'r',
+            })
+    
+    def __make_server(self, write):
+        return StateServer(
+            write=write,
+            root_object=self.__root_object,
+            note_dirty=self.__note_dirty,
+            flowgraph_for_debug=self.__flowgraph,
+            ready=self.__ready,
+            reactor=self.__reactor)
+    
+    def __ready(self, url):
+        first = self.__url is None
+        self.__url = url
+        if first and self.__open_client is not None:
+            self.__announce()
+    
+    def __announce(self):
+        url = self.__url
+        if self.__open_client:
+            log.msg('Opening ' + url)
+            import webbrowser  # lazy load
+            webbrowser.open(url, new=1, autoraise=True)
+        else:
+            log.msg('Visit ' + url)
+        self.__open_client = None
+    
+    def __process_ended(self, reason):
+        self.__process = None
+        if self.__stopped is not None:
+            self.__stopped.callback(None)
+            self.__stopped = None
+        elif self.running:
+            log.msg('Web process exited (%s); restarting' % (reason.getErrorMessage(),))
+            self.__reactor.callLater(_respawn_delay, self.__spawn)
+
+
+__all__.append('WebProcessService')
+
+
+class _WebProcessProtocol(ProcessProtocol):
+    def __init__(self, make_server, ended):
+        self.__make_server = make_server
+        self.__ended = ended
+        self.__server = None
+    
+    def connectionMade(self):
+        self.__server = self.__make_server(lambda data: self.transport.writeToChild(0, data))
+        self.__server.start()
+    
+    def childDataReceived(self, childFD, data):
+        if childFD == 3:
+            self.__server.data_received(data)
+    
+    def processEnded(self, reason):
+        self.__server.close()
+        self.__ended(reason)
+
+
+class _ParentProtocol(Protocol):
+    def __init__(self, done):
+        self.client = StateClient(lambda data: self.transport.write(data))
+        self.__done = done
+    
+    def dataReceived(self, data):
+        self.client.data_received(data)
+    
+    def connectionLost(self, reason):
+        self.__done.callback(None)
+
+
+@defer.inlineCallbacks
+def _serve_web_process(reactor, config_json):
+    """
+    Main function of the web process.
+    
+    config_json is a JSON object with the parameters of shinysdr.config.Config.serve_web (http_endpoint, ws_endpoint, root_cap, title) and the database configuration (db_directories, writable_db).
+    """
+    # imported here, as in main, so that a usage error is quick
+    from twisted.internet.stdio import StandardIO
+    from shinysdr.config import Config
+    from shinysdr.web import WebService
+    
+    config = json.loads(config_json)
+    
+    logging.basicConfig(level=logging.INFO)
+    log.startLoggingWithObserver(log.PythonLoggingObserver(loggerName='shinysdr.web_process').emit, False)
+    
+    # The parent reads fd 3 rather than stdout so that stray prints cannot corrupt the messages.
+    done = defer.Deferred()
+    protocol = _ParentProtocol(done)
+    StandardIO(protocol, stdin=0, stdout=3, reactor=reactor)
+    client = protocol.client
+    root = yield client.when_ready()
+    
+    databases = Config(reactor).databases
+    for path in config[u'db_directories']:
+        databases.add_directory(path)
+    if config[u'writable_db'] is not None:
+        databases.add_writable_database(config[u'writable_db'])
+    
+    service = WebService(
+        reactor=reactor,
+        root_object=root,
+        flowgraph_for_debug=client,
+        note_dirty=client.note_dirty,
+        read_only_dbs=databases._get_read_only_databases(),
+        writable_db=databases._get_writable_database(),
+        http_endpoint=str(config[u'http_endpoint']),
+        ws_endpoint=str(config[u'ws_endpoint']),
+        root_cap=config[u'root_cap'],
+        title=config[u'title'])
+    service.startService()
+    client.announce(service.get_url())
+    LoopLagProbe(reactor).start()
+    
+    # Exit when the DSP process goes away.
+    yield done
+    yield service.stopService()
+
+
+if __name__ == '__main__':
+    from twisted.internet.task import react
+    react(_serve_web_process, sys.argv[1:])
@@ -0,0 +1,300 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Signal detection on the monitor's spectrum, and automatic management of receivers for the signals found.
+"""
+
+from __future__ import absolute_import, division
+
+import struct
+
+from twisted.internet import reactor as the_reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+import numpy
+
+from shinysdr.modes import get_modes
+from shinysdr.types import Enum, Range
+from shinysdr.values import ExportedState, exported_value, setter
+
+
+__all__ = []  # appended later
+
+
+_scan_interval = 0.25  # seconds
+
+
+def find_peaks(spectrum, threshold):
+    """
+    Find the signals in a power spectrum.
+    
+    spectrum: sequence of power values in dB.
+    threshold: how far above the noise floor, in dB, a bin must be to count as signal.
+    
+    Returns (noise_floor, bins, levels): the estimated noise floor, and for each contiguous run of bins above the threshold, the index and value of its strongest bin.
+    """
+    spectrum = numpy.asarray(spectrum, dtype=numpy.float32)
+    # Most of the spectrum is assumed to be noise, so the median is a robust estimate of its level.
+    noise_floor = float(numpy.median(spectrum)) if len(spectrum) else 0.0
+    above = spectrum > noise_floor + threshold
+    edges = numpy.diff(numpy.concatenate(([False], above, [False])).astype(numpy.int8))
+    starts = numpy.flatnonzero(edges == 1)
+    if len(starts) == 0:
+        return noise_floor, numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.float32)
+    # Each segment from one start to the next contains one run followed by bins below the threshold, which masking keeps from contributing to the maximum.
+    masked = numpy.where(above, spectrum, -numpy.inf)
+    levels = numpy.maximum.reduceat(masked, starts)
+    segment_lengths = numpy.diff(numpy.append(starts, len(spectrum)))
+    candidates = starts[0] + numpy.flatnonzero(masked[starts[0]:] == numpy.repeat(levels, segment_lengths))
+    # If a run has several bins at its maximum, take the first.
+    _, first = numpy.unique(numpy.searchsorted(starts, candidates, side='right'), return_index=True)
+    return noise_floor, candidates[first], levels
+
+
+__all__.append('find_peaks')
+
+
+class Scanner(ExportedState):
+    """
+    Watches the monitor's spectrum for signals, and creates a receiver for each (up to a limit), retunes it to follow the signal, and deletes it once the signal has been gone for a while.
+    
+    Receivers created by the user are left alone, and signals near them are ignored.
+    
+    If a FrequencyIndex is provided, signals near a database channel are tuned to the channel's frequency and mode.
+    """
+    
+    def __init__(self,
+            top,
+            frequency_index=None,
+            enabled=False,
+            threshold=10.0,
+            match_width=12500.0,
+            hold_time=10.0,
+            max_receivers=4,
+            mode=u'NFM',
+            use_database=True,
+            reactor=the_reactor):
+        self.__top = top
+        self.__frequency_index = frequency_index
+        self.__reactor = reactor
+        
+        # settable parameters
+        self.__enabled = False
+        self.__threshold = float(threshold)
+        self.__match_width = float(match_width)
+        self.__hold_time = float(hold_time)
+        self.__max_receivers = int(max_receivers)
+        self.__mode = unicode(mode)
+        self.__use_database = bool(use_database)
+        
+        # scan state
+        self.__splitter = None
+        self.__info_struct = None
+        self.__loop = LoopingCall(self.__poll)
+        self.__loop.clock = reactor
+        self.__managed = {}  # receiver key -> time its signal was last seen
+        self.__noise_floor = 0.0
+        self.__signal_count = 0
+        
+        self.set_enabled(enabled)
+    
+    @exported_value(type=bool)
+    def get_enabled(self):
+        return self.__enabled
+    
+    @setter
+    def set_enabled(self, value):
+        value = bool(value)
+        if value == self.__enabled: return
+        self.__enabled = value
+        if value:
+            fft_cell = self.__top.monitor.state()['fft']
+            self.__info_struct = struct.Struct(fft_cell.type().get_info_format())
+            self.__splitter = fft_cell.subscribe()
+            self.__loop.start(_scan_interval, now=False)
+        else:
+            self.__loop.stop()
+            self.__splitter.close()
+            self.__splitter = None
+            for key in self.__managed.keys():
+                self.__delete(key)
+            self.__signal_count = 0
+    
+    @exported_value(type=Range([(0, 60)], strict=False))
+    def get_threshold(self):
+        """Level above the noise floor, in dB, at which a signal is detected."""
+        return self.__threshold
+    
+    @setter
+    def set_threshold(self, value):
+        self.__threshold = float(value)
+    
+    @exported_value(type=Range([(100, 1e6)], logarithmic=True, strict=False))
+    def get_match_width(self):
+        """Signals closer than this, in Hz, to a receiver are considered to belong to that receiver."""
+        return self.__match_width
+    
+    @setter
+    def set_match_width(self, value):
+        self.__match_width = float(value)
+    
+    @exported_value(type=Range([(0, 600)], strict=False))
+    def get_hold_time(self):
+        """Time, in seconds, a receiver is kept after its signal disappears."""
+        return self.__hold_time
+    
+    @setter
+    def set_hold_time(self, value):
+        self.__hold_time = float(value)
+    
+    @exported_value(type=Range([(1, 20)], integer=True))
+    def get_max_receivers(self):
+        return self.__max_receivers
+    
+    @setter
+    def set_max_receivers(self, value):
+        self.__max_receivers = int(value)
+    
+    # type construction is deferred because we don't want loading this file to trigger loading plugins
+    @exported_value(type_fn=lambda self: Enum({d.mode: d.label for d in get_modes()}))
+    def get_mode(self):
+        """Mode of created receivers, unless taken from the database."""
+        return self.__mode
+    
+    @setter
+    def set_mode(self, value):
+        self.__mode = unicode(value)
+    
+    @exported_value(type=bool)
+    def get_use_database(self):
+        return self.__use_database
+    
+    @setter
+    def set_use_database(self, value):
+        self.__use_database = bool(value)
+    
+    @exported_value(type=float)
+    def get_noise_floor(self):
+        return self.__noise_floor
+    
+    @exported_value(type=int)
+    def get_signal_count(self):
+        return self.__signal_count
+    
+    def __poll(self):
+        # Only the most recent frame matters.
+        frame = None
+        while True:
+            next_frame = self.__splitter.get(binary=True)
+            if next_frame is None:
+                break
+            frame = next_frame
+        if frame is None:
+            return
+        center_freq, sample_rate, offset = self.__info_struct.unpack_from(frame)
+        spectrum = numpy.frombuffer(frame, dtype=numpy.int8, offset=self.__info_struct.size)
+        self._scan(
+            spectrum.astype(numpy.float32) - offset,
+            center_freq=center_freq,
+            sample_rate=sample_rate,
+            analytic=self.__top.monitor.get_signal_type().is_analytic())
+    
+    # not private, for testing
+    def _scan(self, spectrum, center_freq, sample_rate, analytic):
+        """Process one FFT frame, in dB, in the monitor's (unshifted) bin order."""
+        now = self.__reactor.seconds()
+        size = len(spectrum)
+        if size == 0:
+            return
+        if analytic:
+            spectrum = numpy.fft.fftshift(spectrum)
+            bin_width = sample_rate / size
+            low_freq = center_freq - (size // 2) * bin_width
+            # Ignore the DC spike most hardware has.
+            spectrum[size // 2 - 1:size // 2 + 2] = numpy.median(spectrum)
+        else:
+            bin_width = sample_rate / 2 / size
+            low_freq = center_freq
+        
+        self.__noise_floor, bins, _ = find_peaks(spectrum, self.__threshold)
+        self.__signal_count = len(bins)
+        peak_freqs = low_freq + bins * bin_width
+        
+        receivers = self.__top.receivers.state()
+        for key in self.__managed.keys():
+            if key not in receivers:
+                # deleted by someone else
+                del self.__managed[key]
+        unmanaged_freqs = [
+            cell.get().get_rec_freq()
+            for key, cell in receivers.iteritems()
+            if key not in self.__managed]
+        tolerance = self.__match_width / 2
+        
+        for freq in peak_freqs:
+            freq = float(freq)
+            if any(abs(freq - other) <= tolerance for other in unmanaged_freqs):
+                continue
+            mode = self.__mode
+            record = self.__lookup(freq, tolerance)
+            if record is not None:
+                freq = record[u'lowerFreq']
+                # Receiver will deal with a mode that does not exist.
+                mode = record.get(u'mode') or mode
+            key = self.__nearest_managed(receivers, freq, tolerance)
+            if key is not None:
+                self.__managed[key] = now
+                receiver = receivers[key].get()
+                # Retune only when the signal has clearly moved, so that FFT noise does not cause constant retuning.
+                if abs(receiver.get_rec_freq() - freq) > max(tolerance / 2, bin_width):
+                    receiver.set_rec_freq(freq)
+            elif len(self.__managed) < self.__max_receivers:
+                # Not persisted, since after a restart nothing would be managing it.
+                key, _ = self.__top.add_receiver(mode, state={u'mode': mode, u'rec_freq': freq}, persists=False)
+                log.msg('Scanner created receiver %s at %s Hz' % (key, freq))
+                self.__managed[key] = now
+                receivers = self.__top.receivers.state()
+        
+        for key, last_seen in self.__managed.items():
+            if now - last_seen > self.__hold_time:
+                self.__delete(key)
+    
+    def __lookup(self, freq, tolerance):
+        if self.__frequency_index is None or not self.__use_database:
+            return None
+        return self.__frequency_index.lookup(freq, tolerance)
+    
+    def __nearest_managed(self, receivers, freq, tolerance):
+        best_key = None
+        best_distance = tolerance
+        for key in self.__managed:
+            distance = abs(receivers[key].get().get_rec_freq() - freq)
+            if distance <= best_distance:
+                best_key = key
+                best_distance = distance
+        return best_key
+    
+    def __delete(self, key):
+        del self.__managed[key]
+        if key in self.__top.receivers.state():
+            log.msg('Scanner deleting receiver %s' % (key,))
+            self.__top.delete_receiver(key)
+
+
+__all__.append('Scanner')
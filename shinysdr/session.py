@@ -29,11 +29,13 @@ from shinysdr.values import Command, ExportedState, exported_block
 
 
 class AppRoot(ExportedState):
-    def __init__(self, devices, audio_config, features):
+    def __init__(self, devices, audio_config, features, frequency_index=None, recording_directory=None):
         self.__receive_flowgraph = Top(
             devices=devices,
             audio_config=audio_config,
-            features=features)
+            features=features,
+            frequency_index=frequency_index,
+            recording_directory=recording_directory)
         # TODO: only one session while we sort out other things
         self.__session = Session(
             receive_flowgraph=self.__receive_flowgraph,
@@ -73,6 +75,8 @@ class Session(ExportedState):
         callback(rxfs['receivers'])
         callback(rxfs['accessories'])
         callback(rxfs['telemetry_store'])
+        callback(rxfs['scanner'])
+        callback(rxfs['recorders'])
         callback(rxfs['source_name'])
         callback(rxfs['clip_warning'])
         if self.__enable_reboot:
@@ -0,0 +1,173 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory-mapped ring buffers for passing messages (FFT frames, audio) between processes without copying them through a pipe.
+
+This module is not an external API and not guaranteed to have a stable
+interface.
+"""
+
+from __future__ import absolute_import, division
+
+import mmap
+import os
+import struct
+import tempfile
+
+
+__all__ = []  # appended later
+
+
+# Layout:
+#   header: magic, slot count, slot size, write count (messages ever written)
+#   slots: sequence number (message index + 1, or 0 while being written), payload length, payload
+_MAGIC = 'ShRB'
+_header = struct.Struct('<4sIIxxxxQ')
+_slot_header = struct.Struct('<QI')
+_write_count_offset = 16
+
+
+def _shm_directory():
+    # /dev/shm, where available, keeps the file from ever being written to disk.
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return None
+
+
+class RingWriter(object):
+    """
+    The writing end of a ring buffer of fixed-size slots, stored in a newly created file which the reader opens by name.
+    
+    There is exactly one writer and one reader. The reader removes the file as soon as it has mapped it, so that once both ends are open the memory goes away with the processes, even if they crash.
+    
+    The writer never waits for the reader: if the reader falls more than slot_count messages behind, the oldest messages are lost, and the reader finds that out from the sequence numbers.
+    """
+    
+    def __init__(self, slot_count, slot_size, prefix='shinysdr-'):
+        self.__slot_count = slot_count
+        self.__slot_size = slot_size
+        self.__stride = _slot_header.size + slot_size
+        fd, self.path = tempfile.mkstemp(prefix=prefix, dir=_shm_directory())
+        try:
+            length = _header.size + slot_count * self.__stride
+            os.ftruncate(fd, length)
+            self.__map = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+        _header.pack_into(self.__map, 0, _MAGIC, slot_count, slot_size, 0)
+        self.__write_count = 0
+    
+    def get_slot_size(self):
+        """The largest message which may be written."""
+        return self.__slot_size
+    
+    def write(self, data):
+        data_length = len(data)
+        if data_length > self.__slot_size:
+            raise ValueError('Message of %i bytes does not fit in %i byte slot' % (data_length, self.__slot_size))
+        count = self.__write_count
+        offset = _header.size + (count % self.__slot_count) * self.__stride
+        m = self.__map
+        # Invalidate the slot first, so that a reader copying it concurrently can tell its copy is bad.
+        _slot_header.pack_into(m, offset, 0, 0)
+        payload_offset = offset + _slot_header.size
+        m[payload_offset:payload_offset + data_length] = data
+        _slot_header.pack_into(m, offset, count + 1, data_length)
+        count += 1
+        struct.pack_into('<Q', m, _write_count_offset, count)
+        self.__write_count = count
+    
+    def close(self):
+        """Release the memory, and remove the file if the reader never opened it. The reader may keep using its mapping."""
+        if self.__map is None:
+            return
+        self.__map.close()
+        self.__map = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+__all__.append('RingWriter')
+
+
+class RingReader(object):
+    """
+    The reading end of a ring buffer created by a RingWriter. Opening it removes the file.
+    """
+    
+    def __init__(self, path):
+        with open(path, 'r+b') as f:
+            self.__map = mmap.mmap(f.fileno(), 0)
+        magic, self.__slot_count, self.__slot_size, _ = _header.unpack_from(self.__map, 0)
+        if magic != _MAGIC:
+            self.__map.close()
+            raise ValueError('%s is not a ring buffer' % (path,))
+        # Both ends have it mapped now, so the name is no longer needed.
+        os.unlink(path)
+        self.__stride = _slot_header.size + self.__slot_size
+        self.__read_count = 0
+        self.__dropped = 0
+    
+    def get_dropped(self):
+        """Number of messages which were overwritten before they could be read."""
+        return self.__dropped
+    
+    def read(self):
+        """Return the next message, or None if there is none yet."""
+        m = self.__map
+        while True:
+            write_count, = struct.unpack_from('<Q', m, _write_count_offset)
+            count = self.__read_count
+            if count >= write_count:
+                return None
+            if write_count - count > self.__slot_count:
+                self.__skip_to(write_count - self.__slot_count)
+                continue
+            offset = _header.size + (count % self.__slot_count) * self.__stride
+            sequence, length = _slot_header.unpack_from(m, offset)
+            if sequence == count + 1:
+                payload_offset = offset + _slot_header.size
+                data = m[payload_offset:payload_offset + length]
+                if _slot_header.unpack_from(m, offset) == (sequence, length):
+                    self.__read_count = count + 1
+                    return data
+            # The writer has lapped us and is overwriting this slot; the message is gone.
+            self.__skip_to(count + 1)
+    
+    def read_all(self):
+        """Return a list of all messages available now."""
+        messages = []
+        while True:
+            data = self.read()
+            if data is None:
+                return messages
+            messages.append(data)
+    
+    def __skip_to(self, count):
+        self.__dropped += count - self.__read_count
+        self.__read_count = count
+    
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+
+__all__.append('RingReader')
@@ -22,14 +22,17 @@ TODO: This doesn't actually deserve its own module; it's just not clear where to
 
 from __future__ import absolute_import, division
 
-from collections import namedtuple
+from collections import deque, namedtuple
+import threading
 
 from twisted.internet import reactor as the_reactor
 from twisted.internet.interfaces import IReactorTime
+from twisted.python import log
 from zope.interface import Interface, implements
 
+from shinysdr.profiling import timed
 from shinysdr.types import bare_type_registry
-from shinysdr.values import CollectionState
+from shinysdr.values import CollectionState, ExportedState, exported_value
 
 
 __all__ = []  # appended later
@@ -169,6 +172,7 @@ class TelemetryStore(CollectionState):
         self.__time_source = IReactorTime(time_source)
     
     # not exported
+    @timed('telemetry_receive')
     def receive(self, message):
         """Store the supplied telemetry message object."""
         message = ITelemetryMessage(message)
@@ -204,3 +208,118 @@ class TelemetryStore(CollectionState):
 
 
 __all__.append('TelemetryStore')
+
+
+class TelemetryParsePipeline(ExportedState):
+    """
+    Parses raw telemetry input (lines, frames, etc.) on a worker thread and delivers the resulting messages to the reactor thread in batches.
+    
+    The worker is a dedicated daemon thread rather than one from the reactor's thread pool, since it lives as long as the pipeline does. The owner must call close() when done with the pipeline, or the thread will never exit.
+    
+    The input queue is bounded. If parsing or delivery falls behind, the oldest unparsed items are discarded (and counted), so that a burst of input costs telemetry freshness rather than reactor responsiveness. At most one batch is waiting on the reactor at any time.
+    
+    parse: function called on the worker thread with one submitted item, returning an iterable of ITelemetryMessage.
+    deliver: function called on the reactor thread with each parsed message.
+    """
+    
+    def __init__(self, parse, deliver, reactor=the_reactor, limit=1000, batch_size=100):
+        self.__parse = parse
+        self.__deliver = deliver
+        self.__reactor = reactor
+        self.__limit = limit
+        self.__batch_size = batch_size
+        
+        # guarded by __condition
+        self.__condition = threading.Condition()
+        self.__queue = deque()
+        self.__batch_in_flight = False
+        self.__alive = True
+        
+        # counters, written by one thread each
+        self.__dropped_count = 0  # submitting thread, under lock
+        self.__parsed_count = 0  # worker thread
+        self.__delivered_count = 0  # reactor thread
+        
+        self.__thread = threading.Thread(target=self.__run, name='TelemetryParsePipeline')
+        self.__thread.daemon = True
+        self.__thread.start()
+    
+    def submit(self, item):
+        """Queue an item for parsing. May be called from any thread."""
+        with self.__condition:
+            if not self.__alive:
+                return
+            queue = self.__queue
+            if len(queue) >= self.__limit:
+                queue.popleft()
+                self.__dropped_count += 1
+            queue.append(item)
+            self.__condition.notify()
+    
+    def close(self):
+        """Stop the worker thread. Items not yet delivered are discarded."""
+        with self.__condition:
+            self.__alive = False
+            self.__queue.clear()
+            self.__condition.notify()
+    
+    def is_closed(self):
+        return not self.__alive
+    
+    def __run(self):
+        # RUNS IN A SEPARATE THREAD.
+        condition = self.__condition
+        while True:
+            with condition:
+                # Backpressure: do not take more input until the reactor has consumed the previous batch, so that excess input piles up (and is dropped) here rather than in the reactor's queue.
+                while self.__alive and (self.__batch_in_flight or not self.__queue):
+                    condition.wait()
+                if not self.__alive:
+                    return
+                queue = self.__queue
+                items = [queue.popleft() for _ in xrange(min(len(queue), self.__batch_size))]
+            
+            messages = []
+            for item in items:
+                # pylint: disable=broad-except
+                try:
+                    messages.extend(self.__parse(item))
+                except Exception:
+                    log.err(None, 'Error parsing telemetry input %r' % (item,))
+            self.__parsed_count += len(items)
+            
+            if messages:
+                with condition:
+                    self.__batch_in_flight = True
+                self.__reactor.callFromThread(self.__deliver_batch, messages)
+    
+    def __deliver_batch(self, messages):
+        for message in messages:
+            # pylint: disable=broad-except
+            try:
+                self.__deliver(message)
+            except Exception:
+                log.err(None, 'Error delivering telemetry message %r' % (message,))
+        self.__delivered_count += len(messages)
+        with self.__condition:
+            self.__batch_in_flight = False
+            self.__condition.notify()
+    
+    @exported_value(type=int)
+    def get_queue_length(self):
+        return len(self.__queue)
+    
+    @exported_value(type=int)
+    def get_parsed_count(self):
+        return self.__parsed_count
+    
+    @exported_value(type=int)
+    def get_delivered_count(self):
+        return self.__delivered_count
+    
+    @exported_value(type=int)
+    def get_dropped_count(self):
+        return self.__dropped_count
+
+
+__all__.append('TelemetryParsePipeline')
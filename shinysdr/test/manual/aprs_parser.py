@@ -19,10 +19,13 @@
 
 """
 Test for APRS parser. Accepts lines and prints the parsed form.
+
+With --benchmark, instead parses the lines (a recorded corpus, e.g. captured from APRS-IS) repeatedly and reports throughput.
 """
 
 from __future__ import absolute_import, division
 
+import argparse
 import string
 import sys
 import time
@@ -30,8 +33,8 @@ import time
 from shinysdr.plugins import aprs
 
 
-if __name__ == '__main__':
-    for line in sys.stdin:
+def print_parsed(lines):
+    for line in lines:
         print string.rstrip(line, '\n')
         parsed = aprs.parse_tnc2(line, time.time())
         for error in parsed.errors:
@@ -39,3 +42,55 @@ if __name__ == '__main__':
         for fact in parsed.facts:
             print '     ', fact
         print
+
+
+def benchmark(lines, repeat):
+    lines = [string.rstrip(line, '\r\n') for line in lines]
+    lines = [line for line in lines if line and not line.startswith('#')]  # skip blanks and APRS-IS server comments
+    if not lines:
+        print 'No packets in corpus.'
+        return
+    receive_time = time.time()
+    
+    t0 = time.time()
+    c0 = time.clock()
+    error_count = 0
+    for _ in xrange(repeat):
+        for line in lines:
+            if aprs.parse_tnc2(line, receive_time).errors:
+                error_count += 1
+    c1 = time.clock()
+    t1 = time.time()
+    
+    count = len(lines) * repeat
+    print '%i packets (%i distinct) parsed in %.3f s (%.3f CPU-seconds)' % (count, len(lines), t1 - t0, c1 - c0)
+    print '%.0f packets per second' % (count / max(t1 - t0, 1e-9),)
+    print '%.1f%% of packets had parse errors' % (100 * error_count / count,)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('--benchmark', action='store_true',
+        help='measure parsing throughput instead of printing parse results')
+    parser.add_argument('--repeat', type=int, default=10, metavar='N',
+        help='number of passes over the corpus when benchmarking (default %(default)s)')
+    parser.add_argument('files', nargs='*', metavar='FILE',
+        help='TNC2-format lines to parse (default: standard input)')
+    args = parser.parse_args(args=argv[1:])
+    
+    lines = []
+    if args.files:
+        for path in args.files:
+            with open(path, 'r') as f:
+                lines.extend(f)
+    else:
+        lines = sys.stdin
+    
+    if args.benchmark:
+        benchmark(list(lines), args.repeat)
+    else:
+        print_parsed(lines)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
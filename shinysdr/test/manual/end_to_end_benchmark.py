@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end benchmark of a Top with an unthrottled SimulatedDevice, receivers of several modes, and simulated state-stream and audio clients.
+
+The signal is generated as fast as the receivers can consume it, so the sample rate achieved is the measure of DSP cost. Results are written as a JSON object so that runs of different versions can be compared; for example:
+    
+    python shinysdr/test/manual/end_to_end_benchmark.py --receivers 1 --clients 2 --duration 10 --output results.json
+"""
+
+from __future__ import absolute_import, division
+
+import argparse
+import json
+import sys
+import time
+
+import numpy
+
+from twisted.internet import defer
+from twisted.internet import task
+from zope.interface import implements  # available via Twisted
+
+from gnuradio import gr
+
+from shinysdr.devices import Device, IRXDriver
+from shinysdr.plugins.simulate import SimulatedDevice
+from shinysdr.profiling import get_histogram
+from shinysdr.top import Top
+from shinysdr.values import ExportedState
+from shinysdr.web import AudioStreamInner, StateStreamInner
+
+
+# mode, and the frequency of the simulated signal suited to it
+_modes = [
+    ('AM', 10e3),
+    ('NFM', 30e3),
+    ('WFM', 0.0),  # no simulated broadcast signal, so this gets the USB signal
+    ('USB', 0.0),
+    ('VOR', -30e3),
+    ('RTTY', 50e3),
+]
+
+
+class _CountingSink(gr.sync_block):
+    def __init__(self):
+        gr.sync_block.__init__(
+            self,
+            name=type(self).__name__,
+            in_sig=[numpy.complex64],
+            out_sig=None)
+        self.count = 0
+    
+    def work(self, input_items, output_items):
+        n = len(input_items[0])
+        self.count += n
+        return n
+
+
+class _CountingRXDriver(gr.hier_block2, ExportedState):
+    """Passes through another RX driver's output while counting the samples."""
+    implements(IRXDriver)
+    
+    def __init__(self, rx_driver):
+        gr.hier_block2.__init__(
+            self, type(self).__name__,
+            gr.io_signature(0, 0, 0),
+            gr.io_signature(1, 1, gr.sizeof_gr_complex))
+        self.__rx_driver = rx_driver
+        self.counter = _CountingSink()
+        self.connect(rx_driver, self)
+        self.connect(rx_driver, self.counter)
+    
+    def get_output_type(self):
+        return self.__rx_driver.get_output_type()
+    
+    def get_tune_delay(self):
+        return self.__rx_driver.get_tune_delay()
+    
+    def get_usable_bandwidth(self):
+        return self.__rx_driver.get_usable_bandwidth()
+    
+    def close(self):
+        self.__rx_driver.close()
+    
+    def notify_reconnecting_or_restarting(self):
+        self.__rx_driver.notify_reconnecting_or_restarting()
+
+
+class _ByteCounter(object):
+    def __init__(self):
+        self.count = 0
+    
+    def send(self, message):
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        self.count += len(message)
+
+
+def _summarize(values):
+    if not values:
+        return None
+    return {'mean': sum(values) / len(values), 'max': max(values), 'count': len(values)}
+
+
+def _snapshot(counting_driver, state_counter, audio_counter):
+    poller_histogram = get_histogram('poller_poll')
+    return {
+        'wall': time.time(),
+        'cpu': time.clock(),
+        'samples': counting_driver.counter.count,
+        'state_bytes': state_counter.count,
+        'audio_bytes': audio_counter.count,
+        'poll_count': poller_histogram.count,
+        'poll_total': poller_histogram.total,
+    }
+
+
+def _receiver_work_fractions(top):
+    diagnostics = top.get_diagnostics()
+    if not diagnostics.get_counters_enabled():
+        return {}
+    fractions = {}
+    for key, cell in diagnostics.get_groups().state().iteritems():
+        if key.startswith('receiver-'):
+            fractions[key[len('receiver-'):]] = cell.get().get_work_fraction()
+    return fractions
+
+
+@defer.inlineCallbacks
+def run_benchmark(reactor, receivers_per_mode, clients, duration, warmup, reconnects):
+    simulated = SimulatedDevice(throttle=False)
+    counting_driver = _CountingRXDriver(simulated.get_rx_driver())
+    top = Top(
+        devices={'sim': Device(
+            name='benchmark',
+            vfo_cell=simulated.get_vfo_cell(),
+            rx_driver=counting_driver)},
+        features={'stereo': True, 'perf_counters': True})
+    
+    add_receiver_times = []
+    for i in xrange(receivers_per_mode):
+        for mode, freq in _modes:
+            t0 = time.time()
+            top.add_receiver(mode, key='%s%i' % (mode.lower(), i), state={'rec_freq': freq})
+            add_receiver_times.append(time.time() - t0)
+    
+    state_counter = _ByteCounter()
+    audio_counter = _ByteCounter()
+    state_clients = [
+        StateStreamInner(state_counter.send, top, '/radio', lambda: None)
+        for _ in xrange(clients)]
+    audio_clients = [
+        AudioStreamInner(reactor, audio_counter.send, top, 44100)
+        for _ in xrange(clients)]
+    
+    yield task.deferLater(reactor, warmup, lambda: None)
+    
+    _receiver_work_fractions(top)  # start the rate measurement window
+    before = _snapshot(counting_driver, state_counter, audio_counter)
+    yield task.deferLater(reactor, duration, lambda: None)
+    after = _snapshot(counting_driver, state_counter, audio_counter)
+    work_fractions = _receiver_work_fractions(top)
+    
+    reconnect_times = []
+    for _ in xrange(reconnects):
+        t0 = time.time()
+        top._trigger_reconnect(u'benchmark')  # pylint: disable=protected-access
+        reconnect_times.append(time.time() - t0)
+    
+    for client in state_clients + audio_clients:
+        client.connectionLost(None)
+    top.close_all_devices()
+    
+    wall = after['wall'] - before['wall']
+    receiver_count = receivers_per_mode * len(_modes)
+    polls = after['poll_count'] - before['poll_count']
+    cpu_fraction = (after['cpu'] - before['cpu']) / wall
+    defer.returnValue({
+        'parameters': {
+            'receivers_per_mode': receivers_per_mode,
+            'modes': [mode for mode, _ in _modes],
+            'clients': clients,
+            'duration': duration,
+        },
+        'timestamp': time.time(),
+        'gnuradio_version': gr.version(),
+        'samples_per_second': (after['samples'] - before['samples']) / wall,
+        'process_cpu_fraction': cpu_fraction,
+        'process_cpu_fraction_per_receiver': cpu_fraction / receiver_count if receiver_count else None,
+        'receiver_work_fraction': work_fractions,
+        'add_receiver_seconds': _summarize(add_receiver_times),
+        'reconnect_seconds': _summarize(reconnect_times),
+        'poller_tick_seconds': {
+            'mean': (after['poll_total'] - before['poll_total']) / polls if polls else None,
+            'p50': get_histogram('poller_poll').percentile(0.5),
+            'p99': get_histogram('poller_poll').percentile(0.99),
+            'ticks_per_second': polls / wall,
+        },
+        'egress_bytes_per_second': {
+            'state': (after['state_bytes'] - before['state_bytes']) / wall,
+            'audio': (after['audio_bytes'] - before['audio_bytes']) / wall,
+        },
+    })
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--receivers', type=int, default=1, help='receivers of each mode')
+    parser.add_argument('--clients', type=int, default=1, help='state stream clients, and the same number of audio clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='measurement time in seconds')
+    parser.add_argument('--warmup', type=float, default=2.0, help='time in seconds to run before measuring')
+    parser.add_argument('--reconnects', type=int, default=5, help='number of timed flow graph reconnects')
+    parser.add_argument('--output', help='file to write the results to instead of standard output')
+    args = parser.parse_args(argv[1:])
+    
+    def go(reactor):
+        d = run_benchmark(reactor,
+            receivers_per_mode=args.receivers,
+            clients=args.clients,
+            duration=args.duration,
+            warmup=args.warmup,
+            reconnects=args.reconnects)
+        
+        def write(results):
+            text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+            if args.output:
+                with open(args.output, 'w') as f:
+                    f.write(text)
+            else:
+                sys.stdout.write(text)
+        
+        return d.addCallback(write)
+    
+    task.react(go)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load generator and benchmark for the state stream (OurStreamFactory, StateStreamInner, and the poller).
+
+Simulated clients, connected through in-memory transports, subscribe to an exported tree of many receiver-like objects and a telemetry store full of APRS stations, while the values in the tree change at a given rate. Results are written as a JSON object; for example:
+    
+    python shinysdr/test/manual/state_stream_benchmark.py --clients 4 --receivers 50 --stations 1000 --output results.json
+"""
+
+from __future__ import absolute_import, division
+
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from shinysdr.plugins.aprs import parse_tnc2
+from shinysdr.profiling import get_histogram
+from shinysdr.telemetry import TelemetryStore
+from shinysdr.types import Range
+from shinysdr.values import CollectionState, ExportedState, exported_block, exported_value, setter
+from shinysdr.web import OurStreamFactory
+
+
+class _FakeReceiver(ExportedState):
+    """Has about as many cells, of similar types, as a real Receiver."""
+    
+    def __init__(self, index):
+        self.rec_freq = 100e6 + index * 25e3
+        self.mode = u'NFM'
+        self.audio_gain = -6.0
+        self.audio_pan = 0.0
+        self.audio_power = -100.0
+        self.squelch_threshold = -65.0
+        self.always_on = False
+        self.is_valid = True
+    
+    @exported_value(type=float)
+    def get_rec_freq(self):
+        return self.rec_freq
+    
+    @setter
+    def set_rec_freq(self, value):
+        self.rec_freq = value
+    
+    @exported_value(type=unicode)
+    def get_mode(self):
+        return self.mode
+    
+    @exported_value(type=Range([(-30, 20)], strict=False))
+    def get_audio_gain(self):
+        return self.audio_gain
+    
+    @exported_value(type=Range([(-1, 1)], strict=False))
+    def get_audio_pan(self):
+        return self.audio_pan
+    
+    @exported_value(type=float)
+    def get_audio_power(self):
+        return self.audio_power
+    
+    @exported_value(type=Range([(-100, 0)], strict=False))
+    def get_squelch_threshold(self):
+        return self.squelch_threshold
+    
+    @exported_value(type=bool)
+    def get_always_on(self):
+        return self.always_on
+    
+    @exported_value(type=bool)
+    def get_is_valid(self):
+        return self.is_valid
+
+
+class _BenchmarkRoot(ExportedState):
+    def __init__(self, receivers, telemetry_store):
+        self.__receivers = CollectionState(receivers, dynamic=True)
+        self.__telemetry_store = telemetry_store
+    
+    @exported_block()
+    def get_receivers(self):
+        return self.__receivers
+    
+    @exported_block()
+    def get_telemetry_store(self):
+        return self.__telemetry_store
+
+
+_buffer_size = 65536  # same as twisted.internet.abstract.FileDescriptor.bufferSize
+
+
+class _MemoryWebSocketTransport(object):
+    """
+    Stands in for a txWS WebSocket transport, counting and decoding what is written.
+    
+    If bandwidth is nonzero, simulates a client which reads only that many bytes per second, pausing the registered producer as a TCP transport would.
+    """
+    
+    def __init__(self, location, bandwidth=0):
+        self.location = location
+        self.frames = 0
+        self.messages = 0
+        self.bytes = 0
+        self.closed = False
+        self.buffered = 0
+        self.max_buffered = 0
+        self.pauses = 0
+        self.__bandwidth = bandwidth
+        self.__producer = None
+        self.__paused = False
+        self.__last_drain = None
+    
+    def setBinaryMode(self, value):
+        pass
+    
+    def registerProducer(self, producer, streaming):
+        self.__producer = producer
+    
+    def unregisterProducer(self):
+        self.__producer = None
+    
+    def drain(self, now):
+        last_drain = self.__last_drain
+        self.__last_drain = now
+        if not self.__bandwidth or last_drain is None:
+            return
+        self.buffered = max(0, self.buffered - self.__bandwidth * (now - last_drain))
+        if self.__paused and self.buffered == 0:
+            self.__paused = False
+            self.__producer.resumeProducing()
+    
+    def write(self, data):
+        length = len(data.encode('utf-8') if isinstance(data, unicode) else data)
+        self.frames += 1
+        self.bytes += length
+        if self.__bandwidth:
+            self.buffered += length
+            self.max_buffered = max(self.max_buffered, self.buffered)
+            if self.buffered > _buffer_size and not self.__paused and self.__producer is not None:
+                self.__paused = True
+                self.pauses += 1
+                self.__producer.pauseProducing()
+        if isinstance(data, unicode):
+            self.messages += len(json.loads(data))
+        else:
+            # batch of length-prefixed records; see StateStreamInner._send1
+            offset = 0
+            while offset < len(data):
+                length, = struct.unpack_from('<I', data, offset)
+                offset += 4 + length
+                self.messages += 1
+    
+    def close(self, reason=None):
+        self.closed = True
+
+
+def _resident_bytes():
+    # Linux only; coarse, but per-object costs show up well enough when there are thousands of objects.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _per(delta, count):
+    if delta is None or not count:
+        return None
+    return delta / count
+
+
+def _aprs_line(index, receive_time):
+    # vary the position so that each message is a change
+    minutes = (receive_time * 7 + index) % 60
+    return 'N%iCALL>APRS,WIDE1-1:!42%05.2fN/071%05.2fW-benchmark' % (index, minutes, minutes)
+
+
+class _Churn(object):
+    def __init__(self, reactor, receivers, store, stations, rate):
+        self.__reactor = reactor
+        self.__receivers = receivers.values()
+        self.__store = store
+        self.__stations = stations
+        self.__rate = rate
+        self.__random = random.Random(0)
+        self.changes = 0
+    
+    def tick(self, interval):
+        count = int(self.__rate * interval)
+        now = self.__reactor.seconds()
+        for _ in xrange(count):
+            if self.__stations and self.__random.random() < 0.5:
+                self.__store.receive(parse_tnc2(_aprs_line(self.__random.randrange(self.__stations), now), now))
+            elif self.__receivers:
+                receiver = self.__random.choice(self.__receivers)
+                receiver.audio_power = self.__random.uniform(-100, 0)
+            self.changes += 1
+
+
+def _histogram_snapshot(name):
+    h = get_histogram(name)
+    return h.count, h.total
+
+
+def _histogram_delta(name, before):
+    h = get_histogram(name)
+    count = h.count - before[0]
+    total = h.total - before[1]
+    return {
+        'count': count,
+        'total_seconds': total,
+        'mean_seconds': total / count if count else None,
+        'p50_seconds': h.percentile(0.5),
+        'p99_seconds': h.percentile(0.99),
+        'max_seconds': h.max,
+    }
+
+
+@defer.inlineCallbacks
+def run_benchmark(reactor, clients, receiver_count, stations, churn_rate, duration, warmup, client_bandwidth=0):
+    memory_start = _resident_bytes()
+    store = TelemetryStore(time_source=reactor)
+    now = reactor.seconds()
+    for i in xrange(stations):
+        store.receive(parse_tnc2(_aprs_line(i, now), now))
+    for station in store.state().itervalues():
+        station.get().state()  # create the cells, as subscribing would
+    memory_stations = _resident_bytes()
+    receivers = {'r%i' % i: _FakeReceiver(i) for i in xrange(receiver_count)}
+    root = _BenchmarkRoot(receivers, store)
+    
+    factory = OurStreamFactory({None: root}, lambda: None)
+    transports = []
+    connect_start = time.clock()
+    for _ in xrange(clients):
+        protocol = factory.buildProtocol(None)
+        transport = _MemoryWebSocketTransport('/radio', bandwidth=client_bandwidth)
+        protocol.makeConnection(transport)
+        protocol.dataReceived('')  # clients send a dummy first message; see OurStreamProtocol
+        transports.append((protocol, transport))
+    connect_cpu = time.clock() - connect_start
+    memory_clients = _resident_bytes()
+    
+    churn = _Churn(reactor, receivers, store, stations, churn_rate)
+    churn_interval = 0.02
+    churn_loop = task.LoopingCall(churn.tick, churn_interval)
+    churn_loop.clock = reactor
+    churn_loop.start(churn_interval)
+    
+    def drain():
+        for _, transport in transports:
+            transport.drain(reactor.seconds())
+    
+    drain_loop = task.LoopingCall(drain)
+    drain_loop.clock = reactor
+    drain_loop.start(churn_interval)
+    
+    yield task.deferLater(reactor, warmup, lambda: None)
+    
+    histograms = ['poller_poll', 'state_stream_flush', 'serialize', 'telemetry_receive']
+    before = {name: _histogram_snapshot(name) for name in histograms}
+    before_frames = sum(t.frames for _, t in transports)
+    before_messages = sum(t.messages for _, t in transports)
+    before_bytes = sum(t.bytes for _, t in transports)
+    before_changes = churn.changes
+    t0 = time.time()
+    cpu0 = time.clock()
+    yield task.deferLater(reactor, duration, lambda: None)
+    wall = time.time() - t0
+    cpu = time.clock() - cpu0
+    
+    churn_loop.stop()
+    drain_loop.stop()
+    for protocol, _ in transports:
+        protocol.connectionLost(None)
+    
+    defer.returnValue({
+        'parameters': {
+            'clients': clients,
+            'client_bandwidth': client_bandwidth,
+            'receivers': receiver_count,
+            'stations': stations,
+            'churn_per_second': churn_rate,
+            'duration': duration,
+        },
+        'timestamp': time.time(),
+        'memory_bytes_per_station': _per(memory_stations - memory_start if memory_start else None, stations),
+        'memory_bytes_per_subscribed_station': _per(memory_clients - memory_stations if memory_stations else None, clients * stations),
+        'initial_subscribe_cpu_seconds_per_client': connect_cpu / clients if clients else None,
+        'changes_per_second': (churn.changes - before_changes) / wall,
+        'frames_per_second': (sum(t.frames for _, t in transports) - before_frames) / wall,
+        'messages_per_second': (sum(t.messages for _, t in transports) - before_messages) / wall,
+        'bytes_per_second': (sum(t.bytes for _, t in transports) - before_bytes) / wall,
+        'process_cpu_fraction': cpu / wall,
+        'latency': {name: _histogram_delta(name, before[name]) for name in histograms},
+        'dropped_connections': sum(1 for _, t in transports if t.closed),
+        'pauses': sum(t.pauses for _, t in transports),
+        'max_buffered_bytes': max([t.max_buffered for _, t in transports] or [0]),
+    })
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=4, help='number of state stream clients')
+    parser.add_argument('--receivers', type=int, default=50, help='number of receiver-like objects in the tree')
+    parser.add_argument('--stations', type=int, default=1000, help='number of APRS stations in the telemetry store')
+    parser.add_argument('--client-bandwidth', type=float, default=0, help='bytes per second each client reads; 0 for unlimited')
+    parser.add_argument('--churn', type=float, default=1000.0, help='value changes per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='measurement time in seconds')
+    parser.add_argument('--warmup', type=float, default=2.0, help='time in seconds to run before measuring')
+    parser.add_argument('--output', help='file to write the results to instead of standard output')
+    args = parser.parse_args(argv[1:])
+    
+    def go(reactor):
+        d = run_benchmark(reactor,
+            clients=args.clients,
+            receiver_count=args.receivers,
+            stations=args.stations,
+            churn_rate=args.churn,
+            duration=args.duration,
+            warmup=args.warmup,
+            client_bandwidth=args.client_bandwidth)
+        
+        def write(results):
+            text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+            if args.output:
+                with open(args.output, 'w') as f:
+                    f.write(text)
+            else:
+                sys.stdout.write(text)
+        
+        return d.addCallback(write)
+    
+    task.react(go)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
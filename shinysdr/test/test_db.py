@@ -178,6 +178,29 @@ class TestDirectory(unittest.TestCase):
         self.assertIn('Error opening database directory', str(diagnostics[0][1]))
 
 
+class TestFrequencyIndex(unittest.TestCase):
+    def test_lookup(self):
+        records = [
+            {u'type': u'channel', u'lowerFreq': 100e6, u'upperFreq': 100e6},
+            {u'type': u'band', u'lowerFreq': 90e6, u'upperFreq': 110e6},
+        ]
+        database = db.DatabaseModel(None, records)
+        index = db.FrequencyIndex([database, db.DatabaseModel(None, [
+            {u'type': u'channel', u'lowerFreq': 100.2e6, u'upperFreq': 100.2e6},
+        ])])
+        self.assertEqual(index.lookup(100.05e6, 1e6)[u'lowerFreq'], 100e6)
+        self.assertEqual(index.lookup(100.15e6, 1e6)[u'lowerFreq'], 100.2e6)
+        self.assertEqual(index.lookup(101e6, 0.1e6), None)
+        self.assertEqual(index.lookup(91e6, 0.1e6), None)  # bands are not matched
+        
+        records.append({u'type': u'channel', u'lowerFreq': 101e6, u'upperFreq': 101e6})
+        self.assertEqual(index.lookup(101e6, 0.1e6), records[2])
+        records[2][u'lowerFreq'] = records[2][u'upperFreq'] = 102e6
+        database.dirty()
+        self.assertEqual(index.lookup(101e6, 0.1e6), None)
+        self.assertEqual(index.lookup(102e6, 0.1e6), records[2])
+
+
 class TestDBWeb(unittest.TestCase):
     test_data_json = [
         {
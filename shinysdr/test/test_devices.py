@@ -82,9 +82,23 @@ class TestDevice(unittest.TestCase):
         d.set_transmitting(False, midpoint_hook)
         self.assertEqual(log, [(True, midpoint_hook), 'H', (False, midpoint_hook), 'H'])
     
+    def test_close_components(self):
+        component = _TestClosableComponent()
+        d = Device(components={'c': component, 'plain': ExportedState()})
+        d.close()
+        self.assertTrue(component.closed)
+    
     # TODO VFO tests
     # TODO components tests
-    # close() is tested in test_top
+    # close() is otherwise tested in test_top
+
+
+class _TestClosableComponent(ExportedState):
+    def __init__(self):
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
 
 
 class _TestRXDriver(ExportedState):
@@ -0,0 +1,107 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+import unittest
+
+from gnuradio import blocks
+from gnuradio import gr
+
+from shinysdr.diagnostics import Diagnostics, find_leaf_blocks, format_metrics
+from shinysdr.test.testutil import state_smoke_test
+
+
+class TestFormatMetrics(unittest.TestCase):
+    def test_format(self):
+        self.assertEqual(
+            format_metrics([
+                ('a_metric', {'group': 'receiver-a', 'block': 'x1'}, 1),
+                ('b_metric', {'block': 'q"\\'}, 0.5),
+            ]),
+            'a_metric{block="x1",group="receiver-a"} 1.0\n'
+            'b_metric{block="q\\"\\\\"} 0.5\n')
+    
+    def test_empty(self):
+        self.assertEqual(format_metrics([]), '')
+    
+    def test_families(self):
+        self.assertEqual(
+            format_metrics([
+                ('h_bucket', {'name': 'x', 'le': '+Inf'}, 2),
+                ('g', {}, 1),
+                ('h_count', {'name': 'x'}, 2),
+                ('h_bucket', {'name': 'y', 'le': '+Inf'}, 0),
+            ], families={
+                'h': ('histogram', 'Some durations.'),
+                'g': ('gauge', 'A level.'),
+            }),
+            '# HELP h Some durations.\n'
+            '# TYPE h histogram\n'
+            'h_bucket{le="+Inf",name="x"} 2.0\n'
+            'h_count{name="x"} 2.0\n'
+            'h_bucket{le="+Inf",name="y"} 0.0\n'
+            '# HELP g A level.\n'
+            '# TYPE g gauge\n'
+            'g{} 1.0\n')
+
+
+class _TestHierBlock(gr.hier_block2):
+    def __init__(self):
+        gr.hier_block2.__init__(
+            self, 'test',
+            gr.io_signature(1, 1, gr.sizeof_float),
+            gr.io_signature(1, 1, gr.sizeof_float))
+        self.__inner = _TestInnerBlock()
+        self.__multipliers = [blocks.multiply_const_ff(2), blocks.multiply_const_ff(3)]
+        self.connect(self, self.__inner, self.__multipliers[0], self.__multipliers[1], self)
+
+
+class _TestInnerBlock(gr.hier_block2):
+    def __init__(self):
+        gr.hier_block2.__init__(
+            self, 'test inner',
+            gr.io_signature(1, 1, gr.sizeof_float),
+            gr.io_signature(1, 1, gr.sizeof_float))
+        self.__block = blocks.add_const_ff(1)
+        self.connect(self, self.__block, self)
+
+
+class TestDiagnostics(unittest.TestCase):
+    def test_find_leaf_blocks(self):
+        found = find_leaf_blocks(_TestHierBlock())
+        self.assertEqual(
+            sorted(b.name() for b in found.itervalues()),
+            ['add_const_ff', 'multiply_const_ff', 'multiply_const_ff'])
+    
+    def test_disabled(self):
+        diagnostics = Diagnostics(get_roots=lambda: {'x': _TestHierBlock()}, counters_enabled=False)
+        diagnostics.rescan()
+        self.assertEqual(diagnostics.get_groups().state().keys(), [])
+        self.assertEqual(diagnostics.metric_rows(), [])
+    
+    def test_enabled(self):
+        roots = {'x': _TestHierBlock()}
+        diagnostics = Diagnostics(get_roots=lambda: roots, counters_enabled=True)
+        diagnostics.rescan()
+        group = diagnostics.get_groups().state()['x'].get()
+        self.assertEqual(len(group.get_blocks().state()), 3)
+        state_smoke_test(diagnostics)
+        self.assertEqual(len(diagnostics.metric_rows()), 3 * 5)
+        roots = {}
+        diagnostics.rescan()
+        self.assertEqual(diagnostics.get_groups().state().keys(), [])
@@ -0,0 +1,32 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+import numpy
+
+from twisted.trial import unittest
+
+from shinysdr.plugins.ghpsdr import _encode_alaw
+
+
+class TestEncodeAlaw(unittest.TestCase):
+    def test_values(self):
+        # reference values from G.711
+        self.assertEqual(
+            _encode_alaw(numpy.array([0.0, -1 / 4096, 1.0, -1.0, 2.0], dtype=numpy.float32)),
+            '\xd5\x55\xaa\x2a\xaa')
@@ -19,8 +19,10 @@ from __future__ import absolute_import, division
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 
-from shinysdr.plugins.hamlib import connect_to_rig, connect_to_rotator
+from shinysdr.plugins.hamlib import RIG_EPROTO, connect_to_rig, connect_to_rotator, _HamlibClientProtocol, _HamlibRig
 from shinysdr.test.testutil import state_smoke_test
 
 
@@ -92,3 +94,87 @@ class TestHamlibRotator(unittest.TestCase):
     def test_noop(self):
         """basic connect and disconnect, check is clean"""
         pass
+
+
+class TestHamlibClientProtocol(unittest.TestCase):
+    """Tests of command queueing which do not need a daemon."""
+    
+    def setUp(self):
+        self.protocol = _HamlibClientProtocol('test', defer.Deferred())
+        self.protocol._set_proxy(_StubProxy())
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+    
+    def __sent(self):
+        sent = self.transport.value()
+        self.transport.clear()
+        return sent
+    
+    def __respond(self, cmd, line=''):
+        self.protocol.dataReceived('%s: \n%sRPRT 0\n' % (cmd, line))
+    
+    def test_window_and_priority(self):
+        results = []
+        for cmd in ['get_freq', 'get_mode', 'get_dcd']:
+            self.protocol.rc_send(cmd, poll=True).addCallback(results.append)
+        self.protocol.rc_send('set_freq', '123').addCallback(results.append)
+        self.assertEqual(self.__sent(), '+\\get_freq \n+\\get_mode \n')
+        self.assertEqual(self.protocol.get_queue_depth(), 4)
+        
+        self.__respond('get_freq', 'Frequency: 1\n')
+        self.assertEqual(self.__sent(), '+\\set_freq 123\n')
+        self.__respond('get_mode')
+        self.__respond('set_freq')
+        self.assertEqual(self.__sent(), '+\\get_dcd \n')
+        self.__respond('get_dcd')
+        self.assertEqual(results, [0, 0, 0, 0])
+        self.assertEqual(self.protocol.get_queue_depth(), 0)
+    
+    def test_missing_response(self):
+        results = []
+        self.protocol.rc_send('get_freq').addCallback(results.append)
+        self.protocol.rc_send('get_mode').addCallback(results.append)
+        self.__respond('get_mode')
+        self.flushLoggedErrors()
+        self.assertEqual(results, [RIG_EPROTO, 0])
+        self.assertEqual(self.protocol.get_queue_depth(), 0)
+
+
+class TestHamlibSetCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.protocol = _HamlibClientProtocol('test', defer.Deferred())
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.rig = _HamlibRig(self.protocol)
+        self.sent = []
+        self.__respond_all()
+    
+    def tearDown(self):
+        self.protocol.connectionLost(Failure(Exception('test done')))
+    
+    def __respond_all(self):
+        while self.transport.value():
+            lines = self.transport.value().splitlines()
+            self.transport.clear()
+            for line in lines:
+                cmd = line.split(' ')[0][len('+\\'):]
+                self.sent.append(line[len('+\\'):].strip())
+                body = 'Frequency: 145000000\n' if cmd == 'get_freq' else ''
+                self.protocol.dataReceived('%s:\n%sRPRT 0\n' % (cmd, body))
+    
+    def test_last_write_wins(self):
+        del self.sent[:]
+        for freq in ['1', '2', '3']:
+            self.rig._ehs_set('Frequency', freq)
+        self.__respond_all()
+        self.assertEqual(
+            [command for command in self.sent if command.startswith('set_')],
+            ['set_freq 1', 'set_freq 3'])
+
+
+class _StubProxy(object):
+    def _clientReceived(self, command, key, value):
+        pass
+    
+    def _clientError(self, cmd, error_number):
+        pass
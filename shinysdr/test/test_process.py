@@ -0,0 +1,222 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+#
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+import errno
+import fcntl
+import gc
+import os
+
+import numpy
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import ProcessProtocol
+from twisted.trial import unittest
+
+from shinysdr.process import DecoderProcessPool, PipeWriter
+
+
+class TestDecoderProcessPool(unittest.TestCase):
+    timeout = 5
+    
+    def setUp(self):
+        self.pool = DecoderProcessPool(reactor=reactor)
+        self.fds = []
+    
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.pool.close_all()
+        yield _wait_for(lambda: self.pool.get_process_count() == 0)
+    
+    def __write(self, lease, data):
+        fd = lease.get_write_fd()
+        self.fds.append(fd)
+        os.write(fd, data)
+    
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        p1 = _Recorder()
+        lease = self.pool.acquire(['cat'], p1)
+        self.__write(lease, 'a\n')
+        yield _wait_for(lambda: p1.data == 'a\n')
+        lease.release()
+        self.assertEqual(self.pool.get_idle_count(), 1)
+        
+        p2 = _Recorder()
+        lease = self.pool.acquire(['cat'], p2)
+        self.__write(lease, 'b\n')
+        yield _wait_for(lambda: p2.data == 'b\n')
+        self.assertEqual(p1.data, 'a\n')
+        self.assertEqual(self.pool.get_spawn_count(), 1)
+        self.assertEqual(self.pool.get_reuse_count(), 1)
+    
+    @defer.inlineCallbacks
+    def test_concurrent_leases_are_separate(self):
+        self.pool.acquire(['cat'], _Recorder())
+        self.pool.acquire(['cat'], _Recorder())
+        self.assertEqual(self.pool.get_spawn_count(), 2)
+        self.assertEqual(self.pool.get_process_count(), 2)
+        yield None
+    
+    @defer.inlineCallbacks
+    def test_restart(self):
+        p = _Recorder()
+        # exits after the first line, but the pipe survives it
+        lease = self.pool.acquire(['sh', '-c', 'read x; echo "$x"; [ "$x" = a ] || exec cat'], p)
+        self.__write(lease, 'a\nb\n')
+        yield _wait_for(lambda: p.data == 'a\nb\n')
+        self.assertEqual(self.pool.get_spawn_count(), 2)
+        self.assertEqual(self.pool.get_restart_count(), 1)
+        self.assertTrue(self.pool.get_last_respawn_latency() > 0)
+        lease.release()
+    
+    @defer.inlineCallbacks
+    def test_release_when_collected(self):
+        owner = _Owner()
+        lease = self.pool.acquire(['cat'], _Recorder())
+        lease.release_when_collected(owner)
+        del lease
+        gc.collect()
+        self.assertEqual(self.pool.get_idle_count(), 0)
+        
+        del owner
+        gc.collect()
+        yield _wait_for(lambda: self.pool.get_idle_count() == 1)
+        self.assertEqual(self.pool.get_process_count(), 1)
+    
+    @defer.inlineCallbacks
+    def test_release_before_collected(self):
+        owner = _Owner()
+        lease = self.pool.acquire(['cat'], _Recorder())
+        lease.release_when_collected(owner)
+        lease.release()
+        self.assertEqual(self.pool.get_idle_count(), 1)
+        
+        # a later collection of the owner must not release the process again, now that it may be leased to someone else
+        lease = self.pool.acquire(['cat'], _Recorder())
+        self.assertEqual(self.pool.get_idle_count(), 0)
+        del owner
+        gc.collect()
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(self.pool.get_idle_count(), 0)
+        lease.release()
+
+
+class _Owner(object):
+    pass
+
+
+class _Recorder(ProcessProtocol):
+    def __init__(self):
+        self.data = ''
+    
+    def outReceived(self, data):
+        self.data += data
+
+
+@defer.inlineCallbacks
+def _wait_for(predicate):
+    while not predicate():
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+
+class TestPipeWriter(unittest.TestCase):
+    def setUp(self):
+        self.time = 0.0
+        self.pipe_capacity = _pipe_capacity()
+        self.read_fd, write_fd = os.pipe()
+        self.writer = PipeWriter(write_fd, item_size=4, coalesce_size=16, max_buffer_size=self.pipe_capacity, clock=lambda: self.time)
+    
+    def tearDown(self):
+        self.writer.close()
+        os.close(self.read_fd)
+    
+    def __read_all(self):
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.read_fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return ''.join(chunks)
+                raise
+            chunks.append(chunk)
+    
+    def test_coalesce(self):
+        self.writer.write('aaaa')
+        self.writer.write('bbbb')
+        self.assertEqual(self.__read_all(), '')
+        self.writer.write('cccc' * 2)
+        self.assertEqual(self.__read_all(), 'aaaabbbbcccccccc')
+        self.writer.write('dddd')
+        self.writer.flush()
+        self.assertEqual(self.__read_all(), 'dddd')
+    
+    def test_large_write_direct(self):
+        self.writer.write(numpy.arange(10, dtype=numpy.int32))
+        self.assertEqual(self.__read_all(), numpy.arange(10, dtype=numpy.int32).tostring())
+    
+    def test_full_pipe(self):
+        self.writer.write('x' * self.pipe_capacity)
+        self.assertEqual(self.writer.get_blocked_time(), 0.0)
+        self.writer.write('y' * 16)
+        self.time = 2.0
+        self.assertEqual(self.writer.get_blocked_time(), 2.0)
+        self.assertEqual(self.writer.get_buffer_fill(), 16 / self.pipe_capacity)
+        
+        self.assertEqual(self.__read_all(), 'x' * self.pipe_capacity)
+        self.time = 3.0
+        self.writer.flush()
+        self.time = 10.0
+        self.assertEqual(self.writer.get_blocked_time(), 3.0)
+        self.assertEqual(self.__read_all(), 'y' * 16)
+        self.assertEqual(self.writer.get_overrun_count(), 0)
+    
+    def test_overrun_drops_oldest_items(self):
+        self.writer.write('x' * self.pipe_capacity)
+        self.writer.write('abcd' * (self.pipe_capacity // 4))
+        self.assertEqual(self.writer.get_overrun_count(), 0)
+        self.writer.write('ef')
+        self.writer.write('gh')
+        self.assertEqual(self.writer.get_overrun_count(), 1)
+        self.assertEqual(self.writer.get_dropped_bytes(), 4)
+        
+        self.assertEqual(self.__read_all(), 'x' * self.pipe_capacity)
+        self.writer.flush()
+        self.assertEqual(self.__read_all(), 'abcd' * (self.pipe_capacity // 4 - 1) + 'efgh')
+
+
+def _pipe_capacity():
+    """Measure the capacity of a new pipe by filling one."""
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        total = 0
+        while True:
+            try:
+                total += os.write(write_fd, 'z' * 4096)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return total
+                raise
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
@@ -0,0 +1,143 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+import threading
+import time
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from shinysdr.profiling import LatencyHistogram, LoopLagProbe, format_stacks, get_histogram, sample_stacks, timed
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_empty(self):
+        h = LatencyHistogram()
+        self.assertEqual(h.count, 0)
+        self.assertEqual(h.percentile(0.5), 0.0)
+    
+    def test_percentiles(self):
+        h = LatencyHistogram()
+        for _ in xrange(98):
+            h.record(0.000010)  # 10 us, in the bucket below 16 us
+        h.record(0.5)
+        h.record(1.0)
+        self.assertEqual(h.count, 100)
+        self.assertAlmostEqual(h.total, 1.5 + 98 * 0.00001)
+        self.assertEqual(h.max, 1.0)
+        self.assertEqual(h.percentile(0.5), 16e-6)
+        self.assertEqual(h.percentile(0.99), 2 ** 19 / 1e6)
+        self.assertEqual(h.percentile(1.0), 1.0)  # limited by max
+    
+    def test_huge(self):
+        h = LatencyHistogram()
+        h.record(1e9)
+        self.assertEqual(h.percentile(0.5), 1e9)
+    
+    def test_recent_window(self):
+        time = [0.0]
+        h = LatencyHistogram(interval=10, clock=lambda: time[0])
+        h.record(1.0)
+        self.assertEqual(h.percentile(0.5), 1.0)
+        self.assertEqual(h.recent_max(), 1.0)
+        time[0] = 15  # first interval is now the previous one
+        h.record(0.000010)
+        self.assertEqual(h.percentile(1.0), 1.0)
+        self.assertEqual(h.percentile(0.5), 16e-6)
+        time[0] = 25  # first interval has left the window
+        self.assertEqual(h.percentile(1.0), 0.00001)  # limited by max
+        self.assertEqual(h.recent_max(), 0.00001)
+        time[0] = 100  # idle for more than an interval
+        self.assertEqual(h.percentile(0.5), 0.0)
+        self.assertEqual(h.recent_max(), 0.0)
+        # cumulative values are unaffected
+        self.assertEqual(h.count, 2)
+        self.assertEqual(h.max, 1.0)
+    
+    def test_cumulative_buckets(self):
+        h = LatencyHistogram()
+        h.record(0.000010)
+        h.record(0.000010)
+        h.record(0.5)
+        h.record(1e9)
+        buckets = h.cumulative_buckets()
+        self.assertEqual(buckets[0], (1e-6, 0))
+        self.assertEqual(buckets[4], (16e-6, 2))
+        self.assertEqual(buckets[18], (2 ** 18 / 1e6, 2))
+        self.assertEqual(buckets[19], (2 ** 19 / 1e6, 3))
+        self.assertEqual(buckets[-1], (float('inf'), 4))
+        self.assertEqual([count for _, count in buckets], sorted(count for _, count in buckets))
+
+
+class TestTimed(unittest.TestCase):
+    def test_timed(self):
+        histogram = get_histogram('_test_timed')
+        before = histogram.count
+        
+        @timed('_test_timed')
+        def f(x):
+            if x is None:
+                raise ValueError()
+            return x + 1
+        
+        self.assertEqual(f(1), 2)
+        self.assertRaises(ValueError, lambda: f(None))
+        self.assertEqual(histogram.count, before + 2)
+        self.assertEqual(f.__name__, 'f')
+
+
+class TestLoopLagProbe(unittest.TestCase):
+    def test_lag(self):
+        clock = task.Clock()
+        histogram = get_histogram('reactor_lag')
+        before_count = histogram.count
+        probe = LoopLagProbe(clock, interval=0.1)
+        probe.start()
+        clock.advance(0.1)
+        clock.advance(0.35)  # late by 0.25
+        self.assertEqual(histogram.count, before_count + 2)
+        self.assertGreaterEqual(histogram.max, 0.2)
+        probe.stop()
+        clock.advance(1)
+        self.assertEqual(histogram.count, before_count + 2)
+
+
+class TestSampleStacks(unittest.TestCase):
+    def test_sample(self):
+        stop = []
+        
+        def busy_function_for_test():
+            while not stop:
+                time.sleep(0.001)
+        
+        t = threading.Thread(target=busy_function_for_test, name='test_thread')
+        t.start()
+        try:
+            counts = sample_stacks(0.05, interval=0.005)
+        finally:
+            stop.append(True)
+            t.join()
+        self.assertTrue(any(
+            thread_name == 'test_thread' and stack[-1][2] == 'busy_function_for_test'
+            for thread_name, stack in counts))
+        text = format_stacks(counts)
+        self.assertIn('busy_function_for_test', text)
+    
+    def test_format_empty(self):
+        self.assertEqual(format_stacks({}), 'No samples.\n')
@@ -0,0 +1,83 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+from twisted.trial import unittest
+
+from shinysdr.receiver import DemodulatorPool
+
+
+class TestDemodulatorPool(unittest.TestCase):
+    def test_take(self):
+        pool = DemodulatorPool(2)
+        pool.put(('NFM', 48000), 'demod', 'facet')
+        self.assertEqual(pool.take(('NFM', 96000)), None)
+        self.assertEqual(pool.take(('NFM', 48000)), ('demod', 'facet'))
+        self.assertEqual(pool.take(('NFM', 48000)), None)
+    
+    def test_lru_eviction(self):
+        pool = DemodulatorPool(2)
+        pool.put('a', 'A', 'fa')
+        pool.put('b', 'B', 'fb')
+        pool.put('a', 'A2', 'fa2')  # refreshes 'a'
+        pool.put('c', 'C', 'fc')
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.take('b'), None)
+        self.assertEqual(pool.take('a'), ('A2', 'fa2'))
+        self.assertEqual(pool.take('c'), ('C', 'fc'))
+    
+    def test_disabled(self):
+        pool = DemodulatorPool(0)
+        pool.put('a', 'A', 'fa')
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.take('a'), None)
+    
+    def test_discard(self):
+        pool = DemodulatorPool(3)
+        pool.put('a', 'A', 'fa')
+        pool.put('b', 'B', 'fb')
+        pool.discard('fa')
+        self.assertEqual(pool.take('a'), None)
+        self.assertEqual(pool.take('b'), ('B', 'fb'))
+    
+    def test_holds_and_clear(self):
+        pool = DemodulatorPool(1)
+        pool.put('a', 'A', 'fa')
+        self.assertTrue(pool.holds('A'))
+        pool.put('b', 'B', 'fb')  # evicts
+        self.assertFalse(pool.holds('A'))
+        pool.clear()
+        self.assertFalse(pool.holds('B'))
+        self.assertEqual(len(pool), 0)
+    
+    def test_closable_not_kept(self):
+        pool = DemodulatorPool(3)
+        a = _ClosableDemodulator()
+        pool.put('a', a, 'fa')
+        self.assertFalse(pool.holds(a))
+        self.assertEqual(pool.take('a'), None)
+        # the caller has not necessarily disconnected it yet, so closing it is left to the caller
+        self.assertFalse(a.closed)
+
+
+class _ClosableDemodulator(object):
+    def __init__(self):
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
@@ -0,0 +1,208 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, division
+
+import errno
+import json
+import os
+import os.path
+import Queue
+import shutil
+import tempfile
+import threading
+import unittest
+
+from shinysdr.recorder import BufferedFileWriter, RecordingFiles, _WriterThread
+
+
+class TestBufferedFileWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_buffering(self):
+        writer = BufferedFileWriter(self.path, buffer_size=4096)
+        expected = ''.join(chr(i % 256) for i in xrange(10000))
+        writer.write(expected[:3000])
+        self.assertEqual(os.path.getsize(self.path), 0)
+        writer.write(expected[3000:9000])
+        self.assertEqual(os.path.getsize(self.path), 9000)
+        writer.write(expected[9000:])
+        self.assertEqual(writer.tell(), 10000)
+        writer.close()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+    
+    def test_empty(self):
+        BufferedFileWriter(self.path).close()
+        self.assertEqual(os.path.getsize(self.path), 0)
+    
+    def test_disk_full(self):
+        if not os.path.exists('/dev/full'):
+            raise unittest.SkipTest('no /dev/full')
+        writer = BufferedFileWriter('/dev/full', buffer_size=16)
+        writer.write('x' * 8)
+        with self.assertRaises(OSError) as context:
+            writer.write('x' * 8)
+        self.assertEqual(context.exception.errno, errno.ENOSPC)
+        writer.close()  # pending data was discarded, so nothing more to fail
+
+
+class TestRecordingFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.time = 1000000000.0
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def __files(self, **kwargs):
+        return RecordingFiles(
+            directory=self.directory,
+            name='dev',
+            sample_rate=1000,
+            frequency=100e6,
+            metadata={'shinysdr:gain': 10},
+            clock=lambda: self.time,
+            **kwargs)
+    
+    def __metadata(self, data_path):
+        with open(data_path[:-len('data')] + 'meta') as f:
+            return json.load(f)
+    
+    def test_metadata(self):
+        files = self.__files()
+        files.write('\0' * 80)
+        self.time += 1
+        files.retune(101e6)
+        files.write('\0' * 16)
+        files.close()
+        self.assertEqual(len(files.paths), 1)
+        self.assertEqual(os.path.getsize(files.paths[0]), 96)
+        metadata = self.__metadata(files.paths[0])
+        self.assertEqual(metadata['global']['core:sample_rate'], 1000)
+        self.assertEqual(metadata['global']['shinysdr:gain'], 10)
+        self.assertEqual(metadata['captures'], [
+            {
+                'core:sample_start': 0,
+                'core:frequency': 100e6,
+                'core:datetime': '2001-09-09T01:46:40Z',
+            },
+            {
+                'core:sample_start': 10,
+                'core:frequency': 101e6,
+                'core:datetime': '2001-09-09T01:46:41Z',
+            },
+        ])
+    
+    def test_rotate_by_size(self):
+        files = self.__files(max_bytes=100)
+        for _ in xrange(3):
+            files.write('\0' * 80)
+            self.time += 1
+        files.close()
+        self.assertEqual(len(files.paths), 2)
+        self.assertEqual(files.total_bytes, 240)
+        self.assertEqual(
+            [os.path.getsize(path) for path in files.paths],
+            [160, 80])
+    
+    def test_rotate_by_time(self):
+        files = self.__files(max_seconds=10)
+        files.write('\0' * 8)
+        self.time += 5
+        files.write('\0' * 8)
+        self.time += 5
+        files.write('\0' * 8)
+        files.close()
+        self.assertEqual(len(files.paths), 2)
+        self.assertEqual(self.__metadata(files.paths[1])['captures'][0]['core:frequency'], 100e6)
+
+
+class TestWriterThread(unittest.TestCase):
+    def test_retune_after_backlog(self):
+        queue = _FakeMessageQueue()
+        files = _FakeRecordingFiles()
+        writer = _WriterThread(queue, files, failed=lambda: None)
+        queue.insert_tail(_FakeMessage('a'))
+        queue.insert_tail(_FakeMessage('b'))
+        writer.retune(101e6, 1000.0)
+        queue.insert_tail(_FakeMessage('c'))
+        queue.gate.set()
+        files.wait_for_writes(3)
+        writer.stop()
+        self.assertTrue(files.closed.wait(10))
+        self.assertEqual(files.log, ['a', 'b', (101e6, 1000.0), 'c'])
+
+
+class _FakeMessageQueue(object):
+    """Stands in for gr.msg_queue, which would need a running flow graph to fill it; delete_head waits until gate is set."""
+    def __init__(self):
+        self.gate = threading.Event()
+        self.__queue = Queue.Queue()
+    
+    def insert_tail(self, message):
+        self.__queue.put(message)
+    
+    def delete_head(self):
+        self.gate.wait()
+        return self.__queue.get()
+    
+    def count(self):
+        return self.__queue.qsize()
+    
+    def full_p(self):
+        return False
+
+
+class _FakeMessage(object):
+    def __init__(self, string):
+        self.__string = string
+    
+    def length(self):
+        return len(self.__string)
+    
+    def to_string(self):
+        return self.__string
+
+
+class _FakeRecordingFiles(object):
+    def __init__(self):
+        self.log = []
+        self.closed = threading.Event()
+        self.__condition = threading.Condition()
+    
+    def write(self, data):
+        with self.__condition:
+            self.log.append(data)
+            self.__condition.notify_all()
+    
+    def retune(self, frequency, timestamp):
+        self.log.append((frequency, timestamp))
+    
+    def close(self):
+        self.closed.set()
+    
+    def wait_for_writes(self, count):
+        with self.__condition:
+            while len([x for x in self.log if isinstance(x, str)]) < count:
+                self.__condition.wait(10)
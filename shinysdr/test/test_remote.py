@@ -0,0 +1,268 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, division
+
+import gc
+import struct
+
+from twisted.internet import task
+from twisted.trial import unittest
+from zope.interface import implements  # available via Twisted
+
+from shinysdr.remote import StateClient, StateServer, _Channel, _RemoteSplitter
+from shinysdr.shm import RingReader, RingWriter
+from shinysdr.types import BulkDataType
+from shinysdr.values import CollectionState, ExportedState, IWritableCollection, Poller, TextStreamCell, command, exported_block, exported_value, setter
+
+
+class _Loopback(object):
+    """Connects a StateServer and StateClient, delivering data only when flushed, as a pipe would later."""
+    
+    def __init__(self, root, note_dirty=lambda: None):
+        self.server_poller = Poller()
+        self.client_poller = Poller()
+        self.__to_client = []
+        self.__to_server = []
+        self.server_clock = task.Clock()
+        self.server = StateServer(
+            write=self.__to_client.append,
+            root_object=root,
+            note_dirty=note_dirty,
+            reactor=self.server_clock,
+            poller=self.server_poller)
+        self.client = StateClient(write=self.__to_server.append, reactor=task.Clock())
+        self.server.start()
+        self.flush()
+        self.root = self.client.when_ready().result
+    
+    def flush(self):
+        while self.__to_client or self.__to_server:
+            to_client, self.__to_client[:] = self.__to_client[:], []
+            to_server, self.__to_server[:] = self.__to_server[:], []
+            for data in to_client:
+                self.client.data_received(data)
+            for data in to_server:
+                self.server.data_received(data)
+    
+    def poll(self):
+        """Poll the server, deliver its messages, and poll the client."""
+        self.server_poller.poll()
+        self.flush()
+        self.client_poller.poll()
+
+
+class TestRemoteState(unittest.TestCase):
+    def setUp(self):
+        self.dirty = []
+        self.real = RemoteSpecimen()
+        self.loopback = _Loopback(self.real, note_dirty=lambda: self.dirty.append(True))
+        self.proxy = self.loopback.root
+    
+    def test_description(self):
+        self.assertEqual(self.proxy.state_description(), self.real.state_description())
+    
+    def test_set(self):
+        self.proxy.state()['value'].set(5)
+        self.assertEqual(self.proxy.state()['value'].get(), 5, 'optimistic')
+        self.loopback.flush()
+        self.assertEqual(self.real.get_value(), 5)
+    
+    def test_set_corrected(self):
+        self.proxy.state()['value'].set(-1)
+        self.loopback.flush()
+        self.assertEqual(self.real.get_value(), 0)
+        self.assertEqual(self.proxy.state()['value'].get(), 0)
+    
+    def test_subscription(self):
+        cell = self.proxy.state()['value']
+        fired = []
+        subscription = self.loopback.client_poller.subscribe(cell, fired.append)
+        self.loopback.flush()
+        self.real.set_value(7)
+        self.loopback.poll()
+        self.assertEqual(fired, [7])
+        
+        subscription.unsubscribe()
+        self.loopback.flush()
+        self.real.set_value(8)
+        self.loopback.poll()
+        self.assertEqual(cell.get(), 7, 'not polled when not subscribed')
+    
+    def test_block(self):
+        child_proxy = self.proxy.state()['child'].get()
+        self.assertTrue(self.proxy.state()['child'].isBlock())
+        child_proxy.state()['value'].set(3)
+        self.loopback.flush()
+        self.assertEqual(self.real.get_child().get_value(), 3)
+    
+    def test_command(self):
+        self.proxy.state()['poke'].set(None)
+        self.loopback.flush()
+        self.assertEqual(self.real.pokes, 1)
+    
+    def test_note_dirty(self):
+        self.loopback.client.note_dirty()
+        self.loopback.flush()
+        self.assertEqual(self.dirty, [True])
+    
+    def test_state_subscription_count(self):
+        subscription = self.loopback.client_poller.subscribe_state(self.proxy, lambda state: None)
+        self.loopback.flush()
+        self.assertEqual(self.real.counts, [1])
+        subscription.unsubscribe()
+        self.loopback.flush()
+        self.assertEqual(self.real.counts, [1, 0])
+    
+    def test_text_stream(self):
+        received = []
+        self.loopback.client_poller.subscribe(self.proxy.state()['text'], received.append)
+        self.loopback.flush()
+        self.real.chunks.append(u'abc')
+        self.loopback.poll()
+        self.real.chunks.append(u'de')
+        self.loopback.poll()
+        self.assertEqual(received, [u'abc', u'de'])
+        self.assertEqual(self.proxy.state()['text'].get(), u'abcde')
+
+
+class TestRemoteCollection(unittest.TestCase):
+    def setUp(self):
+        self.real = RemoteCollectionSpecimen()
+        self.loopback = _Loopback(self.real)
+        self.proxy = self.loopback.root
+    
+    def test_interfaces(self):
+        self.assertTrue(IWritableCollection.providedBy(self.proxy))
+    
+    def test_create_delete(self):
+        states = []
+        self.loopback.client_poller.subscribe_state(self.proxy, states.append)
+        self.loopback.flush()
+        self.loopback.client_poller.poll()
+        self.assertEqual(states[-1].keys(), [])
+        
+        d = self.proxy.create_child({u'value': 4})
+        self.loopback.flush()
+        self.assertEqual(self.successResultOf(d), u'a')
+        self.loopback.poll()
+        self.assertEqual(states[-1].keys(), [u'a'])
+        self.assertEqual(states[-1][u'a'].get().state()['value'].get(), 4)
+        
+        self.proxy.delete_child(u'a')
+        self.loopback.flush()
+        gc.collect()
+        self.loopback.server_clock.advance(0)  # forgetting the object is deferred
+        self.loopback.poll()
+        self.assertEqual(states[-1].keys(), [])
+
+
+class TestChannel(unittest.TestCase):
+    def test_split_messages(self):
+        data = []
+        received = []
+        sender = _Channel(data.append, None)
+        receiver = _Channel(None, received.append)
+        sender.send([u'a', u'x' * 1000])
+        sender.send([u'b'])
+        for byte in ''.join(data):
+            receiver.data_received(byte)
+        self.assertEqual(received, [[u'a', u'x' * 1000], [u'b']])
+
+
+class TestRemoteSplitter(unittest.TestCase):
+    def setUp(self):
+        self.ring = RingWriter(slot_count=4, slot_size=64)
+        self.reader = RingReader(self.ring.path)
+        self.splitter = _RemoteSplitter(_SplitterClientStub(self.reader), 1, BulkDataType(info_format='d', array_format='b'))
+    
+    def tearDown(self):
+        self.reader.close()
+        self.ring.close()
+    
+    def test_get(self):
+        frame = struct.pack('d', 1.5) + '\x01\xff'
+        self.ring.write(frame)
+        self.ring.write(frame)
+        self.assertEqual(self.splitter.get(), ((1.5,), [1, -1]))
+        self.assertEqual(self.splitter.get(binary=True), frame)
+        self.assertEqual(self.splitter.get(), None)
+
+
+class _SplitterClientStub(object):
+    def __init__(self, reader):
+        self.__reader = reader
+    
+    def _get_reader(self, stream_id):
+        return self.__reader
+
+
+class RemoteSpecimen(ExportedState):
+    """Helper for TestRemoteState"""
+    def __init__(self, value=0, child=True):
+        self.__value = value
+        self.__child = RemoteSpecimen(child=False) if child else ExportedState()
+        self.counts = []
+        self.pokes = 0
+        self.chunks = []
+    
+    def state_def(self, callback):
+        super(RemoteSpecimen, self).state_def(callback)
+        callback(TextStreamCell('text', self.__take_chunks))
+    
+    def state_subscription_count_changed(self, count):
+        self.counts.append(count)
+    
+    def __take_chunks(self):
+        text = u''.join(self.chunks)
+        self.chunks[:] = []
+        return text
+    
+    @exported_value(type=int)
+    def get_value(self):
+        return self.__value
+    
+    @setter
+    def set_value(self, value):
+        # ignore invalid values, to test correction
+        if value >= 0:
+            self.__value = value
+    
+    @exported_block()
+    def get_child(self):
+        return self.__child
+    
+    @command()
+    def poke(self):
+        self.pokes += 1
+
+
+class RemoteCollectionSpecimen(CollectionState):
+    """Helper for TestRemoteCollection"""
+    implements(IWritableCollection)
+    
+    def __init__(self):
+        CollectionState.__init__(self, {}, dynamic=True)
+    
+    def create_child(self, desc):
+        key = unicode(chr(ord('a') + len(self._collection)))
+        self._collection[key] = RemoteSpecimen(value=desc[u'value'], child=False)
+        return key
+    
+    def delete_child(self, key):
+        del self._collection[key]
@@ -0,0 +1,117 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from shinysdr.plugins.replay import FileDevice, MappedSampleReader, read_sigmf_metadata
+from shinysdr.recorder import RecordingFiles
+from shinysdr.test.testutil import DeviceTestCase
+
+
+class TestMappedSampleReader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+        self.samples = (numpy.arange(10) + 1j * numpy.arange(10)).astype(numpy.complex64)
+        self.samples.tofile(self.path)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_loop(self):
+        reader = MappedSampleReader(self.path, loop=True)
+        self.assertEqual(reader.get_length(), 10)
+        out = numpy.zeros(25, dtype=numpy.complex64)
+        self.assertEqual(reader.read_into(out), 25)
+        numpy.testing.assert_array_equal(out, numpy.concatenate([self.samples, self.samples, self.samples[:5]]))
+        self.assertEqual(reader.tell(), 5)
+    
+    def test_no_loop(self):
+        reader = MappedSampleReader(self.path, loop=False)
+        out = numpy.zeros(8, dtype=numpy.complex64)
+        self.assertEqual(reader.read_into(out), 8)
+        self.assertEqual(reader.read_into(out), 2)
+        numpy.testing.assert_array_equal(out[:2], self.samples[8:])
+        self.assertEqual(reader.read_into(out), 0)
+    
+    def test_seek(self):
+        reader = MappedSampleReader(self.path, loop=False)
+        reader.seek(7)
+        self.assertEqual(reader.tell(), 7)
+        out = numpy.zeros(8, dtype=numpy.complex64)
+        self.assertEqual(reader.read_into(out), 3)
+        numpy.testing.assert_array_equal(out[:3], self.samples[7:])
+        reader.seek(100)
+        self.assertEqual(reader.tell(), 10)
+    
+    def test_cu8(self):
+        numpy.array([0, 255, 255, 0], dtype=numpy.uint8).tofile(self.path)
+        reader = MappedSampleReader(self.path, datatype='cu8')
+        out = numpy.zeros(2, dtype=numpy.complex64)
+        reader.read_into(out)
+        numpy.testing.assert_array_equal(out, [-1 + 1j, 1 - 1j])
+    
+    def test_bad_datatype(self):
+        self.assertRaises(ValueError, lambda: MappedSampleReader(self.path, datatype='foo'))
+
+
+class TestSigMFMetadata(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_from_recording(self):
+        files = RecordingFiles(
+            directory=self.directory,
+            name='dev',
+            sample_rate=48000,
+            frequency=100e6,
+            metadata={},
+            clock=lambda: 0.0)
+        files.write(numpy.zeros(4, dtype=numpy.complex64).tostring())
+        files.close()
+        metadata = read_sigmf_metadata(files.paths[0])
+        self.assertEqual(metadata['sample_rate'], 48000)
+        self.assertEqual(metadata['frequency'], 100e6)
+        self.assertIn(metadata['datatype'], ['cf32_le', 'cf32_be'])
+    
+    def test_missing(self):
+        self.assertEqual(read_sigmf_metadata(os.path.join(self.directory, 'raw')), {})
+
+
+class TestFileDevice(DeviceTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'data')
+        numpy.zeros(100, dtype=numpy.complex64).tofile(path)
+        super(TestFileDevice, self).setUpFor(
+            device=FileDevice(path, sample_rate=1000, freq=10e6, throttle=False))
+    
+    def tearDown(self):
+        super(TestFileDevice, self).tearDown()
+        shutil.rmtree(self.directory)
+    
+    # Test methods provided by DeviceTestCase
@@ -0,0 +1,129 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+import numpy
+
+from shinysdr.db import DatabaseModel, FrequencyIndex
+from shinysdr.scanner import Scanner, find_peaks
+from shinysdr.values import CollectionState, ExportedState, exported_value, setter
+
+
+class TestFindPeaks(unittest.TestCase):
+    def test_no_signal(self):
+        noise_floor, bins, levels = find_peaks([-100] * 10, 10)
+        self.assertEqual(noise_floor, -100)
+        self.assertEqual(list(bins), [])
+        self.assertEqual(list(levels), [])
+    
+    def test_runs(self):
+        spectrum = [-100] * 20
+        spectrum[0] = -50  # at edge
+        spectrum[5:8] = [-80, -60, -70]
+        spectrum[12:15] = [-40, -40, -85]  # tie takes first
+        spectrum[19] = -95  # below threshold
+        noise_floor, bins, levels = find_peaks(spectrum, 10)
+        self.assertEqual(noise_floor, -100)
+        self.assertEqual(list(bins), [0, 6, 12])
+        self.assertEqual(list(levels), [-50, -60, -40])
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.top = _StubTop()
+        self.scanner = Scanner(top=self.top, hold_time=1, max_receivers=2, mode=u'AM', reactor=self.clock)
+    
+    def __scan(self, *signal_bins):
+        # 100 bins of 1 kHz each, centered on 1 MHz, in unshifted order as the monitor produces
+        spectrum = numpy.full(100, -100, dtype=numpy.float32)
+        for i in signal_bins:
+            spectrum[i] = -50
+        self.scanner._scan(numpy.fft.ifftshift(spectrum), center_freq=1e6, sample_rate=100e3, analytic=True)
+    
+    def __freqs(self):
+        return sorted(r.get_rec_freq() for r in self.top.receivers_dict.itervalues())
+    
+    def test_create_retune_delete(self):
+        self.__scan(60, 80)
+        self.assertEqual(self.__freqs(), [1.01e6, 1.03e6])
+        self.assertEqual(self.scanner.get_signal_count(), 2)
+        self.assertEqual(self.top.receivers_dict.values()[0].mode, u'AM')
+        self.assertFalse(self.top.receivers_dict.values()[0].persists)
+        
+        self.clock.advance(0.5)
+        self.__scan(64, 80)
+        self.assertEqual(self.__freqs(), [1.014e6, 1.03e6])
+        
+        self.clock.advance(1.1)
+        self.__scan(64)
+        self.assertEqual(self.__freqs(), [1.014e6])
+    
+    def test_max_receivers(self):
+        self.__scan(10, 30, 60)
+        self.assertEqual(len(self.top.receivers_dict), 2)
+    
+    def test_ignore_dc_and_user_receivers(self):
+        self.top.add_receiver(u'USB', state={u'rec_freq': 1.02e6})
+        self.__scan(50, 70)
+        self.assertEqual(len(self.top.receivers_dict), 1)
+        self.assertEqual(self.scanner.get_signal_count(), 1)
+    
+    def test_database(self):
+        index = FrequencyIndex([DatabaseModel(None, [
+            {u'type': u'channel', u'lowerFreq': 1.0203e6, u'upperFreq': 1.0203e6, u'mode': u'NFM'},
+        ])])
+        scanner = Scanner(top=self.top, frequency_index=index, mode=u'AM', reactor=self.clock)
+        scanner._scan(numpy.fft.ifftshift([-100] * 70 + [-50] + [-100] * 29), center_freq=1e6, sample_rate=100e3, analytic=True)
+        [receiver] = self.top.receivers_dict.values()
+        self.assertEqual(receiver.get_rec_freq(), 1.0203e6)
+        self.assertEqual(receiver.mode, u'NFM')
+
+
+class _StubTop(object):
+    def __init__(self):
+        self.receivers_dict = {}
+        self.receivers = CollectionState(self.receivers_dict, dynamic=True)
+        self.__counter = 0
+    
+    def add_receiver(self, mode, key=None, state=None, persists=True):
+        key = unicode(self.__counter)
+        self.__counter += 1
+        self.receivers_dict[key] = receiver = _StubReceiver(mode, state[u'rec_freq'])
+        receiver.persists = persists
+        return key, receiver
+    
+    def delete_receiver(self, key):
+        del self.receivers_dict[key]
+
+
+class _StubReceiver(ExportedState):
+    def __init__(self, mode, freq):
+        self.mode = mode
+        self.__freq = freq
+    
+    @exported_value(type=float)
+    def get_rec_freq(self):
+        return self.__freq
+    
+    @setter
+    def set_rec_freq(self, value):
+        self.__freq = value
@@ -0,0 +1,74 @@
+# Copyright 2016 Kevin Reid <kpreid@switchb.org>
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, division
+
+import os.path
+import unittest
+
+from shinysdr.shm import RingReader, RingWriter
+
+
+class TestRing(unittest.TestCase):
+    def setUp(self):
+        self.writer = RingWriter(slot_count=4, slot_size=16)
+        self.reader = RingReader(self.writer.path)
+    
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+    
+    def test_empty(self):
+        self.assertEqual(self.reader.read(), None)
+    
+    def test_in_order(self):
+        self.writer.write('a')
+        self.writer.write('')
+        self.writer.write('c' * 16)
+        self.assertEqual(self.reader.read_all(), ['a', '', 'c' * 16])
+        self.assertEqual(self.reader.read(), None)
+        self.assertEqual(self.reader.get_dropped(), 0)
+    
+    def test_wraparound(self):
+        for i in xrange(10):
+            self.writer.write(str(i))
+            self.assertEqual(self.reader.read(), str(i))
+        self.assertEqual(self.reader.get_dropped(), 0)
+    
+    def test_overrun(self):
+        for i in xrange(10):
+            self.writer.write(str(i))
+        self.assertEqual(self.reader.read_all(), ['6', '7', '8', '9'])
+        self.assertEqual(self.reader.get_dropped(), 6)
+    
+    def test_too_big(self):
+        self.assertRaises(ValueError, lambda: self.writer.write('x' * 17))
+    
+    def test_file_removed(self):
+        self.assertFalse(os.path.exists(self.writer.path))
+        self.writer.write('a')
+        self.assertEqual(self.reader.read(), 'a')
+    
+    def test_not_a_ring(self):
+        writer = RingWriter(slot_count=4, slot_size=16)
+        with open(writer.path, 'r+b') as f:
+            f.write('XXXX')
+        self.assertRaises(ValueError, lambda: RingReader(writer.path))
+        self.assertTrue(os.path.exists(writer.path))
+        writer.close()
+        self.assertFalse(os.path.exists(writer.path))
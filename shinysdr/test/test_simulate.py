@@ -27,3 +27,11 @@ class TestSimulatedDevice(DeviceTestCase):
             device=SimulatedDevice())
 
     # Test methods provided by DeviceTestCase
+
+
+class TestSimulatedDeviceUnthrottled(DeviceTestCase):
+    def setUp(self):
+        super(TestSimulatedDeviceUnthrottled, self).setUpFor(
+            device=SimulatedDevice(throttle=False))
+
+    # Test methods provided by DeviceTestCase
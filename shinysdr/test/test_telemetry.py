@@ -17,11 +17,14 @@
 
 from __future__ import absolute_import, division
 
+import threading
+import time
+
 from twisted.internet.task import Clock
 from twisted.trial import unittest
 from zope.interface import implements
 
-from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject, TelemetryItem, TelemetryStore, Track, empty_track
+from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject, TelemetryItem, TelemetryParsePipeline, TelemetryStore, Track, empty_track
 
 
 class TestTrack(unittest.TestCase):
@@ -84,6 +87,94 @@ class TestTelemetryStore(unittest.TestCase):
         self.assertEqual([], self.store.state().keys())
     
 
+class TestTelemetryParsePipeline(unittest.TestCase):
+    def setUp(self):
+        self.reactor = _ThreadReactor()
+        self.delivered = []
+        self.pipeline = TelemetryParsePipeline(
+            parse=lambda item: [item, item + 'x'] if item != 'bad' else 1 / 0,
+            deliver=self.delivered.append,
+            reactor=self.reactor,
+            limit=3,
+            batch_size=2)
+    
+    def tearDown(self):
+        self.pipeline.close()
+    
+    def test_parse_and_deliver(self):
+        self.pipeline.submit('a')
+        self.reactor.run_until(lambda: len(self.delivered) >= 2)
+        self.assertEqual(self.delivered, ['a', 'ax'])
+        self.assertEqual(self.pipeline.get_parsed_count(), 1)
+        self.assertEqual(self.pipeline.get_delivered_count(), 2)
+        self.assertEqual(self.pipeline.get_dropped_count(), 0)
+    
+    def test_parse_error(self):
+        self.pipeline.submit('bad')
+        self.pipeline.submit('b')
+        self.reactor.run_until(lambda: len(self.delivered) >= 2)
+        self.assertEqual(self.delivered, ['b', 'bx'])
+        self.flushLoggedErrors(ZeroDivisionError)
+    
+    def test_drop_oldest_while_reactor_busy(self):
+        self.pipeline.submit('a')
+        # worker is now waiting for the first batch to be delivered
+        self.reactor.wait_for_call()
+        for item in ['b', 'c', 'd', 'e', 'f']:
+            self.pipeline.submit(item)
+        self.assertEqual(self.pipeline.get_queue_length(), 3)
+        self.assertEqual(self.pipeline.get_dropped_count(), 2)
+        self.reactor.run_until(lambda: len(self.delivered) >= 8)
+        self.assertEqual(self.delivered, ['a', 'ax', 'd', 'dx', 'e', 'ex', 'f', 'fx'])
+    
+    def test_close_stops_thread(self):
+        threads = []
+        pipeline = TelemetryParsePipeline(
+            parse=lambda item: threads.append(threading.current_thread()) or [item],
+            deliver=self.delivered.append,
+            reactor=self.reactor)
+        pipeline.submit('a')
+        self.reactor.run_until(lambda: self.delivered == ['a'])
+        thread, = threads
+        self.assertTrue(thread.daemon)
+        pipeline.close()
+        self.assertTrue(pipeline.is_closed())
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        pipeline.submit('b')
+        self.assertEqual(pipeline.get_queue_length(), 0)
+
+
+class _ThreadReactor(object):
+    """Minimal reactor substitute which runs callFromThread calls only when the test asks."""
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__calls = []
+    
+    def callFromThread(self, f, *args, **kwargs):
+        with self.__condition:
+            self.__calls.append(lambda: f(*args, **kwargs))
+            self.__condition.notify()
+    
+    def wait_for_call(self, timeout=5):
+        deadline = time.time() + timeout
+        with self.__condition:
+            while not self.__calls:
+                if time.time() > deadline:
+                    raise Exception('timed out waiting for callFromThread')
+                self.__condition.wait(0.01)
+    
+    def run_until(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            self.wait_for_call(timeout=max(0, deadline - time.time()))
+            with self.__condition:
+                calls = self.__calls
+                self.__calls = []
+            for call in calls:
+                call()
+
+
 class Msg(object):
     implements(ITelemetryMessage)
     
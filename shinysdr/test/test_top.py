@@ -26,12 +26,13 @@ from zope.interface import implements  # available via Twisted
 from gnuradio import gr
 
 from shinysdr.devices import Device, IRXDriver, ITXDriver
+from shinysdr.modes import lookup_mode
 from shinysdr.top import Top
 from shinysdr.plugins import simulate
 from shinysdr.signals import SignalType
 from shinysdr.test.testutil import state_smoke_test
 from shinysdr.types import Range
-from shinysdr.values import ExportedState
+from shinysdr.values import ExportedState, Poller
 
 
 class TestTop(unittest.TestCase):
@@ -105,6 +106,26 @@ class TestTop(unittest.TestCase):
         (_key, receiver) = top.add_receiver('NONSENSE', key='a')
         self.assertEqual(receiver.get_mode(), 'AM')
     
+    def test_transient_receiver_not_saved(self):
+        top = Top(devices={'s1': simulate.SimulatedDevice(freq=0)})
+        top.add_receiver('AM', key='a')
+        top.add_receiver('AM', key='b', persists=False)
+        self.assertEqual(top.receivers.state_to_json().keys(), ['a'])
+        top.delete_receiver('b')
+        top.add_receiver('AM', key='b')
+        self.assertEqual(sorted(top.receivers.state_to_json().keys()), ['a', 'b'])
+    
+    def test_telemetry_receiver_stays_connected(self):
+        if lookup_mode('MODE-S') is None:
+            raise unittest.SkipTest('Mode S is not available')
+        top = Top(devices={'s1': simulate.SimulatedDevice(freq=0)})
+        (_key, receiver) = top.add_receiver('MODE-S', key='a')
+        # a client comes and goes, leaving no subscribers
+        Poller().subscribe_state(receiver, lambda state: None).unsubscribe()
+        self.assertFalse(receiver.get_always_on())
+        self.assertTrue(receiver.get_interested_cell().get())
+        self.assertTrue(top._Top__receiver_wanted['a'])
+    
     def test_audio_queue_smoke(self):
         top = Top(devices={'s1': simulate.SimulatedDevice(freq=0)})
         queue = gr.msg_queue()
@@ -120,6 +141,26 @@ class TestTop(unittest.TestCase):
         top.add_audio_queue(queue, 48000)
         top.remove_audio_queue(queue)
     
+    def test_device_graphs_smoke(self):
+        freq1 = 1e6
+        freq2 = 2e6
+        top = Top(
+            devices={
+                's1': simulate.SimulatedDevice(freq=freq1),
+                's2': simulate.SimulatedDevice(freq=freq2),
+            },
+            features={'stereo': True, 'device_graphs': True})
+        queue = gr.msg_queue()
+        (_key, receiver) = top.add_receiver('AM', key='a')
+        top.add_audio_queue(queue, 48000)
+        receiver.set_rec_freq(freq2)
+        receiver.set_device_name('s2')
+        self.assertTrue(receiver.get_is_valid())
+        top.set_source_name('s2')
+        self.assertEqual(top.state()['monitor'].get().get_fft_info()[0], freq2)
+        top.delete_receiver('a')
+        top.remove_audio_queue(queue)
+    
     def test_close(self):
         l = set()
         top = Top(devices={'m': Device(
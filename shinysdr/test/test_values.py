@@ -24,7 +24,7 @@ from __future__ import absolute_import, division
 import unittest
 
 from shinysdr.types import Range
-from shinysdr.values import ExportedState, CollectionState, LooseCell, Poller, ViewCell, command, exported_block, exported_value, setter, unserialize_exported_state
+from shinysdr.values import ExportedState, CollectionState, LooseCell, Poller, TextStreamCell, ViewCell, command, exported_block, exported_value, setter, unserialize_exported_state
 
 
 class TestExportedState(unittest.TestCase):
@@ -101,6 +101,12 @@ class TestDecoratorInheritance(unittest.TestCase):
         self.assertEqual(rw_cell.get(), 0.0)
         rw_cell.set(1.0)
         self.assertEqual(rw_cell.get(), 1.0)
+    
+    def test_setter_only_in_subclass(self):
+        # the per-class member lists must not be shared between classes
+        self.assertFalse(DecoratorInheritanceSpecimenSuper().state()['inherited'].isWritable())
+        self.assertTrue(DecoratorInheritanceSetterSpecimen().state()['inherited'].isWritable())
+        self.assertFalse(DecoratorInheritanceSpecimenSuper().state()['inherited'].isWritable())
 
 
 class DecoratorInheritanceSpecimenSuper(ExportedState):
@@ -124,6 +130,13 @@ class DecoratorInheritanceSpecimen(DecoratorInheritanceSpecimenSuper):
         self.rw = value
 
 
+class DecoratorInheritanceSetterSpecimen(DecoratorInheritanceSpecimenSuper):
+    """Helper for TestDecorator"""
+    @setter
+    def set_inherited(self, value):
+        pass
+
+
 class TestBlockCell(unittest.TestCase):
     def setUp(self):
         self.obj_value = ExportedState()
@@ -169,8 +182,8 @@ class TestViewCell(unittest.TestCase):
     def test_subscription(self):
         fired = []
         
-        def f():
-            fired.append(self.vc.get())
+        def f(value):
+            fired.append(value)
         
         self.vc.subscribe(f)
         self.lc.set(1)
@@ -251,6 +264,14 @@ class TestCellIdentity(unittest.TestCase):
             
     def test_block_cell(self):
         self.assertConsistent(lambda: self.object.state()['block'])
+    
+    def test_dynamic_reuses_decorator_cells(self):
+        self.assertIs(self.object.state()['value'], self.object.state()['value'])
+    
+    def test_compact(self):
+        for key in ['value', 'block']:
+            self.assertFalse(hasattr(self.object.state()[key], '__dict__'), key)
+        self.assertFalse(hasattr(LooseCell(key='k', value=0, type=int), '__dict__'))
 
 
 class CellIdentitySpecimen(ExportedState):
@@ -280,50 +301,130 @@ class TestPoller(unittest.TestCase):
     
     def test_trivial(self):
         cell = self.cells.state()['foo']
-        called = [0]
-        
-        def callback():
-            called[0] += 1
+        received = []
         
-        sub = self.poller.subscribe(cell, callback)
-        self.assertEqual(0, called[0], 'initial')
+        sub = self.poller.subscribe(cell, received.append)
+        self.assertEqual([], received, 'initial')
         self.poller.poll()
-        self.assertEqual(0, called[0], 'noop poll')
+        self.assertEqual([], received, 'noop poll')
         self.cells.set_foo('a')
-        self.assertEqual(0, called[0], 'after set')
+        self.assertEqual([], received, 'after set')
         self.poller.poll()
-        self.assertEqual(1, called[0], 'poll after set')
+        self.assertEqual(['a'], received, 'poll after set')
         
         sub.unsubscribe()
         self.cells.set_subscribable('b')
         self.poller.poll()
-        self.assertEqual(1, called[0], 'no poll after unsubscribe')
+        self.assertEqual(['a'], received, 'no poll after unsubscribe')
     
     def test_subscription_support(self):
         cell = self.cells.state()['subscribable']
-        called = [0]
+        received = []
         
-        def callback():
-            called[0] += 1
-        
-        sub = self.poller.subscribe(cell, callback)
+        sub = self.poller.subscribe(cell, received.append)
         self.assertEqual(0, self.poller._Poller__targets.count_keys(), 'no polling')
-        self.assertEqual(0, called[0], 'initial')
+        self.assertEqual([], received, 'initial')
         self.cells.set_subscribable('a')
-        self.assertEqual(0, called[0], 'after set')
+        self.assertEqual([], received, 'after set')
         self.assertEqual('a', self.cells.get_subscribable())
         self.poller.poll()
-        self.assertEqual(1, called[0], 'poll after set')
+        self.assertEqual(['a'], received, 'poll after set')
         
         sub.unsubscribe()
         self.cells.set_subscribable('b')
         self.poller.poll()
-        self.assertEqual(1, called[0], 'no poll after unsubscribe')
+        self.assertEqual(['a'], received, 'no poll after unsubscribe')
+    
+    def test_subscription_latest_value(self):
+        cell = self.cells.state()['subscribable']
+        received = []
+        self.poller.subscribe(cell, received.append)
+        self.cells.set_subscribable('a')
+        self.cells.set_subscribable('b')
+        self.poller.poll()
+        self.assertEqual(['b'], received)
+    
+    def test_value_read_once_per_poll(self):
+        cell = self.cells.state()['foo']
+        received = []
+        self.poller.subscribe(cell, received.append)
+        self.poller.subscribe(cell, received.append)
+        self.cells.set_foo('a')
+        gets_before = self.cells.foo_gets
+        self.poller.poll()
+        self.assertEqual(['a', 'a'], received)
+        self.assertEqual(1, self.cells.foo_gets - gets_before)
+    
+    def test_text_stream(self):
+        chunks = [u'']
+        
+        def source():
+            chunk = chunks[0]
+            chunks[0] = u''
+            return chunk
+        
+        cell = TextStreamCell(key='text', source=source, size=5)
+        received = []
+        sub = self.poller.subscribe(cell, received.append)
+        self.poller.poll()
+        self.assertEqual([], received, 'no text')
+        chunks[0] = u'abc'
+        self.poller.poll()
+        chunks[0] = u'defg'
+        self.poller.poll()
+        self.assertEqual([u'abc', u'defg'], received, 'only new text is delivered')
+        self.assertEqual(u'cdefg', cell.get(), 'ring buffer')
+        self.assertEqual(u'text_stream', cell.description()['kind'])
+        
+        sub.unsubscribe()
+        chunks[0] = u'h'
+        self.poller.poll()
+        self.assertEqual([u'abc', u'defg'], received, 'no poll after unsubscribe')
+
+    
+    def test_state_subscription_count(self):
+        obj = SubscriptionCountSpecimen()
+        sub1 = self.poller.subscribe_state(obj, lambda state: None)
+        sub2 = self.poller.subscribe_state(obj, lambda state: None)
+        self.assertEqual([1, 2], obj.counts)
+        sub1.unsubscribe()
+        sub2.unsubscribe()
+        self.assertEqual([1, 2, 1, 0], obj.counts)
+    
+    def test_poll_order_and_unsubscribe_during_poll(self):
+        fired = []
+        subs = []
+        
+        def make_callback(i):
+            def callback(state):
+                fired.append(i)
+                if i == 0:
+                    subs[2].unsubscribe()
+            return callback
+        
+        for i in xrange(100):
+            subs.append(self.poller.subscribe_state(ExportedState(), make_callback(i)))
+        for i in xrange(3, 60):
+            subs[i].unsubscribe()
+        subs.append(self.poller.subscribe_state(ExportedState(), make_callback(100)))
+        self.poller.poll()
+        self.assertEqual([0, 1] + range(60, 101), fired)
+        self.assertEqual(43, self.poller._Poller__targets.count_keys())
+
+
+class SubscriptionCountSpecimen(ExportedState):
+    """Helper for TestPoller"""
+    def __init__(self):
+        self.counts = []
+    
+    def state_subscription_count_changed(self, count):
+        self.counts.append(count)
 
 
 class PollerCellsSpecimen(ExportedState):
     """Helper for TestPoller"""
     foo = None
+    foo_gets = 0
     
     def __init__(self):
         self.subscribable = LooseCell(key='subscribable', value='', type=str)
@@ -339,6 +440,7 @@ class PollerCellsSpecimen(ExportedState):
     
     @exported_value()
     def get_foo(self):
+        self.foo_gets += 1
         return self.foo
 
     @setter
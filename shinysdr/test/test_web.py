@@ -22,6 +22,7 @@
 from __future__ import absolute_import, division
 
 import json
+import struct
 import urlparse
 
 from zope.interface import Interface, implements  # available via Twisted
@@ -36,7 +37,7 @@ from shinysdr.db import DatabaseModel
 from shinysdr.signals import SignalType
 from shinysdr.values import ExportedState, CollectionState, NullExportedState, Poller, exported_block, exported_value, nullExportedState, setter
 # TODO: StateStreamInner is an implementation detail; arrange a better interface to test
-from shinysdr.web import StateStreamInner, WebService
+from shinysdr.web import OurStreamFactory, StateStreamInner, WebService
 from shinysdr.test import testutil
 
 
@@ -267,6 +268,181 @@ class TestStateStream(StateStreamTestCase):
         self.assertRaises(KeyError, lambda:
             self.stream.dataReceived(json.dumps(['set', 99999, 100.0, 1234])))
         self.assertEqual(self.getUpdates(), [])
+    
+    def test_pause_still_sends_changes(self):
+        self.setUpForObject(StateSpecimen())
+        self.getUpdates()
+        self.stream.pauseProducing()
+        self.object.set_rw(2.0)
+        self.assertEqual(self.getUpdates(), [
+            ['value', 2, 2.0],
+        ])
+        self.stream.resumeProducing()
+        self.assertEqual(self.getUpdates(), [])
+    
+    def test_coalesce(self):
+        self.setUpForObject(StateSpecimen())
+        self.getUpdates()
+        self.stream.pauseProducing()
+        self.stream.coalesce_changes()
+        self.object.set_rw(2.0)
+        self.assertEqual(self.getUpdates(), [])
+        self.object.set_rw(3.0)
+        self.assertEqual(self.getUpdates(), [])
+        self.stream.resumeProducing()
+        self.assertEqual(self.getUpdates(), [
+            ['value', 2, 3.0],
+        ])
+        self.object.set_rw(4.0)
+        self.assertEqual(self.getUpdates(), [
+            ['value', 2, 4.0],
+        ])
+    
+    def test_coalesce_no_change(self):
+        self.setUpForObject(StateSpecimen())
+        self.getUpdates()
+        self.stream.pauseProducing()
+        self.stream.coalesce_changes()
+        self.object.set_rw(2.0)
+        self.getUpdates()
+        self.object.set_rw(1.0)
+        self.getUpdates()
+        self.stream.resumeProducing()
+        self.assertEqual(self.getUpdates(), [])
+
+
+class TestStateStreamBinaryBatching(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.stream = StateStreamInner(
+            self.sent.append,
+            StateSpecimen(),
+            'urlroot',
+            lambda: None,
+            poller=Poller())
+        self.stream._flush()
+        del self.sent[:]
+    
+    def test_batch_and_order(self):
+        self.stream._send1(True, (5, 'abc'))
+        self.stream._send1(True, (6, ''))
+        self.stream._send1(False, ['value', 1, 2])
+        self.stream._send1(True, (7, 'de'))
+        self.stream._send1(False, ['value', 1, 3])
+        self.stream._flush()
+        # one message of each kind, JSON first
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(json.loads(self.sent[0]), [['value', 1, 2], ['value', 1, 3]])
+        self.assertEqual(self.sent[1], struct.pack('<II', 7, 5) + 'abc' + struct.pack('<II', 4, 6) + struct.pack('<II', 6, 7) + 'de')
+    
+    def test_drop_frames_for_deleted(self):
+        self.stream._send1(True, (5, 'abc'))
+        self.stream._send1(True, (6, 'de'))
+        self.stream._send1(False, ('delete', 5))
+        self.stream._flush()
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(json.loads(self.sent[0]), [['delete', 5]])
+        self.assertEqual(self.sent[1], struct.pack('<II', 6, 6) + 'de')
+    
+    def test_shed_while_paused(self):
+        self.stream.pauseProducing()
+        self.stream._send1(True, (5, 'abc'))
+        self.stream._send1(False, ['value', 1, 2])
+        self.stream._flush()
+        self.stream.resumeProducing()
+        self.stream._send1(True, (6, 'de'))
+        self.stream._flush()
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(json.loads(self.sent[0]), [['value', 1, 2]])
+        self.assertEqual(self.sent[1], struct.pack('<II', 6, 6) + 'de')
+
+
+class _ProducerTransportStub(object):
+    location = '/radio'
+    
+    def __init__(self):
+        self.producer = None
+        self.written = []
+        self.closed = None
+    
+    def setBinaryMode(self, value):
+        pass
+    
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+    
+    def write(self, data):
+        self.written.append(data)
+    
+    def close(self, reason=None):
+        self.closed = reason
+
+
+class TestOurStreamProtocol(unittest.TestCase):
+    def setUp(self):
+        self.protocol = OurStreamFactory({None: StateSpecimen()}, _noop).buildProtocol(None)
+        self.transport = _ProducerTransportStub()
+        self.protocol.makeConnection(self.transport)
+        # not using a real StateStreamInner, which would use the global poller
+        self.inner = _ProducerStub()
+        self.protocol.inner = self.inner
+    
+    def __send(self, message):
+        # warning: implementation poking; this is what the inner object is given to send with
+        self.protocol._OurStreamProtocol__send(message)
+    
+    def test_producer(self):
+        self.assertIs(self.transport.producer, self.protocol)
+        self.protocol.pauseProducing()
+        self.protocol.resumeProducing()
+        self.protocol.stopProducing()
+        self.assertEqual(self.inner.calls, ['pause', 'resume', 'stop'])
+    
+    def test_escalation(self):
+        chunk = 'x' * 150000
+        self.protocol.pauseProducing()
+        self.__send(chunk)
+        self.assertEqual(self.inner.calls, ['pause'])
+        self.__send(chunk)
+        self.assertEqual(self.inner.calls, ['pause', 'coalesce'])
+        self.protocol.resumeProducing()
+        
+        # the count starts over on each pause
+        self.protocol.pauseProducing()
+        self.__send(chunk)
+        self.assertEqual(self.inner.calls, ['pause', 'coalesce', 'resume', 'pause'])
+        self.assertEqual(len(self.transport.written), 3)
+        self.assertEqual(self.transport.closed, None)
+    
+    def test_hard_limit(self):
+        chunk = 'x' * 300000
+        self.protocol.pauseProducing()
+        for _ in xrange(4):
+            self.__send(chunk)
+        self.assertEqual(len(self.transport.written), 3)
+        self.assertEqual(self.transport.closed, 'Too much data buffered')
+        self.flushLoggedErrors()
+        # nothing more is written, even when resumed
+        self.protocol.resumeProducing()
+        self.__send(chunk)
+        self.assertEqual(len(self.transport.written), 3)
+
+
+class _ProducerStub(object):
+    def __init__(self):
+        self.calls = []
+    
+    def pauseProducing(self):
+        self.calls.append('pause')
+    
+    def resumeProducing(self):
+        self.calls.append('resume')
+    
+    def stopProducing(self):
+        self.calls.append('stop')
+    
+    def coalesce_changes(self):
+        self.calls.append('coalesce')
 
 
 class IFoo(Interface):
@@ -32,10 +32,13 @@ from zope.interface import Interface, implements  # available via Twisted
 from gnuradio import blocks
 from gnuradio import gr
 
-from shinysdr.audiomux import AudioManager
-from shinysdr.blocks import MonitorSink, RecursiveLockBlockMixin, Context
+from shinysdr.audiomux import AudioManager, make_audio_bridge
+from shinysdr.blocks import MonitorSink, RecursiveLockBlockMixin
+from shinysdr.diagnostics import Diagnostics, enable_perf_counters
 from shinysdr.math import LazyRateCalculator
 from shinysdr.receiver import Receiver
+from shinysdr.recorder import IQRecorder
+from shinysdr.scanner import Scanner
 from shinysdr.signals import SignalType
 from shinysdr.telemetry import TelemetryStore
 from shinysdr.types import Enum, Notice
@@ -59,6 +62,12 @@ class ReceiverCollection(CollectionState):
         
     def delete_child(self, key):
         self.__top.delete_receiver(key)
+    
+    def state_to_json(self):
+        state = super(ReceiverCollection, self).state_to_json()
+        for key in self.__top._get_transient_receiver_keys():
+            state.pop(key, None)
+        return state
 
 
 # TODO: Figure out how to stop having to 'declare' this here and in config.py
@@ -67,13 +76,15 @@ _stub_features = {'stereo': True}
 
 class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
 
-    def __init__(self, devices={}, audio_config=None, features=_stub_features):
+    def __init__(self, devices={}, audio_config=None, features=_stub_features, frequency_index=None, recording_directory=None):
         if len(devices) <= 0:
             raise ValueError('Must have at least one RF device')
         
         gr.top_block.__init__(self, "SDR top block")
         self.__running = False  # duplicate of GR state we can't reach, see __start_or_stop
         self.__has_a_useful_receiver = False
+        self.__is_recording = False
+        self.__monitor_graph = None  # graph the monitor is connected in
 
         # Configuration
         # TODO: device refactoring: Remove vestigial 'accessories'
@@ -82,6 +93,16 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         self.source_name = self._sources.keys()[0]  # arbitrary valid initial value
         self.__rx_device_type = Enum({k: v.get_name() or k for (k, v) in self._sources.iteritems()})
         
+        # If enabled, each RF device, its receivers, and the monitor if it is using that device, are in a separate top block, so that locking, reconnecting, or restarting one does not disturb the others and their work is scheduled independently. This top block then contains only audio mixing and output, which receivers' audio reaches through bridges.
+        if features.get('device_graphs', False):
+            self.__device_graphs = {k: DeviceGraph(k, d) for k, d in self._sources.iteritems()}
+        else:
+            self.__device_graphs = None
+        self.__demodulator_pool = features.get('demodulator_pool', False)
+        self.__device_graph_plans = {}  # what is connected in each device graph
+        self.__audio_bridges = {}  # receiver key -> (sink, source)
+        self.__receiver_graphs = {}  # receiver key -> graph it is connected in
+        
         # Audio early setup
         self.__audio_manager = AudioManager(  # must be before contexts
             graph=self,
@@ -95,20 +116,40 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         self.__monitor_rx_driver = None
         self.monitor = MonitorSink(
             signal_type=SignalType(sample_rate=10000, kind='IQ'),  # dummy value will be updated in _do_connect
-            context=Context(self))
-        self.monitor.get_interested_cell().subscribe(self.__start_or_stop_later)
+            context=_GraphContext(self._get_monitor_graph))
+        self.monitor.get_interested_cell().subscribe(lambda interested: self.__start_or_stop_later())
         self.__clip_probe = MaxProbe()
         
         # Receiver blocks (multiple, eventually)
         self._receivers = {}
         self._receiver_valid = {}
+        self.__receiver_wanted = {}  # whether connected at last reconnect, modulo validity
+        self.__transient_receivers = set()  # keys of receivers not to be saved
+        self.__receiver_interest_subscriptions = {}
         
         # collections
         # TODO: No longer necessary to have these non-underscore names
         self.sources = CollectionState(self._sources)
         self.receivers = ReceiverCollection(self._receivers, self)
         self.accessories = CollectionState(accessories)
+        if recording_directory is not None:
+            self._recorders = {
+                k: IQRecorder(
+                    device=d,
+                    device_key=k,
+                    directory=recording_directory,
+                    changed=self.__recorder_changer(k))
+                for k, d in self._sources.iteritems()}
+        else:
+            self._recorders = {}
+        self.recorders = CollectionState(self._recorders)
         self.__telemetry_store = TelemetryStore()
+        self.__scanner = Scanner(top=self, frequency_index=frequency_index)
+        if features.get('perf_counters', False):
+            enable_perf_counters()
+        self.__diagnostics = Diagnostics(
+            get_roots=self.__diagnostics_roots,
+            counters_enabled=features.get('perf_counters', False))
         
         # Flags, other state
         self.__needs_reconnect = [u'initialization']
@@ -120,14 +161,19 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         # Initialization
         
         def hookup_vfo_callback(k, d):  # function so as to not close over loop variable
-            d.get_vfo_cell().subscribe(lambda: self.__device_vfo_callback(k))
+            d.get_vfo_cell().subscribe(lambda value: self.__device_vfo_callback(k))
         
         for k, d in devices.iteritems():
             hookup_vfo_callback(k, d)
         
         self._do_connect()
 
-    def add_receiver(self, mode, key=None, state=None):
+    def add_receiver(self, mode, key=None, state=None, persists=True):
+        """
+        Create a receiver and return (key, receiver).
+        
+        If persists is false, the receiver is left out of the saved state, as is appropriate for one created automatically (e.g. by the scanner) which would be unmanaged after a restart.
+        """
         if len(self._receivers) >= 100:
             # Prevent storage-usage DoS attack
             raise Exception('Refusing to create more than 100 receivers')
@@ -160,11 +206,17 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
             audio_channels=self.__audio_manager.get_channels(),
             device_name=self.source_name,
             audio_destination=self.__audio_manager.get_default_destination(),  # TODO match others
+            demodulator_pool=self.__demodulator_pool,
             context=facet,
         ), state=combined_state)
         facet._receiver = receiver
         self._receivers[key] = receiver
         self._receiver_valid[key] = False
+        if not persists:
+            self.__transient_receivers.add(key)
+        self.__receiver_wanted[key] = False
+        self.__receiver_interest_subscriptions[key] = receiver.get_interested_cell().subscribe(
+            lambda interested: self.__receiver_interest_changed_later(key))
         
         self.__needs_reconnect.append(u'added receiver ' + key)
         self._do_connect()
@@ -179,14 +231,24 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         receiver = self._receivers[key]
         
         # save defaults for use if about to become empty
-        if len(self._receivers) == 1:
+        if len(self._receivers) == 1 and key not in self.__transient_receivers:
             self.receiver_default_state = receiver.state_to_json()
         
         del self._receivers[key]
         del self._receiver_valid[key]
+        self.__transient_receivers.discard(key)
+        del self.__receiver_wanted[key]
+        self.__audio_bridges.pop(key, None)
+        self.__receiver_graphs.pop(key, None)
+        self.__receiver_interest_subscriptions.pop(key).unsubscribe()
         self.__needs_reconnect.append(u'removed receiver ' + key)
         self._do_connect()
+        receiver.close()
 
+    def _get_transient_receiver_keys(self):
+        """For use by ReceiverCollection only."""
+        return self.__transient_receivers
+    
     # TODO move these methods to a facet of AudioManager
     def add_audio_queue(self, queue, queue_rate):
         self.__audio_manager.add_audio_queue(queue, queue_rate)
@@ -231,49 +293,67 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
             log.msg(u'Flow graph: Rebuilding connections because: %s' % (', '.join(self.__needs_reconnect),))
             self.__needs_reconnect = []
             
-            self._recursive_lock()
-            self.disconnect_all()
-            
-            self.connect(
-                self.__monitor_rx_driver,
-                self.monitor)
-            self.connect(
-                self.__monitor_rx_driver,
-                self.__clip_probe)
-
             # Filter receivers
             audio_rs = self.__audio_manager.reconnecting()
             n_valid_receivers = 0
-            has_non_audio_receiver = False
+            plans = {device_key: [] for device_key in self._sources}
+            recording = {device_key: device_key in self._recorders and self._recorders[device_key].get_recording() for device_key in self._sources}
             for key, receiver in self._receivers.iteritems():
                 self._receiver_valid[key] = receiver.get_is_valid()
+                self.__receiver_wanted[key] = self.__is_receiver_wanted(receiver)
                 if not self._receiver_valid[key]:
                     continue
                 if not self.__audio_manager.validate_destination(receiver.get_audio_destination()):
                     log.err('Flow graph: receiver audio destination %r is not available' % (receiver.get_audio_destination(),))
                     continue
+                if not self.__receiver_wanted[key]:
+                    # No one would hear or see its output, so leave it disconnected, where it costs nothing.
+                    continue
                 n_valid_receivers += 1
                 if n_valid_receivers > 6:
                     # Sanity-check to avoid burning arbitrary resources
                     # TODO: less arbitrary constant; communicate this restriction to client
                     log.err('Flow graph: Refusing to connect more than 6 receivers')
                     break
-                self.connect(self._sources[receiver.get_device_name()].get_rx_driver(), receiver)
                 receiver_output_type = receiver.get_output_type()
-                if receiver_output_type.get_sample_rate() <= 0:
-                    # Demodulator has no output, but receiver has a dummy output, so connect it to something to satisfy flow graph structure.
-                    for ch in xrange(0, self.__audio_manager.get_channels()):
-                        self.connect((receiver, ch), blocks.null_sink(gr.sizeof_float))
-                    # Note that we have a non-audio receiver which may be useful even if there is no audio output
-                    has_non_audio_receiver = True
-                else:
+                has_audio = receiver_output_type.get_sample_rate() > 0
+                plans[receiver.get_device_name()].append((key, receiver, has_audio))
+                if has_audio:
                     assert receiver_output_type.get_kind() == 'STEREO'
-                    audio_rs.input(receiver, receiver_output_type.get_sample_rate(), receiver.get_audio_destination())
+                    audio_rs.input(
+                        self.__get_audio_bridge(key)[1] if self.__device_graphs is not None else receiver,
+                        receiver_output_type.get_sample_rate(),
+                        receiver.get_audio_destination())
             
-            self.__has_a_useful_receiver = audio_rs.finish_bus_connections() or \
-                has_non_audio_receiver
+            self.__is_recording = any(recording.itervalues())
+            if self.__device_graphs is None:
+                # every connected receiver is wanted by someone
+                self.__has_a_useful_receiver = n_valid_receivers > 0
+            else:
+                # this graph contains only audio
+                self.__has_a_useful_receiver = any(
+                    has_audio
+                    for plan in plans.itervalues()
+                    for _, _, has_audio in plan)
+                if not self.__has_a_useful_receiver and self.__running:
+                    # GNU Radio cannot run an empty top block, so stop before emptying it.
+                    self.stop()
+                    self.wait()
+                    self.__running = False
             
+            self._recursive_lock()
+            self.disconnect_all()
+            if self.__device_graphs is None:
+                self.__receiver_graphs.clear()
+                self.__monitor_graph = self
+                self.__connect_device(self, self.source_name, [], with_monitor=True, with_recorder=False)
+                for device_key, plan in plans.iteritems():
+                    self.__connect_device(self, device_key, plan, with_monitor=False, with_recorder=recording[device_key])
+            else:
+                self.__reconnect_device_graphs(plans, recording)
+            audio_rs.finish_bus_connections()
             self._recursive_unlock()
+            self.__diagnostics.rescan()
             # (this is in an if block but it can't not execute if anything else did)
             log.msg('Flow graph: ...done reconnecting (%i ms).' % ((time.time() - t0) * 1000,))
             
@@ -281,6 +361,79 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         
         self.__in_reconnect = False
 
+    def __reconnect_device_graphs(self, plans, recording):
+        # Only device graphs whose contents change are touched, so that reconnecting one device's receivers does not interrupt the others.
+        changed = []
+        for device_key, plan in plans.iteritems():
+            with_monitor = device_key == self.source_name
+            with_recorder = recording[device_key]
+            signature = (with_monitor, with_recorder, [(key, id(receiver), has_audio) for key, receiver, has_audio in plan])
+            if signature != self.__device_graph_plans.get(device_key):
+                self.__device_graph_plans[device_key] = signature
+                changed.append((device_key, plan, with_monitor, with_recorder))
+        
+        # Disconnect everything that is changing before connecting anything, since a receiver or the monitor may be moving from one graph to another.
+        for device_key, plan, with_monitor, with_recorder in changed:
+            graph = self.__device_graphs[device_key]
+            if plan or with_monitor or with_recorder:
+                graph._recursive_lock()
+            else:
+                # GNU Radio cannot run an empty top block, so stop rather than lock.
+                graph.set_running(False)
+            graph.disconnect_all()
+            for key in [k for k, g in self.__receiver_graphs.iteritems() if g is graph]:
+                del self.__receiver_graphs[key]
+        for device_key, plan, with_monitor, with_recorder in changed:
+            graph = self.__device_graphs[device_key]
+            if with_monitor:
+                self.__monitor_graph = graph
+            self.__connect_device(graph, device_key, plan, with_monitor=with_monitor, with_recorder=with_recorder)
+            if plan or with_monitor or with_recorder:
+                graph._recursive_unlock()
+    
+    def __connect_device(self, graph, device_key, plan, with_monitor, with_recorder):
+        rx_driver = self._sources[device_key].get_rx_driver()
+        if with_monitor:
+            graph.connect(rx_driver, self.monitor)
+            graph.connect(rx_driver, self.__clip_probe)
+        if with_recorder:
+            graph.connect(rx_driver, self._recorders[device_key])
+        for key, receiver, has_audio in plan:
+            self.__receiver_graphs[key] = graph
+            graph.connect(rx_driver, receiver)
+            if not has_audio:
+                # Demodulator has no output, but receiver has a dummy output, so connect it to something to satisfy flow graph structure.
+                for ch in xrange(0, self.__audio_manager.get_channels()):
+                    graph.connect((receiver, ch), blocks.null_sink(gr.sizeof_float))
+            elif graph is not self:
+                bridge_sink = self.__get_audio_bridge(key)[0]
+                for ch in xrange(0, self.__audio_manager.get_channels()):
+                    graph.connect((receiver, ch), (bridge_sink, ch))
+    
+    def __get_audio_bridge(self, key):
+        if key not in self.__audio_bridges:
+            self.__audio_bridges[key] = make_audio_bridge(self.__audio_manager.get_channels())
+        return self.__audio_bridges[key]
+    
+    def _get_monitor_graph(self):
+        """for the monitor's context only"""
+        if self.__monitor_graph is not None:
+            return self.__monitor_graph
+        return self.__graph_for_device(self.source_name)
+    
+    def _get_receiver_graph(self, key):
+        """for ContextForReceiver only"""
+        if key in self.__receiver_graphs:
+            return self.__receiver_graphs[key]
+        receiver = self._receivers.get(key)
+        # if not yet added, it is being created, and will be on the monitor's device
+        return self.__graph_for_device(receiver.get_device_name() if receiver is not None else self.source_name)
+    
+    def __graph_for_device(self, device_key):
+        if self.__device_graphs is None:
+            return self
+        return self.__device_graphs[device_key]
+
     def __device_vfo_callback(self, device_key):
         # Note that in addition to the flow graph delay, the callLater is also needed in order to ensure we don't do our reconfiguration in the middle of the source's own workings.
         reactor.callLater(
@@ -299,6 +452,37 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
                 self._update_receiver_validity(rec_key)
             # TODO: If multiple receivers change validity we'll do redundant reconnects in this loop; avoid that.
 
+    def __is_receiver_wanted(self, receiver):
+        if receiver.get_interested_cell().get():
+            return True
+        return (
+            receiver.get_output_type().get_sample_rate() > 0 and
+            self.__audio_manager.destination_has_outputs(receiver.get_audio_destination()))
+    
+    def __receiver_interest_changed_later(self, key):
+        # Subscriptions change in the middle of other operations, so don't reconnect immediately.
+        reactor.callLater(0, self.__receiver_interest_changed, key)
+    
+    def __receiver_interest_changed(self, key):
+        receiver = self._receivers.get(key)
+        if receiver is None:
+            return
+        if self.__is_receiver_wanted(receiver) != self.__receiver_wanted[key]:
+            self._trigger_reconnect(u'receiver %s demand changed' % (key,))
+    
+    def __diagnostics_roots(self):
+        roots = {'monitor': self.monitor}
+        for key, device in self._sources.iteritems():
+            roots['device-' + key] = device.get_rx_driver()
+        for key, recorder in self._recorders.iteritems():
+            roots['recorder-' + key] = recorder
+        for key, receiver in self._receivers.iteritems():
+            roots['receiver-' + key] = receiver
+        return roots
+    
+    def __recorder_changer(self, device_key):
+        return lambda: self._trigger_reconnect(u'recording on %s started or stopped' % (device_key,))
+    
     def _update_receiver_validity(self, key):
         receiver = self._receivers[key]
         if receiver.get_is_valid() != self._receiver_valid[key]:
@@ -329,6 +513,22 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
     def get_telemetry_store(self):
         return self.__telemetry_store
     
+    @exported_block()
+    def get_scanner(self):
+        return self.__scanner
+    
+    @exported_block()
+    def get_recorders(self):
+        return self.recorders
+    
+    @exported_block(persists=False)
+    def get_diagnostics(self):
+        return self.__diagnostics
+    
+    def metrics(self):
+        """Return the diagnostics counters as rows for shinysdr.diagnostics.format_metrics, for the web server's metrics resource."""
+        return self.__diagnostics.metric_rows()
+    
     def start(self, **kwargs):
         # trigger reconnect/restart notification
         self._recursive_lock()
@@ -342,23 +542,23 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         self.__running = False
 
     def __start_or_stop(self):
-        # TODO: Improve start/stop conditions:
-        #
-        # * run if a client is watching an audio-having receiver's cell-based outputs (e.g. VOR) but not listening to audio
-        #
-        # * don't run if no client is watching a pure telemetry receiver
-        #   (maybe a user preference since having a history when you connect is useful)
-        #
-        # Both of these refinements require becoming aware of cell subscriptions.
-        should_run = (
-            self.__has_a_useful_receiver
-            or self.monitor.get_interested_cell().get())
+        # Receivers which no one is listening to or watching, and which are not always_on, are not connected (see _do_connect), so this only needs to know whether there are any connected receivers.
+        monitor_wanted = self.monitor.get_interested_cell().get()
+        if self.__device_graphs is None:
+            should_run = self.__has_a_useful_receiver or monitor_wanted or self.__is_recording
+        else:
+            # This graph contains only audio, which exists if any receiver with audio output is connected.
+            should_run = self.__has_a_useful_receiver
         if should_run != self.__running:
             if should_run:
                 self.start()
             else:
                 self.stop()
                 self.wait()
+        if self.__device_graphs is not None:
+            for device_key, graph in self.__device_graphs.iteritems():
+                with_monitor, with_recorder, plan = self.__device_graph_plans.get(device_key, (False, False, []))
+                graph.set_running(len(plan) > 0 or with_recorder or (with_monitor and monitor_wanted))
 
     def __start_or_stop_later(self):
         reactor.callLater(0, self.__start_or_stop)
@@ -367,12 +567,17 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         """Close all devices in preparation for a clean shutdown.
         
         Makes this top block unusable"""
+        for recorder in self._recorders.itervalues():
+            recorder.close()
         for device in self._sources.itervalues():
             device.close()
         for device in self._accessories.itervalues():
             device.close()
         self.stop()
         self.wait()
+        if self.__device_graphs is not None:
+            for graph in self.__device_graphs.itervalues():
+                graph.set_running(False)
 
     @exported_value(type_fn=lambda self: self.__rx_device_type)
     def get_source_name(self):
@@ -414,13 +619,59 @@ class Top(gr.top_block, ExportedState, RecursiveLockBlockMixin):
         self._do_connect()
     
     def _recursive_lock_hook(self):
+        if self.__device_graphs is not None:
+            # devices are not in this graph; see DeviceGraph
+            return
         for source in self._sources.itervalues():
             source.notify_reconnecting_or_restarting()
 
 
-class ContextForReceiver(Context):
+class DeviceGraph(gr.top_block, RecursiveLockBlockMixin):
+    """
+    Top block for one RF device and what is connected to it, when Top is using separate top blocks per device.
+    """
+    def __init__(self, device_key, device):
+        gr.top_block.__init__(self, str('%s device graph' % (device_key,)))
+        self.__device = device
+        self.__running = False  # duplicate of GR state we can't reach
+    
+    def set_running(self, value):
+        if value == self.__running:
+            return
+        if value:
+            # trigger reconnect/restart notification
+            self._recursive_lock()
+            self._recursive_unlock()
+            self.start()
+        else:
+            self.stop()
+            self.wait()
+        self.__running = value
+    
+    def _recursive_lock_hook(self):
+        self.__device.notify_reconnecting_or_restarting()
+
+
+class _GraphContext(object):
+    """
+    Like Context, but for a block which may move between top blocks; get_graph returns the one it is currently in.
+    """
+    def __init__(self, get_graph):
+        self.__get_graph = get_graph
+        self.__locked = []
+    
+    def lock(self):
+        graph = self.__get_graph()
+        self.__locked.append(graph)
+        graph._recursive_lock()
+    
+    def unlock(self):
+        self.__locked.pop()._recursive_unlock()
+
+
+class ContextForReceiver(_GraphContext):
     def __init__(self, top, key):
-        Context.__init__(self, top)
+        _GraphContext.__init__(self, lambda: top._get_receiver_graph(key))
         self.__top = top
         self._key = key
         self._enabled = False  # assigned outside
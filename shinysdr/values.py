@@ -25,7 +25,6 @@
 from __future__ import absolute_import, division
 
 import array
-import bisect
 import struct
 import weakref
 
@@ -35,14 +34,18 @@ from zope.interface import Interface, implements  # available via Twisted
 
 from gnuradio import gr
 
+from shinysdr.profiling import timed
 from shinysdr.types import BulkDataType, to_value_type
 
 
 class BaseCell(object):
+    # There are many cells (one per exported attribute of every object, including each telemetry object), so they avoid having a __dict__. Subclasses which do not declare __slots__ get one as usual.
+    __slots__ = ('_target', '_key', '_persists', '_writable', '__weakref__')
+    
     def __init__(self, target, key, persists=True, writable=False):
         # The exact relationship of target and key depends on the subtype
         self._target = target
-        self._key = key
+        self._key = intern(key) if type(key) is str else key
         self._persists = persists
         self._writable = writable
     
@@ -90,12 +93,18 @@ class BaseCell(object):
     
     def persists(self):
         return self._persists
+    
+    def subscription_count_changed(self, count):
+        """Override this to be notified when the number of poller subscriptions to this cell changes."""
+        pass
         
     def description(self):
         raise NotImplementedError()
 
 
 class ValueCell(BaseCell):
+    __slots__ = ('_value_type',)
+    
     def __init__(self, target, key, type, **kwargs):
         BaseCell.__init__(self, target, key, **kwargs)
         self._value_type = to_value_type(type)
@@ -125,6 +134,8 @@ class ValueCell(BaseCell):
 
 # TODO this name is historical and should be changed
 class Cell(ValueCell):
+    __slots__ = ('_getter', '_setter')
+    
     def __init__(self, target, key, type=to_value_type(object), writable=False, persists=None):
         if persists is None: persists = writable
         ValueCell.__init__(self, target, key, writable=writable, persists=persists, type=type)
@@ -221,7 +232,51 @@ class StreamCell(ValueCell):
         raise Exception('StreamCell is not writable.')
 
 
+class TextStreamCell(ValueCell):
+    """
+    A read-only cell for append-only text, such as the output of a text-mode decoder.
+    
+    source is called, when the cell is polled, to obtain all text produced since it was last called. Subscribers are called with only the newly appended text, so that none is lost however much arrives between polls; get() returns the last `size` characters.
+    """
+    
+    def __init__(self, key, source, size=1000):
+        """
+        The key is not used by the cell itself.
+        """
+        ValueCell.__init__(
+            self,
+            target=object(),
+            key=key,
+            type=unicode,
+            persists=False,
+            writable=False)
+        self.__source = source
+        self.__size = size
+        self.__text = u''
+    
+    def get(self):
+        return self.__text
+    
+    def set(self, value):
+        raise Exception('TextStreamCell is not writable.')
+    
+    def poll_chunk(self):
+        """Fetch and record new text from the source, and return it. For use by the poller."""
+        chunk = self.__source()
+        if chunk:
+            self.__text = (self.__text + chunk)[-self.__size:]
+        return chunk
+    
+    def description(self):
+        description = super(TextStreamCell, self).description()
+        description['kind'] = 'text_stream'
+        description['size'] = self.__size
+        return description
+
+
 class BaseBlockCell(BaseCell):
+    __slots__ = ()
+    
     def __init__(self, target, key, persists=True):
         BaseCell.__init__(self, target, key, writable=False, persists=persists)
     
@@ -245,6 +300,8 @@ class BaseBlockCell(BaseCell):
 
 # TODO: get() code is same as Cell (value-type cell). Refactoring in progress to make block cells less magic.
 class BlockCell(BaseBlockCell):
+    __slots__ = ('_getter',)
+    
     def __init__(self, target, key, persists=True):
         BaseBlockCell.__init__(self, target, key, persists=persists)
         self._getter = getattr(self._target, 'get_' + key)
@@ -257,6 +314,8 @@ class BlockCell(BaseBlockCell):
 
 # TODO: It's unclear whether or not the Cell design makes sense in light of this. We seem to have conflated the index in the container and the type of the contained into one object.
 class CollectionMemberCell(BaseBlockCell):
+    __slots__ = ('__last_seen',)
+    
     def __init__(self, target, key, persists=True):
         BaseBlockCell.__init__(self, target, key, persists=persists)
         self.__last_seen = nullExportedState
@@ -273,7 +332,7 @@ class ISubscribableCell(Interface):
         """
         (TODO main doc)
         
-        Note that the callback may be called _immediately_ upon value change; the callback should therefore avoid taking significant actions until later.
+        The callback is given the new value. Note that the callback may be called _immediately_ upon value change; the callback should therefore avoid taking significant actions until later.
         """
         pass
 
@@ -283,6 +342,7 @@ class LooseCell(ValueCell):
     A cell which stores a value and does not get it from another object; it can therefore reliably provide update notifications.
     """
     implements(ISubscribableCell)
+    __slots__ = ('__value', '__subscriptions', '__post_hook')
     
     def __init__(self, key, value, type, persists=True, writable=False, post_hook=None):
         """
@@ -313,18 +373,17 @@ class LooseCell(ValueCell):
         if self.__post_hook is not None:
             self.__post_hook(value)
         
-        self._fire()
+        self._fire(value)
     
     def set_internal(self, value):
         # TODO: More cap-ish strategy to handle this
         """For use only by the "owner" to report updates."""
         self.__value = value
-        self._fire()
+        self._fire(value)
     
-    def _fire(self):
+    def _fire(self, value):
         for subscription in self.__subscriptions:
-            # TODO: in sync with Poller, add passing the value in here
-            subscription._fire()
+            subscription._fire(value)
     
     def subscribe(self, callback):
         subscription = _LooseCellSubscription(self, callback)
@@ -337,6 +396,8 @@ class LooseCell(ValueCell):
 
 
 class _LooseCellSubscription(object):
+    __slots__ = ('_fire', '__cell')
+    
     def __init__(self, cell, callback):
         self._fire = callback
         self.__cell = cell
@@ -356,10 +417,10 @@ def ViewCell(base, get_transform, set_transform, **kwargs):
         base_value = set_transform(view_value)
         base.set(base_value)
         if base_value != base.get():
-            reverse()
+            reverse(base.get())
     
-    def reverse():
-        self.set(get_transform(base.get()))
+    def reverse(base_value):
+        self.set(get_transform(base_value))
     
     self = LooseCell(
         value=get_transform(base.get()),
@@ -431,31 +492,26 @@ class ExportedState(object):
     def state_is_dynamic(self):
         return False
     
+    def state_subscription_count_changed(self, count):
+        """Override this to be notified when the number of poller subscriptions to this object's state (e.g. from connected clients) changes."""
+        pass
+    
     def state(self):
         if self.state_is_dynamic() or not hasattr(self, '_ExportedState__cache'):
+            # Cells from decorators never change, so even a dynamic object only makes them once.
+            if not hasattr(self, '_ExportedState__member_cells'):
+                self.__member_cells = {
+                    key: member._make_cell(self, key, writable)
+                    for key, member, writable in _get_exported_members(type(self))}
+            
             cache = {}
-            self.__cache = cache
-
+            
             def callback(cell):
                 cache[cell.key()] = cell
             self.state_def(callback)
-            
-            # decorator support
-            # TODO kludgy introspection, figure out what is better
-            for k in dir(type(self)):
-                if not hasattr(self, k): continue
-                v = getattr(type(self), k)
-                # TODO use an interface here and move the check inside
-                if isinstance(v, ExportedGetter):
-                    if not k.startswith('get_'):
-                        # TODO factor out attribute name usage in Cell so this restriction is moot
-                        raise LookupError('Bad getter name', k)
-                    else:
-                        k = k[len('get_'):]
-                    cache[k] = v.make_cell(self, k)
-                elif isinstance(v, ExportedCommand):
-                    cache[k] = v.make_cell(self, k)
-            
+            cache.update(self.__member_cells)
+            self.__cache = cache
+        
         return self.__cache
     
     def state_to_json(self):
@@ -510,6 +566,34 @@ class ExportedState(object):
         return description
 
 
+_exported_members_by_class = weakref.WeakKeyDictionary()
+
+
+def _get_exported_members(cls):
+    """
+    Return a list of (key, descriptor, writable) for the decorator-exported members (ExportedGetter and ExportedCommand) of the class.
+    
+    This is computed once per class, so that objects do not each repeat the introspection.
+    """
+    members = _exported_members_by_class.get(cls)
+    if members is not None:
+        return members
+    members = []
+    for k in dir(cls):
+        # TODO use an interface here and move the check inside
+        v = getattr(cls, k, None)
+        if isinstance(v, ExportedGetter):
+            if not k.startswith('get_'):
+                # TODO factor out attribute name usage in Cell so this restriction is moot
+                raise LookupError('Bad getter name', k)
+            key = k[len('get_'):]
+            members.append((key, v, isinstance(getattr(cls, 'set_' + key, None), ExportedSetter)))
+        elif isinstance(v, ExportedCommand):
+            members.append((k, v, False))
+    _exported_members_by_class[cls] = members
+    return members
+
+
 def unserialize_exported_state(ctor, kwargs=None, state=None):
     all_kwargs = {}
     if kwargs is not None:
@@ -616,13 +700,16 @@ class ExportedGetter(object):
             return self.__function.__get__(obj, type)
     
     def make_cell(self, obj, attr):
+        writable = isinstance(getattr(type(obj), 'set_' + attr, None), ExportedSetter)
+        return self._make_cell(obj, attr, writable)
+    
+    def _make_cell(self, obj, attr, writable):
+        """make_cell, given whether there is a setter (as found by _get_exported_members)."""
         kwargs = self.__cell_kwargs
         if 'type_fn' in kwargs:
             kwargs = kwargs.copy()
             kwargs['type'] = kwargs['type_fn'](obj)
             del kwargs['type_fn']
-        # TODO kludgy introspection, figure out what is better
-        writable = hasattr(obj, 'set_' + attr) and isinstance(getattr(type(obj), 'set_' + attr), ExportedSetter)
         if self.__is_block:
             assert not writable
             return BlockCell(obj, attr, **kwargs)
@@ -666,34 +753,42 @@ class ExportedCommand(object):
     
     def make_cell(self, obj, attr):
         return Command(obj, attr, self.__get__(obj))
+    
+    def _make_cell(self, obj, attr, writable):
+        return self.make_cell(obj, attr)
 
 
-class _SortedMultimap(object):
+class _OrderedMultimap(object):
     """
     Support for Poller.
     Properties not explained by the name:
     * Values must be unique within a given key.
-    * Keys are iterated in sorted order (values are not)
+    * Keys are iterated in the order they were added (values are not). This provides determinism for testing etc. without requiring keys to be comparable.
+    * Adding and removing are constant-time (amortized).
     """
     def __init__(self):
-        # key -> set(values)
+        # key -> entry, where entry is [key, set(values)]; the set is replaced with None when the key is removed
         self.__dict = {}
-        # keys in sorted order
-        self.__sorted = []
+        # entries in insertion order, including removed ones not yet compacted away
+        self.__entries = []
         # count of values (= count of pairs)
         self.__value_count = 0
     
     def iter_snapshot(self):
         # TODO: consider not exposing the value sets directly, especially as this allows noticing mutation
-        return ((key, self.__dict[key]) for key in self.__sorted)
+        # Keys removed during iteration are skipped; keys added during iteration are not visited.
+        for entry in self.__entries[:]:
+            values = entry[1]
+            if values is not None:
+                yield entry[0], values
     
     def add(self, key, value):
-        if key in self.__dict:
-            values = self.__dict[key]
-        else:
-            values = set()
-            self.__dict[key] = values
-            bisect.insort(self.__sorted, key)
+        entry = self.__dict.get(key)
+        if entry is None:
+            entry = [key, set()]
+            self.__dict[key] = entry
+            self.__entries.append(entry)
+        values = entry[1]
         if value in values:
             raise KeyError('Duplicate add: %r' % ((key, value),))
         values.add(value)
@@ -701,27 +796,29 @@ class _SortedMultimap(object):
     
     def remove(self, key, value):
         """Returns true if the value was the last value for that key"""
-        if key not in self.__dict:
+        entry = self.__dict.get(key)
+        if entry is None:
             raise KeyError('No key to remove: %r' % ((key, value),))
-        values = self.__dict[key]
+        values = entry[1]
         if value not in values:
             raise KeyError('No value to remove: %r' % ((key, value),))
         values.remove(value)
         self.__value_count -= 1
         last_out = len(values) == 0
         if last_out:
-            sorted_list = self.__sorted
             del self.__dict[key]
-            index = bisect.bisect_left(sorted_list, key)
-            if sorted_list[index] != key:
-                # TODO: This has been observed to happen. Need to diagnose.
-                raise Exception("can't happen: while removing last value %r for key %r from %r, %r was found instead of the key at index %r in the sorted list" % (value, key, self, sorted_list[index], index))
-            sorted_list[index:index + 1] = []
+            entry[1] = None
+            if len(self.__entries) > 2 * len(self.__dict) + 16:
+                self.__entries = [e for e in self.__entries if e[1] is not None]
         return last_out
     
     def count_keys(self):
         return len(self.__dict)
     
+    def count_values_for_key(self, key):
+        entry = self.__dict.get(key)
+        return len(entry[1]) if entry is not None else 0
+    
     def count_values(self):
         return self.__value_count
 
@@ -732,11 +829,15 @@ class Poller(object):
     """
     
     def __init__(self):
-        # sorting provides determinism for testing etc.
-        self.__targets = _SortedMultimap()
+        self.__targets = _OrderedMultimap()
         self.__functions = []
     
     def subscribe(self, cell, callback):
+        """
+        Call callback, on the poller's schedule, when the cell's value changes.
+        
+        callback is given the new value, or for stream cells each new chunk or frame; it should not need to get() the cell again.
+        """
         if not isinstance(cell, BaseCell):
             # we're not actually against duck typing here; this is a sanity check
             raise TypeError('Poller given a non-cell %r' % (cell,))
@@ -744,6 +845,8 @@ class Poller(object):
             return _NonPollingSubscription(self, cell, callback)
         if isinstance(cell, StreamCell):  # TODO kludge; use generic interface
             return _PollerSubscription(self, _PollerStreamTarget(cell), callback)
+        elif isinstance(cell, TextStreamCell):
+            return _PollerSubscription(self, _PollerTextStreamTarget(cell), callback)
         else:
             return _PollerSubscription(self, _PollerValueTarget(cell), callback)
     
@@ -756,12 +859,17 @@ class Poller(object):
     
     def _add_subscription(self, target, subscription):
         self.__targets.add(target, subscription)
+        target.subscription_count_changed(self.__targets.count_values_for_key(target))
     
     def _remove_subscription(self, target, subscription):
         last_out = self.__targets.remove(target, subscription)
         if last_out:
             target.unsubscribe()
+            target.subscription_count_changed(0)
+        else:
+            target.subscription_count_changed(self.__targets.count_values_for_key(target))
     
+    @timed('poller_poll')
     def poll(self):
         for target, subscriptions in self.__targets.iter_snapshot():
             # pylint: disable=cell-var-from-loop
@@ -806,6 +914,8 @@ the_poller = AutomaticPoller()
 
 
 class _PollerSubscription(object):
+    __slots__ = ('_fire', '_target', '_poller')
+    
     def __init__(self, poller, target, callback):
         self._fire = callback
         self._target = target
@@ -819,23 +929,40 @@ class _PollerSubscription(object):
 class _NonPollingSubscription(object):
     def __init__(self, poller, cell, callback):
         self._poller = poller
+        self._cell = cell
         self._callback = callback
+        self._value = None
+        self._queued = False
         self._cell_subscription = cell.subscribe(self._fire)
     
     def unsubscribe(self):
         self._cell_subscription.unsubscribe()
     
-    def _fire(self):
-        self._poller.queue_function(self._callback)
+    def _fire(self, value):
+        # several changes between polls are delivered once, with the latest value
+        self._value = value
+        if not self._queued:
+            self._queued = True
+            self._poller.queue_function(self._deliver)
+    
+    def _deliver(self):
+        self._queued = False
+        self._callback(self._value)
 
 
 class _PollerTarget(object):
+    __slots__ = ('_obj', '_subscriptions')
+    
     def __init__(self, obj):
         self._obj = obj
         self._subscriptions = []
     
-    def __cmp__(self, other):
-        return cmp(type(self), type(other)) or cmp(self._obj, other._obj)
+    def __eq__(self, other):
+        # pylint: disable=unidiomatic-typecheck
+        return type(self) == type(other) and self._obj == other._obj
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
     
     def __hash__(self):
         return hash(self._obj)
@@ -844,11 +971,16 @@ class _PollerTarget(object):
         """Call fire (with arbitrary info in args) if the thing polled has changed."""
         raise NotImplementedError()
     
+    def subscription_count_changed(self, count):
+        pass
+    
     def unsubscribe(self):
         pass
 
 
 class _PollerValueTarget(_PollerTarget):
+    __slots__ = ('__previous_value',)
+    
     def __init__(self, cell):
         _PollerTarget.__init__(self, cell)
         self.__previous_value = self.__get()
@@ -860,11 +992,15 @@ class _PollerValueTarget(_PollerTarget):
         value = self.__get()
         if value != self.__previous_value:
             self.__previous_value = value
-            # TODO should pass value in to avoid redundant gets
-            fire()
+            fire(value)
+    
+    def subscription_count_changed(self, count):
+        self._obj.subscription_count_changed(count)
 
 
 class _PollerStateTarget(_PollerTarget):
+    __slots__ = ('__previous_structure', '__dynamic')
+    
     def __init__(self, block):
         _PollerTarget.__init__(self, block)
         self.__previous_structure = None  # unequal to any state dict
@@ -877,10 +1013,15 @@ class _PollerStateTarget(_PollerTarget):
             if now != self.__previous_structure:
                 self.__previous_structure = now
                 fire(now)
+    
+    def subscription_count_changed(self, count):
+        self._obj.state_subscription_count_changed(count)
 
 
 class _PollerStreamTarget(_PollerTarget):
     # TODO there are no tests for stream subscriptions
+    __slots__ = ('__subscription',)
+    
     def __init__(self, cell):
         _PollerTarget.__init__(self, cell)
         self.__subscription = cell.subscribe()
@@ -895,3 +1036,15 @@ class _PollerStreamTarget(_PollerTarget):
     def unsubscribe(self):
         self.__subscription.close()
         super(_PollerStreamTarget, self).unsubscribe()
+
+
+class _PollerTextStreamTarget(_PollerTarget):
+    __slots__ = ()
+    
+    def poll(self, fire):
+        chunk = self._obj.poll_chunk()
+        if chunk:
+            fire(chunk)
+    
+    def subscription_count_changed(self, count):
+        self._obj.subscription_count_changed(count)
@@ -36,7 +36,9 @@ from twisted.application import strports
 from twisted.application.service import Service
 from twisted.internet import defer
 from twisted.internet import protocol
+from twisted.internet import threads
 from twisted.internet import reactor as the_reactor  # TODO fix
+from twisted.internet.interfaces import IPushProducer
 from twisted.plugin import IPlugin, getPlugins
 from twisted.python import log
 from twisted.web import http, static, server, template
@@ -51,8 +53,10 @@ import shinysdr.plugins
 import shinysdr.db
 from shinysdr.ephemeris import EphemerisResource
 from shinysdr.modes import get_modes
+from shinysdr.diagnostics import format_metrics
+from shinysdr.profiling import format_stacks, latency_metric_rows, sample_stacks, timed
 from shinysdr.signals import SignalType
-from shinysdr.values import ExportedState, BaseCell, BlockCell, StreamCell, IWritableCollection, the_poller
+from shinysdr.values import ExportedState, BaseCell, BlockCell, StreamCell, TextStreamCell, IWritableCollection, the_poller
 
 
 # temporary kludge until upstream takes our patch
@@ -95,6 +99,7 @@ def _transform_for_json(obj):
 
 
 # JSON-encode values for clients, including in the state stream
+@timed('serialize')
 def _serialize(obj):
     structure = _transform_for_json(obj)
     return _json_encoder_for_serial.encode(structure)
@@ -126,6 +131,7 @@ class CellResource(Resource):
     def render_GET(self, request):
         return self.grrender(self._cell.get(), request)
 
+    @timed('cell_put')
     def render_PUT(self, request):
         data = request.content.read()
         self._cell.set(self.grparse(data))
@@ -215,13 +221,25 @@ class BlockResource(Resource):
             raise Exception('Block is not a writable collection')
         assert request.getHeader('Content-Type') == 'application/json'
         reqjson = json.load(request.content)
-        key = block.create_child(reqjson)  # note may fail
-        self._noteDirty()
-        url = request.prePathURL() + '/receivers/' + urllib.quote(key, safe='')
-        request.setResponseCode(201)  # Created
-        request.setHeader('Location', url)
-        # TODO consider a more useful response
-        return _serialize(url).encode('utf-8')
+        # note may fail; remote objects (shinysdr.remote) return a Deferred
+        d = defer.maybeDeferred(block.create_child, reqjson)
+        
+        def created(key):
+            self._noteDirty()
+            url = request.prePathURL() + '/receivers/' + urllib.quote(key, safe='')
+            request.setResponseCode(201)  # Created
+            request.setHeader('Location', url)
+            # TODO consider a more useful response
+            request.write(_serialize(url).encode('utf-8'))
+            request.finish()
+        
+        def failed(failure):
+            log.err(failure, 'Failed to create child of %r' % (block,))
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.finish()
+        
+        d.addCallbacks(created, failed)
+        return server.NOT_DONE_YET
     
     def render_DELETE(self, request):
         self._deleteSelf()
@@ -266,8 +284,74 @@ class FlowgraphVizResource(Resource):
                 1: 'r',
                 2: 2
             })
-        process.pipes[0].write(self.__block.dot_graph())
-        process.pipes[0].loseConnection()
+        
+        def write_graph(graph):
+            process.pipes[0].write(graph)
+            process.pipes[0].loseConnection()
+        
+        def failed(failure):
+            log.err(failure, 'Failed to get flow graph')
+            process.pipes[0].loseConnection()
+        
+        # remote flow graphs (shinysdr.remote) return a Deferred
+        defer.maybeDeferred(self.__block.dot_graph).addCallback(write_graph).addErrback(failed)
+        return server.NOT_DONE_YET
+
+
+class MetricsResource(Resource):
+    """Plain-text performance counters (see shinysdr.diagnostics) of the flow graph, and latency histograms of this process."""
+    isLeaf = True
+    
+    def __init__(self, block):
+        self.__block = block
+    
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        
+        def write_metrics(rows):
+            text = format_metrics(list(rows) + latency_metric_rows())
+            request.write(text.encode('utf-8') if isinstance(text, unicode) else text)
+            request.finish()
+        
+        def failed(failure):
+            log.err(failure, 'Failed to get metrics')
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.finish()
+        
+        # remote flow graphs (shinysdr.remote) return a Deferred
+        defer.maybeDeferred(self.__block.metrics).addCallback(write_metrics).addErrback(failed)
+        return server.NOT_DONE_YET
+
+
+class ProfileResource(Resource):
+    """
+    Samples the Python stacks of this process's threads for ?seconds=N (default 5) seconds and returns the most frequent ones as plain text.
+    """
+    isLeaf = True
+    max_seconds = 60
+    
+    def __init__(self, reactor):
+        self.__reactor = reactor
+    
+    def render_GET(self, request):
+        try:
+            seconds = float(request.args.get('seconds', ['5'])[0])
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'seconds must be a number\n'
+        seconds = max(0.0, min(self.max_seconds, seconds))
+        request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        
+        def write_stacks(counts):
+            request.write(format_stacks(counts))
+            request.finish()
+        
+        def failed(failure):
+            log.err(failure, 'Failed to profile')
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.finish()
+        
+        threads.deferToThreadPool(self.__reactor, self.__reactor.getThreadPool(), sample_stacks, seconds).addCallback(write_stacks).addErrback(failed)
         return server.NOT_DONE_YET
 
 
@@ -293,6 +377,12 @@ def _get_interfaces(obj):
 
 class _StateStreamObjectRegistration(object):
     # TODO messy
+    # There is one of these per object per client, so they avoid having a __dict__.
+    __slots__ = (
+        '__ssi', 'obj', 'serial', 'url',
+        'has_previous_value', 'previous_value', 'value_is_references',
+        '__dead', '__stale', '__obj_is_cell', '__obj_is_stream', '__poller_registration', '__refcount')
+    
     def __init__(self, ssi, poller, obj, serial, url, refcount):
         self.__ssi = ssi
         self.obj = obj
@@ -302,18 +392,22 @@ class _StateStreamObjectRegistration(object):
         self.previous_value = None
         self.value_is_references = False
         self.__dead = False
+        self.__stale = False
+        self.__obj_is_stream = False
         if isinstance(obj, BaseCell):
             self.__obj_is_cell = True
             if isinstance(obj, StreamCell):  # TODO kludge
+                self.__obj_is_stream = True
                 self.__poller_registration = poller.subscribe(obj, self.__listen_binary_stream)
-                self.send_now_if_needed = lambda: None
+            elif isinstance(obj, TextStreamCell):
+                # initial value is sent in the description
+                self.__obj_is_stream = True
+                self.__poller_registration = poller.subscribe(obj, self.__listen_text_stream)
             else:
                 self.__poller_registration = poller.subscribe(obj, self.__listen_cell)
-                self.send_now_if_needed = self.__listen_cell
         else:
             self.__obj_is_cell = False
             self.__poller_registration = poller.subscribe_state(obj, self.__listen_state)
-            self.send_now_if_needed = lambda: self.__listen_state(self.obj.state())
         self.__refcount = refcount
     
     def __str__(self):
@@ -332,36 +426,64 @@ class _StateStreamObjectRegistration(object):
         """kludge to get initial state sent"""
     
     def send_now_if_needed(self):
-        # should be overridden in instance
-        raise Exception('This placeholder should never get called')
+        if self.__dead or self.__obj_is_stream:
+            pass
+        elif self.__obj_is_cell:
+            self.__update_cell(self.obj.get())
+        else:
+            self.__maybesend_reference(self.obj.state(), False)
+    
+    def resync(self):
+        """Send the current value if it changed while changes were being coalesced."""
+        self.__stale = False
+        self.send_now_if_needed()
     
     def get_object_which_is_cell(self):
         if not self.__obj_is_cell:
             raise Exception('This object is not a cell')
         return self.obj
     
-    def __listen_cell(self):
+    def __mark_stale(self):
+        # While changes are being coalesced, they are not sent; only the latest value is sent on resume.
+        if not self.__stale:
+            self.__stale = True
+            self.__ssi._note_stale(self)
+    
+    def __listen_cell(self, value):
         if self.__dead:
             return
+        if self.__ssi._coalescing:
+            self.__mark_stale()
+            return
+        self.__update_cell(value)
+    
+    def __update_cell(self, value):
         obj = self.obj
-        if isinstance(obj, StreamCell):
+        if isinstance(obj, (StreamCell, TextStreamCell)):
             raise Exception("shouldn't happen: StreamCell here")
         if obj.isBlock():
-            block = obj.get()
-            self.__ssi._lookup_or_register(block, self.url)
-            self.__maybesend_reference({u'value': block}, True)
+            self.__ssi._lookup_or_register(value, self.url)
+            self.__maybesend_reference({u'value': value}, True)
         else:
-            value = obj.get()
             self.__maybesend(value, value)
     
     def __listen_binary_stream(self, value):
         if self.__dead:
             return
-        self.__ssi._send1(True, struct.pack('I', self.serial) + value)
+        self.__ssi._send1(True, (self.serial, value))
+    
+    def __listen_text_stream(self, chunk):
+        if self.__dead:
+            return
+        # The client appends the chunk to the value it has.
+        self.__ssi._send1(False, ('value', self.serial, chunk))
     
     def __listen_state(self, state):
         if self.__dead:
             return
+        if self.__ssi._coalescing:
+            self.__mark_stale()
+            return
         self.__maybesend_reference(state, False)
     
     # TODO fix private refs to ssi here
@@ -427,9 +549,23 @@ class _StateStreamObjectRegistration(object):
                 self.__ssi._registered_objs[obj].dec_refcount_and_maybe_notify()
 
 
+_binary_record_header = struct.Struct('<II')
+
+
 # TODO: Better name for this category of object
 class StateStreamInner(object):
+    """
+    Sends the state of root_object and its descendants, and changes to it, as messages passed to send.
+    
+    This is an IPushProducer, and sheds load in order of priority when the client is not keeping up. While paused, binary stream messages (e.g. FFT frames) are dropped, but changes to cells and blocks are still sent. If the owner finds that not enough (see coalesce_changes), changes are also held back until resumed, at which point only the latest values are sent. Text stream chunks and responses to the client's requests are always sent.
+    """
+    implements(IPushProducer)
+    
     def __init__(self, send, root_object, root_url, noteDirty, poller=the_poller):
+        self._paused = False
+        self._coalescing = False
+        self.__stale_registrations = []
+        self.__dropped_frames = 0
         self.__poller = poller
         self._send = send
         self.__root_object = root_object
@@ -439,6 +575,7 @@ class StateStreamInner(object):
         self._registered_objs = {self._cell: root_registration}
         self.__registered_serials = {root_registration.serial: root_registration}
         self._send_batch = []
+        self.__binary_batch = []  # of (serial, payload)
         self.__batch_delay = None
         self.__root_url = root_url
         self.__noteDirty = noteDirty
@@ -448,6 +585,40 @@ class StateStreamInner(object):
         for obj in self._registered_objs.keys():
             self.__drop(obj)
     
+    # implement IPushProducer
+    def pauseProducing(self):
+        self._paused = True
+    
+    # implement IPushProducer
+    def resumeProducing(self):
+        self._paused = False
+        self._coalescing = False
+        if self.__dropped_frames:
+            log.msg('State stream %s resumed; dropped %i stream frames while paused' % (self.__root_url, self.__dropped_frames))
+            self.__dropped_frames = 0
+        stale = self.__stale_registrations
+        self.__stale_registrations = []
+        for registration in stale:
+            registration.resync()
+    
+    # implement IPushProducer
+    def stopProducing(self):
+        pass
+    
+    def coalesce_changes(self):
+        """
+        Until resumed, hold back changes to cells and blocks, sending only the latest values on resume.
+        
+        For use by OurStreamProtocol, when the buffer keeps growing while paused even though stream frames are being dropped.
+        """
+        if not self._coalescing:
+            self._coalescing = True
+            log.msg('State stream %s is not keeping up with changes; coalescing them' % (self.__root_url,))
+    
+    def _note_stale(self, registration):
+        """For use by _StateStreamObjectRegistration."""
+        self.__stale_registrations.append(registration)
+    
     def dataReceived(self, data):
         # TODO: handle json parse failure or other failures meaningfully
         command = json.loads(data)
@@ -493,7 +664,7 @@ class StateStreamInner(object):
             self.__registered_serials[serial] = registration
             if isinstance(obj, BaseCell):
                 self._send1(False, ('register_cell', serial, url, obj.description()))
-                if isinstance(obj, StreamCell):  # TODO kludge
+                if isinstance(obj, (StreamCell, TextStreamCell)):  # TODO kludge
                     pass
                 elif not obj.isBlock():  # TODO condition is a kludge due to block cell values being gook
                     registration.set_previous({u'value': obj.get()}, False)
@@ -505,29 +676,67 @@ class StateStreamInner(object):
             registration.send_now_if_needed()
             return registration
     
+    @timed('state_stream_flush')
     def _flush(self):  # exposed for testing
+        """
+        Send the queued messages as at most one JSON message followed by at most one binary message.
+        
+        Each kind stays in order, but binary records are not interleaved with JSON messages. This is safe because a binary record only carries a new value for its own cell: the registration of the cell is a JSON message so it is still received first, and records for cells deleted in the same batch are dropped here.
+        """
         self.__batch_delay = None
+        deleted = None
         if len(self._send_batch) > 0:
+            deleted = set(message[1] for message in self._send_batch if message[0] == 'delete')
             # unicode() because JSONEncoder does not reliably return a unicode rather than str object
             self._send(unicode(_serialize(self._send_batch)))
             self._send_batch = []
+        if len(self.__binary_batch) > 0:
+            records = []
+            for serial, payload in self.__binary_batch:
+                if deleted and serial in deleted:
+                    continue
+                records.append(_binary_record_header.pack(4 + len(payload), serial))
+                records.append(payload)
+            self.__binary_batch = []
+            if records:
+                self._send(''.join(records))
     
     def _send1(self, binary, value):
+        """
+        Queue a message to be sent at the end of this reactor turn.
+        
+        If binary is false, value is a JSON-serializable message. Such messages are sent as one JSON array.
+        
+        If binary is true, value is a (serial, payload string) pair. Such messages are sent as one binary WebSocket message containing a sequence of records, each of which is:
+            uint32 (little-endian) length of the rest of the record, i.e. 4 + len(payload)
+            uint32 (little-endian) serial
+            payload
+        """
+        # Messages are batched in order to increase client-side efficiency since each incoming WebSocket message is always a separate JS event. See _flush for ordering.
         if binary:
-            # preserve order by flushing stored non-binary msgs
-            # TODO: Implement batching for binary messages.
-            self._flush()
-            self._send(value)
+            if self._paused:
+                # Binary messages are frequent, large, and superseded by the next, so they are what is shed when the client is not keeping up.
+                self.__dropped_frames += 1
+                return
+            self.__binary_batch.append(value)
         else:
-            # Messages are batched in order to increase client-side efficiency since each incoming WebSocket message is always a separate JS event.
             self._send_batch.append(value)
-            # TODO: Parameterize with reactor so we can test properly
-            if not (self.__batch_delay is not None and self.__batch_delay.active()):
-                self.__batch_delay = the_reactor.callLater(0, self._flush)
+        # TODO: Parameterize with reactor so we can test properly
+        if not (self.__batch_delay is not None and self.__batch_delay.active()):
+            self.__batch_delay = the_reactor.callLater(0, self._flush)
 
 
 class AudioStreamInner(object):
+    """
+    Sends audio from block to send.
+    
+    This is an IPushProducer: while paused, audio is discarded, so that a client which is not keeping up hears gaps rather than falling further and further behind.
+    """
+    implements(IPushProducer)
+    
     def __init__(self, reactor, send, block, audio_rate):
+        self.__paused = False
+        self.__dropped_bytes = 0
         self._send = send
         self._queue = gr.msg_queue(limit=100)
         self.__running = [True]
@@ -547,8 +756,30 @@ class AudioStreamInner(object):
         # Insert a dummy message to ensure the loop thread unblocks; otherwise it will sit around forever, including preventing process shutdown.
         self._queue.insert_tail(gr.message())
     
+    # implement IPushProducer
+    def pauseProducing(self):
+        self.__paused = True
+    
+    # implement IPushProducer
+    def resumeProducing(self):
+        self.__paused = False
+        if self.__dropped_bytes:
+            log.msg('Audio stream resumed; dropped %i bytes while paused' % (self.__dropped_bytes,))
+            self.__dropped_bytes = 0
+    
+    # implement IPushProducer
+    def stopProducing(self):
+        pass
+    
+    def coalesce_changes(self):
+        # Nothing more to shed; everything is already dropped while paused.
+        pass
+    
     def __deliver(self, data_string):
-        self._send(data_string, safe_to_drop=True)
+        if self.__paused:
+            self.__dropped_bytes += len(data_string)
+        else:
+            self._send(data_string)
 
 
 def _AudioStream_read_loop(reactor, queue, deliver, running):
@@ -577,12 +808,27 @@ def _lookup_block(block, path):
     return block
 
 
+# While the transport has us paused, its buffer grows by what we write.
+_paused_bytes_before_coalescing = 200000
+_paused_bytes_before_closing = 1000000
+
+
 class OurStreamProtocol(protocol.Protocol):
+    """
+    Dispatches a WebSocket connection to a StateStreamInner or AudioStreamInner according to its URL.
+    
+    This is registered with the transport as a producer, and passes on pause and resume to the inner object, so that traffic is reduced at its source when the client is not keeping up. If the data written while paused still keeps growing, the inner object is asked to coalesce changes, and if it grows beyond a hard limit (e.g. because the client has stopped reading entirely), the connection is closed.
+    """
+    implements(IPushProducer)
+    
     def __init__(self, caps, noteDirty):
         self._caps = caps
         self._seenValues = {}
         self.inner = None
         self.__noteDirty = noteDirty
+        self.__paused = False
+        self.__paused_bytes = 0
+        self.__closing = False
     
     def dataReceived(self, data):
         """Twisted Protocol implementation.
@@ -620,29 +866,52 @@ class OurStreamProtocol(protocol.Protocol):
             self.inner = StateStreamInner(self.__send, root_object, loc, self.__noteDirty)  # note reuse of loc as HTTP path; probably will regret this
         else:
             raise Exception('Unknown path: %r' % (path,))
+        if self.__paused:
+            self.inner.pauseProducing()
     
     def connectionMade(self):
         """twisted Protocol implementation"""
         self.transport.setBinaryMode(True)
         # Unfortunately, txWS calls this too soon for transport.location to be available
+        self.transport.registerProducer(self, True)
     
     def connectionLost(self, reason):
         """twisted Protocol implementation"""
         if self.inner is not None:
             self.inner.connectionLost(reason)
     
-    def __send(self, message, safe_to_drop=False):
-        if len(self.transport.transport.dataBuffer) > 1000000:
-            # TODO: condition is horrible implementation-diving kludge
-            # Don't accumulate indefinite buffer if we aren't successfully getting it onto the network.
-            
-            if safe_to_drop:
-                log.err('Dropping data going to stream ' + self.transport.location)
-            else:
+    # implement IPushProducer
+    def pauseProducing(self):
+        self.__paused = True
+        if self.inner is not None:
+            self.inner.pauseProducing()
+    
+    # implement IPushProducer
+    def resumeProducing(self):
+        self.__paused = False
+        self.__paused_bytes = 0
+        if self.inner is not None:
+            self.inner.resumeProducing()
+    
+    # implement IPushProducer
+    def stopProducing(self):
+        if self.inner is not None:
+            self.inner.stopProducing()
+    
+    def __send(self, message):
+        if self.__closing:
+            return
+        if self.__paused:
+            before = self.__paused_bytes
+            self.__paused_bytes = after = before + len(message)
+            if after > _paused_bytes_before_closing:
                 log.err('Dropping connection due to too much data on stream ' + self.transport.location)
+                self.__closing = True
                 self.transport.close(reason='Too much data buffered')
-        else:
-            self.transport.write(message)
+                return
+            if before <= _paused_bytes_before_coalescing < after and self.inner is not None:
+                self.inner.coalesce_changes()
+        self.transport.write(message)
 
 
 class OurStreamFactory(protocol.Factory):
@@ -783,6 +1052,8 @@ class WebService(Service):
         
         # Debug graph
         appRoot.putChild('flow-graph', FlowgraphVizResource(reactor, flowgraph_for_debug))
+        appRoot.putChild('metrics', MetricsResource(flowgraph_for_debug))
+        appRoot.putChild('profile', ProfileResource(reactor))
         
         # Ephemeris
         appRoot.putChild('ephemeris', EphemerisResource())
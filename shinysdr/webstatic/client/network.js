@@ -294,6 +294,11 @@ define(['./values', './events'], function (values, events) {
         function (id) { return idMap[id]; });
     } else if (desc.kind === 'command') {
       cell = new RemoteCommandCell(setter, type);
+    } else if (desc.kind === 'text_stream') {
+      // updates carry only the newly appended text
+      cell = new ReadCell(setter, desc.current, type, function (appended) {
+        return (cell.get() + appended).slice(-desc.size);
+      });
     } else if (desc.writable) {
       cell = new ReadWriteCell(setter, desc.current, type);
     } else {
@@ -386,10 +391,20 @@ define(['./values', './events'], function (values, events) {
       
       function oneBinaryMessage(buffer) {
         // Currently, BulkDataCell updates are the only type of binary messages.
+        // A binary message is a batch of records, each a uint32 length followed by that many bytes of (uint32 id, data); see StateStreamInner._send1.
         var view = new DataView(buffer);
-        var id = view.getUint32(0, true);
-        var cell_updater = updaterMap[id];
-        cell_updater(buffer);
+        var offset = 0;
+        while (offset < buffer.byteLength) {
+          var length = view.getUint32(offset, true);
+          var id = view.getUint32(offset + 4, true);
+          if (!(id in updaterMap)) {
+            console.error('Undefined id in state stream binary message', id);
+          } else {
+            // Copied so that the record starts at offset 0, as BulkDataCell expects, and so that typed arrays over it are aligned.
+            (0, updaterMap[id])(buffer.slice(offset + 4, offset + 4 + length));
+          }
+          offset += 4 + length;
+        }
       }
       
       ws.onmessage = function (event) {
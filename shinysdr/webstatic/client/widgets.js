@@ -513,6 +513,15 @@ define(['./values', './events', './widget', './gltools', './database', './menus'
         createWidgetExt(config.context, LinSlider, panSlider, block.audio_pan);
         otherBox.appendChild(document.createTextNode('R'));
       }
+      if ('always_on' in block) {
+        // run even when no one is listening or watching (telemetry modes always do)
+        var alwaysOnLabel = otherBox.appendChild(document.createElement('label'));
+        var alwaysOnCheckbox = alwaysOnLabel.appendChild(document.createElement('input'));
+        alwaysOnLabel.appendChild(document.createTextNode(' Always on'));
+        alwaysOnCheckbox.type = 'checkbox';
+        createWidgetExt(config.context, Toggle, alwaysOnCheckbox, block.always_on);
+        ignore('always_on');
+      }
       
       setInsertion(saveInsert);
       